@@ -0,0 +1,551 @@
+import io
+import json
+import math
+import os
+import tarfile
+import tempfile
+import threading
+import time
+from array import array
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Optional, Sequence
+
+from kivy.logger import Logger as logger
+
+from wacryptolib.sensor import JsonDataAggregator, TarfileRecordsAggregator, TimeLimitedAggregatorMixin
+from waclient.utilities.bounded_queue import BoundedQueueWorker
+from waclient.utilities.compression import compress_data, COMPRESSION_EXTENSIONS
+from waclient.utilities.sensor_data import encode_sensor_data, SENSOR_DATA_EXTENSION
+from wacryptolib.utilities import synchronized, check_datetime_is_tz_aware
+
+SENSOR_DATA_ENCODINGS = ("json", "binary")
+
+
+class AdjustableDurationMixin:
+    """
+    Mixin for time-limited aggregators, whose max duration can be changed after instantiation
+    (it applies to the current aggregation too).
+    """
+
+    @synchronized
+    def set_max_duration(self, max_duration_s):
+        self._max_duration_s = max_duration_s
+
+
+class AdjustableJsonDataAggregator(AdjustableDurationMixin, JsonDataAggregator):
+    """JsonDataAggregator whose max duration can be changed after instantiation."""
+
+
+class SpoolingTarfileRecordsAggregator(AdjustableDurationMixin, TarfileRecordsAggregator):
+    """
+    Tarfile aggregator which builds its archive in a spooled temporary file, so that
+    memory usage stays bounded whatever the duration of the container.
+
+    The archive remains in RAM until it exceeds `max_memory_size` bytes, then it is rolled over
+    to an anonymous temporary file in `spool_dir`. If `max_memory_size` is 0 or None, the archive
+    is kept in memory, like in the parent class.
+
+    Completed archives are handed to the container storage as file-like streams, so
+    this storage must support them (see `RecordingContainerStorage`).
+
+    Records can also be added from existing files, which get streamed into the archive chunk by chunk.
+
+    `member_compression` maps sensor names to the compression codec (see `waclient.utilities.compression`)
+    applied to their in-memory records, whose extension then gets the suffix of the codec.
+    Records added from files (e.g. already compressed audio) are never compressed.
+
+    If `queue_size` is set, in-memory records go through a BoundedQueueWorker with this `overflow_policy`,
+    so that data aggregators aren't stalled by compression and archiving. Records added from files
+    stay synchronous, since their temporary files are only valid during the call.
+    """
+
+    _records_queue = None
+
+    def __init__(
+        self,
+        container_storage,
+        max_duration_s,
+        spool_dir,
+        max_memory_size=None,
+        member_compression=None,
+        queue_size=None,
+        overflow_policy="block",
+    ):
+        super().__init__(container_storage=container_storage, max_duration_s=max_duration_s)
+        self._spool_dir = spool_dir
+        self._max_memory_size = max_memory_size
+        self._member_compression = member_compression or {}
+        if queue_size:
+            self._records_queue = BoundedQueueWorker(
+                name="records",
+                consumer=self._consume_queued_record,
+                max_size=queue_size,
+                overflow_policy=overflow_policy,
+            )
+
+    @property
+    def queue_stats(self):
+        """Statistics of the records queue, or None if records are added synchronously."""
+        return self._records_queue.get_stats() if self._records_queue is not None else None
+
+    def _create_archive_stream(self):
+        if not self._max_memory_size:
+            return io.BytesIO()
+        return tempfile.SpooledTemporaryFile(
+            max_size=self._max_memory_size, prefix="tarfile_aggregator_", dir=str(self._spool_dir)
+        )
+
+    def _notify_aggregation_operation(self):
+        # Full override of parent method, which always builds its archive in a BytesIO
+        TimeLimitedAggregatorMixin._notify_aggregation_operation(self)
+        if not self._current_tarfile:
+            assert not self._current_bytesio, repr(self._current_bytesio)
+            assert not self._current_metadata, repr(self._current_metadata)
+            assert not self._current_records_count, self._current_records_count
+            self._current_bytesio = self._create_archive_stream()
+            self._current_tarfile = tarfile.open(
+                mode=self.tarfile_writing_mode, fileobj=self._current_bytesio
+            )
+            self._current_metadata = {"members": {}}
+
+    def _flush_aggregated_data(self):
+        # Full override of parent method, which copies the whole archive as a bytestring
+
+        if not self._current_start_time:
+            assert not self._current_records_count
+            return
+
+        assert self._current_tarfile  # Since start time is only set on new aggregation...
+        self._current_tarfile.close()  # Doesn't close the underlying stream
+        archive_stream = self._current_bytesio
+        archive_stream.seek(0)
+
+        end_time = datetime.now(tz=timezone.utc)
+        filename_base = self._build_tarfile_filename(
+            from_datetime=self._current_start_time, to_datetime=end_time
+        )
+        self._container_storage.enqueue_file_for_encryption(
+            filename_base=filename_base, data=archive_stream, metadata=self._current_metadata
+        )
+
+        self._current_tarfile = None
+        self._current_bytesio = None
+        self._current_metadata = None
+        self._current_records_count = 0
+
+        TimeLimitedAggregatorMixin._flush_aggregated_data(self)
+
+    def _do_add_record(self, sensor_name, from_datetime, to_datetime, extension, data):
+        codec = self._member_compression.get(sensor_name, "none")
+        if codec != "none":
+            data = compress_data(data, codec=codec)  # Done outside of the lock
+            extension += COMPRESSION_EXTENSIONS[codec]
+        self._archive_record(
+            sensor_name=sensor_name, from_datetime=from_datetime, to_datetime=to_datetime, extension=extension, data=data
+        )
+
+    def _archive_record(self, sensor_name, from_datetime, to_datetime, extension, data):
+        """Write an in-memory record (already compressed if needed) into the current archive."""
+        super().add_record(
+            sensor_name=sensor_name, from_datetime=from_datetime, to_datetime=to_datetime, extension=extension, data=data
+        )
+
+    def _consume_queued_record(self, record_kwargs):
+        self._do_add_record(**record_kwargs)
+
+    def get_pending_record_filepaths(self) -> set:
+        """Return the paths of files given to `add_record_from_file()`, which are not in the archive yet."""
+        return set()  # Such records are archived synchronously
+
+    def add_record(self, sensor_name: str, from_datetime: datetime, to_datetime: datetime, extension: str, data: bytes):
+        record_kwargs = dict(
+            sensor_name=sensor_name, from_datetime=from_datetime, to_datetime=to_datetime, extension=extension, data=data
+        )
+        if self._records_queue is not None:
+            self._records_queue.put(record_kwargs)
+        else:
+            self._do_add_record(**record_kwargs)
+
+    def finalize_tarfile(self):
+        if self._records_queue is not None:
+            self._records_queue.wait_until_empty()  # Queued records belong to current tarfile
+        super().finalize_tarfile()
+
+    @synchronized
+    def add_record_from_file(
+        self, sensor_name: str, from_datetime: datetime, to_datetime: datetime, extension: str, filepath: Path
+    ):
+        """Same as `add_record()`, but data is read from a file, without loading it fully in memory.
+
+        The aggregator takes ownership of the file, which is deleted once its content is in the archive.
+        """
+        assert self._current_records_count or not self._current_start_time  # INVARIANT of our system!
+        assert extension.startswith("."), extension
+        assert from_datetime <= to_datetime, (from_datetime, to_datetime)
+        check_datetime_is_tz_aware(from_datetime)
+        check_datetime_is_tz_aware(to_datetime)
+
+        record_file = open(filepath, "rb")
+        try:
+            with record_file:
+
+                self._notify_aggregation_operation()
+
+                filename = self._build_record_filename(
+                    sensor_name=sensor_name, from_datetime=from_datetime, to_datetime=to_datetime, extension=extension
+                )
+                logger.info("Adding record %r to tarfile builder, from file %s" % (filename, filepath.name))
+
+                size = os.fstat(record_file.fileno()).st_size
+
+                member_metadata = dict(size=size, mtime=to_datetime)
+                self._current_metadata["members"][filename] = member_metadata  # Overridden if existing
+
+                tarinfo = tarfile.TarInfo(filename)
+                tarinfo.size = size
+                tarinfo.mtime = to_datetime.timestamp()
+                self._current_tarfile.addfile(tarinfo, record_file)  # Chunked copy
+
+                self._current_records_count += 1
+        finally:
+            filepath.unlink()  # Immediate cleanup, even on error
+
+
+class PreEventTarfileRecordsAggregator(SpoolingTarfileRecordsAggregator):
+    """
+    Tarfile aggregator which, outside of events, keeps records in a rolling window instead of archiving them.
+
+    For each sensor, the window keeps the records which ended less than `pre_event_duration_s` seconds ago;
+    the in-memory ones are also bounded by `max_window_memory_size` bytes overall (oldest first evicted).
+    Records added from files stay on disk while they're in the window, and are deleted on eviction.
+
+    When `mark_event()` is called, the window is moved to the archive, and new records are archived
+    too, until `post_event_duration_s` seconds have elapsed since the latest event (so overlapping events
+    are merged). The archive is then handed to the container storage like in the parent class,
+    and buffering resumes.
+
+    `finalize_tarfile()` seals the ongoing event (if any), and discards the rolling window.
+    """
+
+    def __init__(self, *args, pre_event_duration_s, post_event_duration_s=0, max_window_memory_size=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        assert pre_event_duration_s >= 0 and post_event_duration_s >= 0, (pre_event_duration_s, post_event_duration_s)
+        self._pre_event_duration_s = pre_event_duration_s
+        self._post_event_duration_s = post_event_duration_s
+        self._max_window_memory_size = max_window_memory_size
+        self._lock = threading.RLock()  # Held while sealing the window, around synchronized parent methods
+        self._window_lock = threading.Lock()
+        self._windows = {}  # Sensor name => deque of record dicts, oldest first
+        self._unsealed_window_records = []  # Popped by an event, but not archived yet
+        self._window_memory_size = 0
+        self._event_end_time = None  # Monotonic time, only set during an event
+        self._events_count = 0
+        self._evicted_count = 0
+
+    @property
+    def window_stats(self):
+        with self._window_lock:
+            return dict(
+                records_count=sum(len(window) for window in self._windows.values()),
+                memory_size=self._window_memory_size,
+                evicted_count=self._evicted_count,
+                events_count=self._events_count,
+                is_event_ongoing=self._event_end_time is not None,
+            )
+
+    @staticmethod
+    def _get_record_memory_size(record):
+        return len(record["data"]) if "data" in record else 0
+
+    @staticmethod
+    def _discard_records(records):
+        for record in records:
+            if "filepath" in record:
+                try:
+                    record["filepath"].unlink()  # TODO use missing_ok=True later
+                except FileNotFoundError:
+                    pass
+
+    def _pop_window_records(self):
+        records = [record for window in self._windows.values() for record in window]
+        self._windows = {}
+        self._window_memory_size = 0
+        return sorted(records, key=lambda record: record["from_datetime"])
+
+    def _evict_window_records(self):
+        """Remove and return the records which are outdated, or which exceed the memory bounds of the window."""
+        evicted_records = []
+
+        def _evict_oldest_record(window):
+            record = window.popleft()
+            self._window_memory_size -= self._get_record_memory_size(record)
+            evicted_records.append(record)
+
+        limit_datetime = datetime.now(tz=timezone.utc) - timedelta(seconds=self._pre_event_duration_s)
+        for window in self._windows.values():
+            while window and window[0]["to_datetime"] < limit_datetime:
+                _evict_oldest_record(window)
+
+        if self._max_window_memory_size:
+            while self._window_memory_size > self._max_window_memory_size:
+                oldest_window = min(
+                    (window for window in self._windows.values() if window),
+                    key=lambda window: window[0]["from_datetime"],
+                )
+                _evict_oldest_record(oldest_window)
+
+        self._evicted_count += len(evicted_records)
+        return evicted_records
+
+    def _buffer_record(self, record) -> bool:
+        """Add the record to the rolling window, and return True, unless an event is ongoing."""
+        with self._window_lock:
+            if self._event_end_time is not None:
+                return False
+            self._windows.setdefault(record["sensor_name"], deque()).append(record)
+            self._window_memory_size += self._get_record_memory_size(record)
+            evicted_records = self._evict_window_records()
+        self._discard_records(evicted_records)
+        return True
+
+    def _archive_record(self, **record_kwargs):
+        if not self._buffer_record(record_kwargs):
+            super()._archive_record(**record_kwargs)
+
+    def add_record_from_file(self, **record_kwargs):
+        if not self._buffer_record(record_kwargs):
+            super().add_record_from_file(**record_kwargs)
+
+    def get_pending_record_filepaths(self) -> set:
+        with self._window_lock:
+            records = list(self._unsealed_window_records)
+            records.extend(record for window in self._windows.values() for record in window)
+        return set(record["filepath"] for record in records if "filepath" in record)
+
+    def _archive_window_record(self, record):
+        if "filepath" in record:
+            super().add_record_from_file(**record)
+        else:
+            super()._archive_record(**record)
+
+    def _archive_unsealed_window_records(self):
+        """Archive the window records popped by an event, if not done yet. Must be called with `_lock` held."""
+        with self._window_lock:
+            window_records, self._unsealed_window_records = self._unsealed_window_records, []
+        for record in window_records:
+            try:
+                self._archive_window_record(record)
+            except Exception as exc:
+                logger.error("Error when archiving record of rolling window: %r", exc, exc_info=True)
+
+    def mark_event(self):
+        """Seal the rolling window, and the records of the next `post_event_duration_s` seconds, into a container."""
+        with self._window_lock:
+            is_new_event = self._event_end_time is None
+            self._event_end_time = time.monotonic() + self._post_event_duration_s
+            self._events_count += 1
+            if is_new_event:
+                self._unsealed_window_records.extend(self._pop_window_records())
+                window_records_count = len(self._unsealed_window_records)
+
+        if not is_new_event:
+            logger.debug("Extending ongoing event of tarfile aggregator")
+            return
+
+        logger.info("Event marked, sealing %d records of rolling window", window_records_count)
+        threading.Thread(
+            target=self._offloaded_seal_event, name="pre_event_sealer", daemon=True
+        ).start()  # Caller (e.g. a sensor) mustn't wait for archiving
+
+    def _offloaded_seal_event(self):
+        # The whole window lands in the current archive, before post-event records and any finalization
+        with self._lock:
+            self._archive_unsealed_window_records()
+
+        while True:
+            with self._window_lock:
+                if self._event_end_time is None:
+                    return  # Event already sealed by finalize_tarfile()
+                remaining_s = self._event_end_time - time.monotonic()
+                if remaining_s <= 0:
+                    self._event_end_time = None  # Next records go to the rolling window
+                    break
+            time.sleep(remaining_s)  # Event might have been extended meanwhile
+
+        logger.info("End of event, sealing tarfile aggregator")
+        try:
+            SpoolingTarfileRecordsAggregator.finalize_tarfile(self)
+        except Exception as exc:
+            logger.error("Error when sealing event of tarfile aggregator: %r", exc, exc_info=True)
+
+    def finalize_tarfile(self):
+        if self._records_queue is not None:
+            self._records_queue.wait_until_empty()  # Queued records might belong to ongoing event
+        with self._window_lock:
+            self._event_end_time = None
+            window_records = self._pop_window_records()
+        self._discard_records(window_records)
+        with self._lock:
+            self._archive_unsealed_window_records()  # In case the sealer thread didn't get the lock yet
+        super().finalize_tarfile()
+
+
+class ColumnarDataAggregator(AdjustableDurationMixin, TimeLimitedAggregatorMixin):
+    """
+    Alternative to JsonDataAggregator, for sensors which always push the same numeric fields.
+
+    Each field is stored in a compact array of doubles, along with a column of epoch timestamps,
+    instead of a list of dicts, so frequent polling doesn't create lots of small objects.
+    On flush, columns are serialized in one pass, as a json mapping of each field name
+    (and "timestamp") to its list of values. Missing values are stored as NaN, and serialized as null.
+
+    With the "binary" `encoding`, columns are instead stored as fixed-point deltas (see
+    `waclient.utilities.sensor_data`), with the precision `1 / scale` given for each field
+    by `field_scales` (or `default_field_scale`). Timestamps are kept at millisecond precision.
+
+    If `queue_size` is set, values are timestamped then pushed to a BoundedQueueWorker with this
+    `overflow_policy`, so that sensor threads never wait for the aggregation and its flushes.
+
+    Public methods of this class are thread-safe.
+    """
+
+    TIMESTAMP_FIELD_NAME = "timestamp"
+    TIMESTAMP_SCALE = 1000
+
+    _tarfile_aggregator = None
+    _current_columns = None
+    _values_queue = None
+    _lock = None
+
+    def __init__(
+        self,
+        tarfile_aggregator: TarfileRecordsAggregator,
+        sensor_name: str,
+        max_duration_s: float,
+        field_names: Sequence,
+        encoding: str = "json",
+        field_scales: Optional[dict] = None,
+        default_field_scale: float = 10000,
+        queue_size: Optional[int] = None,
+        overflow_policy: str = "block",
+    ):
+        super().__init__(max_duration_s=max_duration_s)
+        assert isinstance(tarfile_aggregator, TarfileRecordsAggregator), tarfile_aggregator
+        assert field_names and self.TIMESTAMP_FIELD_NAME not in field_names, field_names
+        assert encoding in SENSOR_DATA_ENCODINGS, encoding
+        self._tarfile_aggregator = tarfile_aggregator
+        self._sensor_name = sensor_name
+        self._field_names = tuple(field_names)
+        self._encoding = encoding
+        field_scales = field_scales or {}
+        self._column_scales = {name: field_scales.get(name, default_field_scale) for name in self._field_names}
+        self._column_scales[self.TIMESTAMP_FIELD_NAME] = self.TIMESTAMP_SCALE
+        self._lock = threading.Lock()
+        if queue_size:
+            self._values_queue = BoundedQueueWorker(
+                name=sensor_name,
+                consumer=self._consume_queued_values,
+                max_size=queue_size,
+                overflow_policy=overflow_policy,
+            )
+
+    def __len__(self):
+        return len(self._current_columns[0]) if self._current_columns else 0
+
+    @property
+    def sensor_name(self):
+        return self._sensor_name
+
+    @property
+    def field_names(self):
+        return self._field_names
+
+    @property
+    def queue_stats(self):
+        """Statistics of the values queue, or None if values are aggregated synchronously."""
+        return self._values_queue.get_stats() if self._values_queue is not None else None
+
+    def _notify_aggregation_operation(self):
+        super()._notify_aggregation_operation()
+        if self._current_columns is None:
+            # First column is for timestamps
+            self._current_columns = [array("d") for _ in range(len(self._field_names) + 1)]
+
+    def _serialize_columns(self, columns) -> bytes:
+        column_names = (self.TIMESTAMP_FIELD_NAME,) + self._field_names
+        if self._encoding == "binary":
+            return encode_sensor_data(dict(zip(column_names, columns)), scales=self._column_scales)
+        dataset = {
+            name: [None if math.isnan(value) else value for value in column]  # Missing values become null
+            for (name, column) in zip(column_names, columns)
+        }
+        return json.dumps(dataset, separators=(",", ":"), allow_nan=False).encode("utf8")
+
+    def _flush_aggregated_data(self):
+        if not self._current_start_time:
+            assert not self._current_columns
+            return
+        end_time = datetime.now(tz=timezone.utc)
+        dataset_bytes = self._serialize_columns(self._current_columns)
+        self._tarfile_aggregator.add_record(
+            data=dataset_bytes,
+            sensor_name=self._sensor_name,
+            from_datetime=self._current_start_time,
+            to_datetime=end_time,
+            extension=SENSOR_DATA_EXTENSION if self._encoding == "binary" else ".json",
+        )
+        self._current_columns = None
+        super()._flush_aggregated_data()
+
+    @synchronized
+    def _do_add_values(self, values, timestamp):
+        assert self._current_columns or not self._current_start_time  # INVARIANT of our system!
+        self._notify_aggregation_operation()
+        timestamps_column, *value_columns = self._current_columns
+        timestamps_column.append(timestamp)
+        for column, value in zip(value_columns, values):
+            column.append(math.nan if value is None else value)
+
+    def _consume_queued_values(self, item):
+        values, timestamp = item
+        self._do_add_values(values, timestamp=timestamp)
+
+    def add_values(self, values: Sequence, timestamp: Optional[float] = None):
+        """
+        Flush current data to the tarfile if needed, and append `values` (ordered like `field_names`,
+        None meaning "missing") to the columns, along with `timestamp` (defaults to current epoch time).
+        """
+        assert len(values) == len(self._field_names), values
+        if timestamp is None:
+            timestamp = time.time()  # Not at dequeuing time
+        if self._values_queue is not None:
+            self._values_queue.put((values, timestamp))
+        else:
+            self._do_add_values(values, timestamp=timestamp)
+
+    def add_data(self, data_dict: dict):
+        """
+        Same as `add_values()`, but with a dict of values, for compatibility with JsonDataAggregator.
+
+        The timestamp may be provided in the dict, under the "timestamp" key.
+        """
+        self.add_values(
+            tuple(data_dict.get(field_name) for field_name in self._field_names),
+            timestamp=data_dict.get(self.TIMESTAMP_FIELD_NAME),
+        )
+
+    @synchronized
+    def _do_flush_dataset(self):
+        assert self._current_columns or not self._current_start_time  # INVARIANT of our system!
+        self._flush_aggregated_data()
+
+    def flush_dataset(self):
+        """
+        Force the flushing of current data to the tarfile (e.g. when terminating the service),
+        including queued values.
+        """
+        if self._values_queue is not None:
+            self._values_queue.wait_until_empty()
+        self._do_flush_dataset()
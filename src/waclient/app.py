@@ -3,6 +3,7 @@ import functools
 import logging
 import os
 import shutil
+from concurrent.futures.thread import ThreadPoolExecutor
 from os.path import join, dirname
 from pathlib import Path
 
@@ -30,16 +31,14 @@ from waclient.common_config import (
     SRC_ROOT_DIR, WIP_RECORDING_MARKER, 
     DEFAULT_REQUESTED_PERMISSIONS_MAPPER, 
     request_single_permission)
+from waclient.container_index import get_container_index
 from waclient.service_controller import ServiceController
 from waclient.utilities.logging import CallbackHandler
+from waclient.utilities.lru_cache import LruCache
 from waclient.utilities.misc import safe_catch_unhandled_exception
 from waclient.utilities.osc import get_osc_server
 # from waclient.utilities.i18n import Lang
-from wacryptolib.container import (
-    extract_metadata_from_container,
-    get_encryption_configuration_summary,
-)
-from wacryptolib.utilities import load_from_json_file
+from wacryptolib.container import get_encryption_configuration_summary
 
 
 
@@ -51,6 +50,9 @@ class A:  # TODO put back translation tooling
 
 tr = A()  # ("en")
 
+# Max count of container info texts kept in memory
+CONTAINER_INFO_CACHE_SIZE = 500
+
 
 osc, osc_starter_callback = get_osc_server(is_master=True)
 
@@ -73,6 +75,9 @@ class WitnessAngelClientApp(App):
 
     def __init__(self, **kwargs):
         self._unanswered_service_state_requests = 0  # Used to detect a service not responding anymore to status requests
+        self._container_info_cache = LruCache(max_size=CONTAINER_INFO_CACHE_SIZE)
+        self._container_info_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="container_info")
+        self._displayed_container_filepath = None
         print("STARTING INIT OF WitnessAngelClientApp")
         super(WitnessAngelClientApp, self).__init__(**kwargs)
         print("AFTER PARENT INIT OF WitnessAngelClientApp")
@@ -204,6 +209,7 @@ class WitnessAngelClientApp(App):
         closed).
         """
         atexit.unregister(self.on_stop)  # Not needed anymore
+        self._container_info_executor.shutdown(wait=False)
         if not self.get_daemonize_service():
             self.service_controller.stop_service()  # Will wait for termination, then kill it
 
@@ -257,6 +263,12 @@ class WitnessAngelClientApp(App):
             self.root.ids.recording_btn.state = expected_state
             self.root.ids.recording_btn.disabled = False
 
+    @osc.address_method("/receive_pipeline_stats")
+    @safe_catch_unhandled_exception
+    def receive_pipeline_stats(self, stats_json):
+        callback = functools.partial(self.log_output, "Recording pipeline statistics: %s" % stats_json)
+        Clock.schedule_once(callback)
+
     @staticmethod
     def get_nice_size(size):
         for unit in filesize_units:
@@ -265,63 +277,114 @@ class WitnessAngelClientApp(App):
             size /= 1024.0
         return size
 
-    def get_container_info(self, filepath):
+    def get_container_info(self, filepath, cache_key=None):
         """Return a text with info about the container algorithms and inner members metadata.
+
+        If `cache_key` is provided, a successfully computed text is memoized under it.
          """
         if not filepath:
             return "Please select a container"
 
         filename = os.path.basename(filepath)
         try:
-            container = load_from_json_file(filepath)
+            info = self._build_container_info(filepath)
+            if cache_key:
+                self._container_info_cache.set(cache_key, info)
+            return info
+        except FileNotFoundError:
+            return "This container was deleted"
+        except Exception as exc:
+            logging.error("Error when reading container %s: %r", filename, exc)
+            return "Container analysis failed"
 
-            info_lines = []
+    def _build_container_info(self, filepath):
+        filename = os.path.basename(filepath)
+        if not os.path.exists(filepath):
+            raise FileNotFoundError(filepath)
 
-            metadata = extract_metadata_from_container(container)
-            if not metadata:
-                info_lines.append(
-                    "No metadata found in container regarding inner files."
-                )
+        container_index = get_container_index()
+        entry = container_index.get_container_entry(filename)
+        if entry is None:  # E.g. service didn't synchronize index yet
+            container_index.index_container(Path(filepath))
+            entry = container_index.get_container_entry(filename)
 
-            info_lines.append("MEMBERS:")
-            for member_name, member_metadata in sorted(metadata["members"].items()):
-                # TODO later add more info
-                nice_size = self.get_nice_size(member_metadata["size"])
-                info_lines.append("- %s (%s)" % (member_name, nice_size))
+        info_lines = []
 
-            info_lines.append("")
+        if not entry["members"]:
+            info_lines.append(
+                "No metadata found in container regarding inner files."
+            )
 
-            info_lines.append("KEYCHAIN ID:")
-            info_lines.append(str(container.get("keychain_uid", "<not found>")))
+        info_lines.append("MEMBERS:")
+        for member_name, member_metadata in sorted(entry["members"].items()):
+            # TODO later add more info
+            nice_size = self.get_nice_size(member_metadata["size"])
+            info_lines.append("- %s (%s)" % (member_name, nice_size))
 
-            info_lines.append("")
+        info_lines.append("")
 
-            info_lines.append("ALGORITHMS:")
-            summary = get_encryption_configuration_summary(container)
-            info_lines.append(summary)
+        info_lines.append("KEYCHAIN ID:")
+        info_lines.append(entry["keychain_uid"] or "<not found>")
 
-            return "\n".join(info_lines)
+        info_lines.append("")
 
+        info_lines.append("ALGORITHMS:")
+        info_lines.append(entry["encryption_summary"])
+
+        return "\n".join(info_lines)
+
+    @staticmethod
+    def _get_container_info_cache_key(filepath):
+        stat = os.stat(filepath)
+        return (filepath, stat.st_mtime_ns, stat.st_size)
+
+    def display_container_info(self, filepath):
+        """Display info about a container, immediately if it's cached, else once a worker thread computed it."""
+        self._displayed_container_filepath = filepath
+        file_info = self.root.ids.file_info
+        try:
+            cache_key = self._get_container_info_cache_key(filepath) if filepath else None
         except FileNotFoundError:
-            return "This container was deleted"
-        except Exception as exc:
-            logging.error("Error when reading container %s: %r", filename, exc)
-            return "Container analysis failed"
+            cache_key = None
+        info = self._container_info_cache.get(cache_key) if cache_key else None
+        if info is None and cache_key:
+            file_info.text = "Loading container info..."
+            self._container_info_executor.submit(self._compute_container_info, filepath, cache_key)
+        else:
+            file_info.text = info or self.get_container_info(filepath)
+
+    @safe_catch_unhandled_exception
+    def _compute_container_info(self, filepath, cache_key):
+        info = self.get_container_info(filepath, cache_key=cache_key)
+        callback = functools.partial(self._on_container_info_computed, filepath, info)
+        Clock.schedule_once(callback)
+
+    def _on_container_info_computed(self, filepath, info, *args):
+        if filepath == self._displayed_container_filepath:  # Else selection changed in the meantime
+            self.root.ids.file_info.text = info
 
     def purge_all_containers(self):
-        """Delete all containers from internal storage."""
-        containers_dir = self.internal_containers_dir
-        logger.info("Purging all containers from %s", containers_dir)
-        for filename in os.listdir(containers_dir):
-            filepath = os.path.join(containers_dir, filename)
-            os.remove(filepath)
-        self.refresh_filebrowser()
+        """Ask the service to delete all containers from internal storage, by batches."""
+        self.root.ids.file_info.text = "Purging containers..."
+        self.service_controller.purge_all_containers()
+
+    @osc.address_method("/receive_purge_progress")
+    @safe_catch_unhandled_exception
+    def receive_purge_progress(self, deleted_count, total_count):
+        callback = functools.partial(self._on_purge_progress, deleted_count, total_count)
+        Clock.schedule_once(callback)
+
+    def _on_purge_progress(self, deleted_count, total_count, *args):
+        if deleted_count < 0:  # Purge is over
+            self._container_info_cache.clear()
+            self.root.ids.file_info.text = self.get_container_info(None)
+            self.log_output("Containers purge is over")
+        else:
+            self.root.ids.file_info.text = "Purging containers (%d/%d)..." % (deleted_count, total_count)
+        self.refresh_filebrowser()  # Cheap, since only the first page of containers gets stat-ed
 
     def refresh_filebrowser(self):
-        self.root.ids.filebrowser._update_files()
-        # TODO: test with latest Kivy, else open ticket regarding this part:
-        # "on_entries_cleared: treeview.root.nodes = []" not calling _trigger_layout()
-        self.root.ids.filebrowser.layout.ids.treeview._trigger_layout()  # TEMPORARY
+        self.root.ids.filebrowser.refresh()
 
     def attempt_container_decryption(self, filepath):
         assert isinstance(filepath, str), filepath  # OSCP doesn't handle Path instances
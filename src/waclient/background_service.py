@@ -1,10 +1,11 @@
 from pathlib import Path
 
 import io
+import json
 import logging
 import os
-import tarfile
 import threading
+import time
 from concurrent.futures.thread import ThreadPoolExecutor
 from configparser import Error as ConfigParserError
 
@@ -14,20 +15,27 @@ from kivy.logger import Logger as logger
 from oscpy.server import ServerClass
 from waclient.common_config import (
     APP_CONFIG_FILE,
+    INTERNAL_CONTAINERS_DIR,
     INTERNAL_KEYS_DIR,
     EXTERNAL_DATA_EXPORTS_DIR,
     get_encryption_conf,
     IS_ANDROID, WIP_RECORDING_MARKER, CONTEXT)
+from waclient.container_index import get_container_index
+from waclient.container_storage import RecordingContainerStorage
+from waclient.key_storage import MonitoredFilesystemKeyStoragePool
 from waclient.recording_toolchain import (
     build_recording_toolchain,
+    get_recording_toolchain_stats,
+    mark_recording_toolchain_event,
+    update_recording_toolchain,
     start_recording_toolchain,
     stop_recording_toolchain,
 )
 from waclient.utilities.logging import CallbackHandler
 from waclient.utilities.misc import safe_catch_unhandled_exception
 from waclient.utilities.osc import get_osc_server, get_osc_client
+from waclient.utilities.exports import export_tarfile_stream
 from wacryptolib.container import decrypt_data_from_container, load_container_from_filesystem
-from wacryptolib.key_storage import FilesystemKeyStorage, FilesystemKeyStoragePool
 from wacryptolib.utilities import load_from_json_file
 
 # os.environ["KIVY_NO_CONSOLELOG"] = "1"  # IMPORTANT
@@ -43,6 +51,9 @@ THREAD_POOL_EXECUTOR = ThreadPoolExecutor(
     max_workers=1, thread_name_prefix="service_worker"  # SINGLE worker for now, to avoid concurrency
 )
 
+# Time budget for flushing recordings on service shutdown, before Android might kill the process
+SERVICE_SHUTDOWN_TIMEOUT_S = 20
+
 if IS_ANDROID:
     from waclient.android_utils import preload_java_classes
     preload_java_classes()
@@ -61,7 +72,10 @@ class BackgroundServer(object):
 
     _sock = None
 
-    _recording_toolchain = None
+    _recording_toolchain = None  # Kept alive between recordings, and updated when config changes
+    _recording_toolchain_config_mtime = None
+
+    _last_start_latency_s = None  # Duration of the latest recording start, from request to running sensors
 
     _status_change_in_progress = False  # Set to True while recording is starting/stopping
 
@@ -73,7 +87,11 @@ class BackgroundServer(object):
             CallbackHandler(self._remote_logging_callback)
         )
         self._termination_event = threading.Event()
-        self._key_storage_pool = FilesystemKeyStoragePool(INTERNAL_KEYS_DIR)
+        self._key_storage_pool = MonitoredFilesystemKeyStoragePool(INTERNAL_KEYS_DIR)
+        # E.g. containers stored by a previous version, or lost by a brutal shutdown
+        threading.Thread(
+            target=self._offloaded_synchronize_container_index, name="container_index_sync", daemon=True
+        ).start()
         logger.info("Service started")
 
         # Initial setup of service according to persisted config
@@ -98,6 +116,10 @@ class BackgroundServer(object):
             )
             return
 
+    @safe_catch_unhandled_exception
+    def _offloaded_synchronize_container_index(self):
+        get_container_index().synchronize_with_directory(INTERNAL_CONTAINERS_DIR)
+
     def _offload_task(self, method, *args, **kwargs):
         return THREAD_POOL_EXECUTOR.submit(method, *args, **kwargs)
 
@@ -147,16 +169,12 @@ class BackgroundServer(object):
                 #logger.debug("Ignoring redundant call to service.start_recording()")
                 return
             logger.info("Starting recording")
-            if not self._recording_toolchain:
-                config = self._load_config()
-                self._recording_toolchain = build_recording_toolchain(
-                    config,
-                        key_storage_pool=self._key_storage_pool,
-                    encryption_conf=encryption_conf,
-                )
+            start_time = time.monotonic()
+            self._prepare_recording_toolchain(encryption_conf=encryption_conf)
             if self._recording_toolchain:  # Else we just let cancellation occur
                 start_recording_toolchain(self._recording_toolchain)
-                logger.info("Recording started")
+                self._last_start_latency_s = time.monotonic() - start_time
+                logger.info("Recording started (in %.3fs)", self._last_start_latency_s)
 
                 if IS_ANDROID:
                     from waclient.android_utils import build_notification_channel, build_notification
@@ -170,6 +188,27 @@ class BackgroundServer(object):
             self._status_change_in_progress = False
             self.broadcast_recording_state()  # Even on error
 
+    def _prepare_recording_toolchain(self, encryption_conf):
+        """Build the recording toolchain, or update the existing one if config file or encryption conf changed."""
+        config_mtime = os.path.getmtime(APP_CONFIG_FILE) if os.path.exists(APP_CONFIG_FILE) else None
+        toolchain = self._recording_toolchain
+        if (
+            toolchain
+            and config_mtime == self._recording_toolchain_config_mtime
+            and encryption_conf == toolchain["encryption_conf"]
+        ):
+            return  # Sensors can just be resumed
+        config = self._load_config()
+        if toolchain:
+            self._recording_toolchain = update_recording_toolchain(
+                toolchain, config, key_storage_pool=self._key_storage_pool, encryption_conf=encryption_conf
+            )
+        else:
+            self._recording_toolchain = build_recording_toolchain(
+                config, key_storage_pool=self._key_storage_pool, encryption_conf=encryption_conf
+            )
+        self._recording_toolchain_config_mtime = config_mtime
+
     @osc.address_method("/start_recording")
     @safe_catch_unhandled_exception
     def start_recording(self, env=None):
@@ -198,30 +237,50 @@ class BackgroundServer(object):
         self._send_message("/receive_recording_state", is_recording)
 
     @safe_catch_unhandled_exception
-    def _offloaded_stop_recording(self):
+    def _offloaded_stop_recording(self, timeout_s=None):
         try:
             if not self.is_recording:
                 #logger.debug("Ignoring redundant call to service.stop_recording()")
                 return
             logger.info("Stopping recording")
-            stop_recording_toolchain(self._recording_toolchain)
+            try:
+                report = stop_recording_toolchain(self._recording_toolchain, timeout_s=timeout_s)
+            except Exception:
+                self._recording_toolchain = None  # Will force a full rebuild on next recording
+                raise
+            if report["timed_out_stages"]:
+                self._recording_toolchain = None  # Some components might still be busy flushing
             logger.info("Recording stopped")
 
             if IS_ANDROID:
                 CONTEXT.stopForeground(True)  # Does remove notification
 
         finally:  # Trigger all this even if container flushing failed
-            self._recording_toolchain = (
-                None
-            )  # Will force a reload of config on next recording
             self._status_change_in_progress = False
             self.broadcast_recording_state()
 
+    @osc.address_method("/broadcast_pipeline_stats")
+    @safe_catch_unhandled_exception
+    def broadcast_pipeline_stats(self):
+        """Send to the app the statistics (queue depths, drops...) of the recording pipeline, as json."""
+        stats = get_recording_toolchain_stats(self._recording_toolchain) if self._recording_toolchain else {}
+        self._send_message("/receive_pipeline_stats", json.dumps(stats))
+
+    @osc.address_method("/mark_event")
+    @safe_catch_unhandled_exception
+    def mark_event(self):
+        """Seal the recent records into a container, when recording in pre-event mode."""
+        if not self.is_recording:
+            logger.warning("Ignoring event marked while not recording")
+            return
+        if not mark_recording_toolchain_event(self._recording_toolchain):
+            logger.info("Ignoring event marked in continuous recording mode")
+
     @osc.address_method("/stop_recording")
     @safe_catch_unhandled_exception
-    def stop_recording(self):
+    def stop_recording(self, timeout_s=None):
         self._status_change_in_progress = True
-        return self._offload_task(self._offloaded_stop_recording)
+        return self._offload_task(self._offloaded_stop_recording, timeout_s=timeout_s)
 
     @safe_catch_unhandled_exception
     def _offloaded_attempt_container_decryption(self, container_filepath):
@@ -236,15 +295,13 @@ class BackgroundServer(object):
         tarfile_bytes = decrypt_data_from_container(
             container, key_storage_pool=self._key_storage_pool
         )
-        tarfile_bytesio = io.BytesIO(tarfile_bytes)
-        tarfile_obj = tarfile.open(
-            mode="r", fileobj=tarfile_bytesio  # TODO add gzip support here one day
-        )
-        # Beware, as root on unix systems it would apply chown/chmod
-        tarfile_obj.extractall(target_directory)
+        del container  # Ciphertext must not linger in memory during extraction
+        # Members are streamed to disk, decompressed and made human-readable, without copying the plaintext
+        exported_filepaths = export_tarfile_stream(io.BytesIO(tarfile_bytes), target_directory=target_directory)
         logger.info(
-            "Container content was successfully decrypted into folder %s",
+            "Container content was successfully decrypted into folder %s (%d files)",
             target_directory,
+            len(exported_filepaths),
         )
 
     @osc.address_method("/attempt_container_decryption")
@@ -253,6 +310,35 @@ class BackgroundServer(object):
         container_filepath = Path(container_filepath)
         return self._offload_task(self._offloaded_attempt_container_decryption, container_filepath=container_filepath)
 
+    def _send_purge_progress(self, deleted_count, total_count):
+        self._send_message("/receive_purge_progress", deleted_count, total_count)
+
+    @safe_catch_unhandled_exception
+    def _offloaded_purge_all_containers(self):
+        logger.info("Purging all containers from %s", INTERNAL_CONTAINERS_DIR)
+        # Toolchain changes are offloaded to the same single worker, so its storage can't be replaced meanwhile
+        temporary_container_storage = None
+        if self._recording_toolchain:
+            container_storage = self._recording_toolchain["container_storage"]
+        else:
+            container_storage = temporary_container_storage = RecordingContainerStorage(
+                default_encryption_conf=None,
+                containers_dir=INTERNAL_CONTAINERS_DIR,
+                container_index=get_container_index(),
+            )
+        try:
+            deleted_count = container_storage.purge_all_containers(progress_callback=self._send_purge_progress)
+            logger.info("Purged %d containers", deleted_count)
+        finally:
+            if temporary_container_storage is not None:
+                temporary_container_storage.shutdown()
+            self._send_message("/receive_purge_progress", -1, -1)  # Special values for "purge over"
+
+    @osc.address_method("/purge_all_containers")
+    @safe_catch_unhandled_exception
+    def purge_all_containers(self):
+        return self._offload_task(self._offloaded_purge_all_containers)
+
     @osc.address_method("/stop_server")
     @safe_catch_unhandled_exception
     def stop_server(self):
@@ -262,7 +348,8 @@ class BackgroundServer(object):
             logger.info(
                 "Recording is in progress, we stop it as part of service shutdown"
             )
-            self.stop_recording().result(timeout=30)   # SYNCHRONOUS CALL (but through threadpool still)
+            # SYNCHRONOUS CALL (but through threadpool still), with some margin over the shutdown deadline
+            self.stop_recording(timeout_s=SERVICE_SHUTDOWN_TIMEOUT_S).result(timeout=SERVICE_SHUTDOWN_TIMEOUT_S + 10)
 
         osc.stop_all()
         self._termination_event.set()
@@ -19,7 +19,7 @@ DEFAULT_REQUESTED_PERMISSIONS_MAPPER = {
     # Gyroscope needs no permissions
     # "WRITE_EXTERNAL_STORAGE" => DELAYED PERMISSIONS
     "record_microphone": "RECORD_AUDIO",
-    # TODO "CAMERA",
+    "record_camera": "CAMERA",
     "record_gps": "ACCESS_FINE_LOCATION"
 }
 IS_ANDROID = (platform == "android")
@@ -81,6 +81,8 @@ INTERNAL_KEYS_DIR.mkdir(exist_ok=True)
 INTERNAL_CONTAINERS_DIR = INTERNAL_APP_ROOT / "Containers"
 INTERNAL_CONTAINERS_DIR.mkdir(exist_ok=True)
 
+CONTAINER_INDEX_FILE = INTERNAL_APP_ROOT / "container_index.sqlite"
+
 EXTERNAL_DATA_EXPORTS_DIR = _EXTERNAL_APP_ROOT / "DataExports"  # Might no exist yet (and require permissions!)
 
 
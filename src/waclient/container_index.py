@@ -0,0 +1,192 @@
+"""
+Persistent index of the metadata of stored containers, so that they can be listed and described
+without parsing their files (and their potentially huge ciphertexts).
+"""
+
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from kivy.logger import Logger as logger
+
+from waclient.common_config import CONTAINER_INDEX_FILE
+from waclient.utilities.container_header import load_container_header
+from wacryptolib.container import (
+    CONTAINER_SUFFIX,
+    OFFLOADED_DATA_SUFFIX,
+    extract_metadata_from_container,
+    get_encryption_configuration_summary,
+)
+
+_CONTAINER_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS containers (
+    container_name TEXT PRIMARY KEY,
+    keychain_uid TEXT,
+    members_json TEXT NOT NULL,
+    from_timestamp REAL,
+    to_timestamp REAL,
+    encryption_summary TEXT NOT NULL,
+    file_size INTEGER NOT NULL
+)
+"""
+
+_CONTAINER_ENTRY_FIELDS = (
+    "container_name",
+    "keychain_uid",
+    "members",
+    "from_timestamp",
+    "to_timestamp",
+    "encryption_summary",
+    "file_size",
+)
+
+
+def get_container_files_size(container_filepath: Path) -> int:
+    """Return the total size of the files of a container (including its offloaded ciphertext, if any)."""
+    file_size = container_filepath.stat().st_size
+    offloaded_filepath = container_filepath.parent.joinpath(container_filepath.name + OFFLOADED_DATA_SUFFIX)
+    if offloaded_filepath.exists():
+        file_size += offloaded_filepath.stat().st_size
+    return file_size
+
+
+def build_container_index_entry(container_filepath: Path, container: dict) -> dict:
+    """Return the index entry of a container, which must have been dumped to `container_filepath`.
+
+    The time range of the container is deduced from the timestamps of its members, if any.
+    """
+    metadata = extract_metadata_from_container(container) or {}
+    members = {
+        member_name: dict(size=member_metadata.get("size"))
+        for member_name, member_metadata in metadata.get("members", {}).items()
+    }
+    member_timestamps = [
+        member_metadata["mtime"].timestamp()
+        for member_metadata in metadata.get("members", {}).values()
+        if isinstance(member_metadata.get("mtime"), datetime)
+    ]
+    keychain_uid = container.get("keychain_uid")
+    return dict(
+        container_name=container_filepath.name,
+        keychain_uid=str(keychain_uid) if keychain_uid else None,
+        members=members,
+        from_timestamp=min(member_timestamps, default=None),
+        to_timestamp=max(member_timestamps, default=None),
+        encryption_summary=get_encryption_configuration_summary(container),
+        file_size=get_container_files_size(container_filepath),
+    )
+
+
+_process_container_index = None
+_process_container_index_lock = threading.Lock()
+
+
+def get_container_index():
+    """Return the ContainerIndex of internal containers, shared by the whole process (but not by forks)."""
+    global _process_container_index
+    with _process_container_index_lock:
+        if _process_container_index is None:
+            _process_container_index = ContainerIndex(CONTAINER_INDEX_FILE)
+        return _process_container_index
+
+
+class ContainerIndex:
+    """
+    SQLite-backed index of container metadata (keychain uid, members, time range, encryption summary, size).
+
+    Entries are meant to be written by the recording service, when containers are stored or deleted,
+    and read by the app. Several processes can safely share the same database file.
+
+    Public methods of this class are thread-safe.
+    """
+
+    def __init__(self, index_filepath: Path):
+        self._index_filepath = index_filepath
+        self._lock = threading.Lock()
+        # Autocommit mode, since each operation is a transaction of its own
+        self._connection = sqlite3.connect(
+            str(index_filepath), timeout=10, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")  # Readers don't block the writer
+        self._connection.execute(_CONTAINER_INDEX_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    @staticmethod
+    def _row_to_entry(row):
+        entry = dict(zip(_CONTAINER_ENTRY_FIELDS, row))
+        entry["members"] = json.loads(entry["members"])
+        return entry
+
+    def add_container_entry(self, entry: dict):
+        """Insert or replace the entry of a container (see `build_container_index_entry()`)."""
+        values = dict(entry, members=json.dumps(entry["members"]))
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO containers VALUES (%s)" % ", ".join("?" * len(_CONTAINER_ENTRY_FIELDS)),
+                [values[field] for field in _CONTAINER_ENTRY_FIELDS],
+            )
+
+    def index_container(self, container_filepath: Path, container: Optional[dict] = None):
+        """Index a container from its file, whose header is only parsed if `container` isn't provided."""
+        if container is None:
+            container = load_container_header(container_filepath)
+        self.add_container_entry(build_container_index_entry(container_filepath, container=container))
+
+    def remove_container_entry(self, container_name: str):
+        with self._lock:
+            self._connection.execute("DELETE FROM containers WHERE container_name = ?", (container_name,))
+
+    def get_container_entry(self, container_name: str) -> Optional[dict]:
+        """Return the entry of a container, or None if it's not indexed."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT * FROM containers WHERE container_name = ?", (container_name,)
+            ).fetchone()
+        return self._row_to_entry(row) if row else None
+
+    def list_container_names(self) -> list:
+        """Return the names of indexed containers, sorted like ContainerStorage does (i.e. oldest first)."""
+        with self._lock:
+            rows = self._connection.execute("SELECT container_name FROM containers ORDER BY container_name").fetchall()
+        return [row[0] for row in rows]
+
+    def list_container_entries(self) -> list:
+        with self._lock:
+            rows = self._connection.execute("SELECT * FROM containers ORDER BY container_name").fetchall()
+        return [self._row_to_entry(row) for row in rows]
+
+    def synchronize_with_directory(self, containers_dir: Path):
+        """Index the containers of `containers_dir` which are missing from index, and forget vanished ones.
+
+        Returns the counts of added and removed entries.
+        """
+        existing_container_names = set(
+            filepath.name for filepath in containers_dir.glob("*" + CONTAINER_SUFFIX)
+        )
+        indexed_container_names = set(self.list_container_names())
+
+        added_count = 0
+        for container_name in sorted(existing_container_names - indexed_container_names):
+            try:
+                self.index_container(containers_dir.joinpath(container_name))
+                added_count += 1
+            except Exception as exc:
+                logger.warning("Could not index container %s: %r", container_name, exc)
+
+        vanished_container_names = indexed_container_names - existing_container_names
+        for container_name in vanished_container_names:
+            self.remove_container_entry(container_name)
+
+        if added_count or vanished_container_names:
+            logger.info(
+                "Container index synchronized (%d entries added, %d removed)",
+                added_count,
+                len(vanished_container_names),
+            )
+        return dict(added_count=added_count, removed_count=len(vanished_container_names))
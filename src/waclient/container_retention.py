@@ -0,0 +1,126 @@
+"""
+Retention of stored containers depending on their total size, their age, and the free disk space,
+on top of the max count of containers enforced by ContainerStorage.
+"""
+
+import heapq
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from wacryptolib.container import CONTAINER_SUFFIX, OFFLOADED_DATA_SUFFIX
+
+# Max count of containers evicted per retention check, so that each check stays short
+RETENTION_EVICTION_BATCH_SIZE = 20
+
+
+class ContainerRetentionPolicy:
+    """
+    Tracker of stored containers, which selects those to evict when a retention limit is exceeded:
+    `max_total_bytes` (size of all containers), `max_age_s`, or `min_free_disk_bytes` (on the
+    containers partition). Each limit is disabled if None or 0, and can be changed at any time.
+
+    Containers are kept in a heap ordered by name (i.e. oldest first, like ContainerStorage sorts them),
+    so that registering or evicting a container costs O(log n), and the containers directory only gets
+    scanned once, on first use. Containers deleted by other means are lazily dropped from the heap.
+
+    Public methods of this class are thread-safe.
+    """
+
+    def __init__(self, containers_dir: Path, max_total_bytes=None, max_age_s=None, min_free_disk_bytes=None):
+        self._containers_dir = Path(containers_dir)
+        self.max_total_bytes = max_total_bytes
+        self.max_age_s = max_age_s
+        self.min_free_disk_bytes = min_free_disk_bytes
+        self._lock = threading.Lock()
+        self._is_loaded = False
+        self._heap = []  # Container names, possibly including deleted or duplicated ones
+        self._containers = {}  # Container name -> (size, mtime)
+        self._total_bytes = 0
+        self._evicted_count = 0
+        self._reclaimed_bytes = 0
+
+    def _add_container(self, container_name, size, mtime):
+        self._remove_container(container_name)
+        self._containers[container_name] = (size, mtime)
+        self._total_bytes += size
+        heapq.heappush(self._heap, container_name)
+
+    def _remove_container(self, container_name):
+        container_info = self._containers.pop(container_name, None)
+        if container_info:
+            self._total_bytes -= container_info[0]
+        return container_info
+
+    def _ensure_loaded(self):
+        if self._is_loaded:
+            return
+        with os.scandir(self._containers_dir) as dir_entries:
+            file_stats = {dir_entry.name: dir_entry.stat() for dir_entry in dir_entries if dir_entry.is_file()}
+        for filename, file_stat in file_stats.items():
+            if filename.endswith(CONTAINER_SUFFIX):
+                offloaded_file_stat = file_stats.get(filename + OFFLOADED_DATA_SUFFIX)
+                size = file_stat.st_size + (offloaded_file_stat.st_size if offloaded_file_stat else 0)
+                self._add_container(filename, size=size, mtime=file_stat.st_mtime)
+        self._is_loaded = True
+
+    def add_container(self, container_name: str, size: int, mtime=None):
+        """Register a newly stored container (including its offloaded ciphertext in `size`)."""
+        with self._lock:
+            self._ensure_loaded()
+            self._add_container(container_name, size=size, mtime=time.time() if mtime is None else mtime)
+
+    def remove_container(self, container_name: str):
+        """Unregister a container deleted by other means than eviction (e.g. container rotation)."""
+        with self._lock:
+            if self._is_loaded:  # Else container will just not be found on disk
+                self._remove_container(container_name)
+
+    def _is_limit_exceeded(self, oldest_mtime, free_disk_bytes, now):
+        if self.max_total_bytes and self._total_bytes > self.max_total_bytes:
+            return True
+        if self.max_age_s and now - oldest_mtime > self.max_age_s:
+            return True
+        if self.min_free_disk_bytes and free_disk_bytes < self.min_free_disk_bytes:
+            return True
+        return False
+
+    def pop_containers_to_evict(self, max_count=RETENTION_EVICTION_BATCH_SIZE, now=None) -> list:
+        """Unregister and return the names of the oldest containers which must be deleted (at most `max_count`).
+
+        Eviction counters are updated as if these containers were deleted.
+        """
+        now = time.time() if now is None else now
+        free_disk_bytes = shutil.disk_usage(str(self._containers_dir)).free if self.min_free_disk_bytes else None
+        container_names = []
+        with self._lock:
+            self._ensure_loaded()
+            while self._heap and len(container_names) < max_count:
+                container_name = self._heap[0]
+                container_info = self._containers.get(container_name)
+                if container_info is None:
+                    heapq.heappop(self._heap)  # Already deleted
+                    continue
+                size, mtime = container_info
+                if not self._is_limit_exceeded(oldest_mtime=mtime, free_disk_bytes=free_disk_bytes, now=now):
+                    break
+                heapq.heappop(self._heap)
+                self._remove_container(container_name)
+                if free_disk_bytes is not None:
+                    free_disk_bytes += size
+                self._evicted_count += 1
+                self._reclaimed_bytes += size
+                container_names.append(container_name)
+        return container_names
+
+    def get_stats(self):
+        """Return the count and total size of tracked containers, and the eviction counters."""
+        with self._lock:
+            return dict(
+                containers_count=len(self._containers) if self._is_loaded else None,
+                total_bytes=self._total_bytes if self._is_loaded else None,
+                evicted_count=self._evicted_count,
+                reclaimed_bytes=self._reclaimed_bytes,
+            )
@@ -0,0 +1,415 @@
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from kivy.logger import Logger as logger
+
+from waclient.container_index import build_container_index_entry
+from waclient.utilities.bounded_queue import BoundedQueueWorker
+from wacryptolib.container import (
+    ContainerStorage,
+    CONTAINER_SUFFIX,
+    LOCAL_ESCROW_MARKER,
+    OFFLOADED_DATA_SUFFIX,
+    encrypt_data_into_container,
+    dump_container_to_filesystem,
+)
+from wacryptolib.escrow import EscrowApi
+from wacryptolib.utilities import catch_and_log_exception, generate_uuid0, synchronized
+
+ENCRYPTION_BACKENDS = ("thread", "process")
+
+HANDOVER_FILE_PREFIX = "container_plaintext_"
+
+# Count of containers deleted per acquisition of the storage lock, when purging
+PURGE_BATCH_SIZE = 50
+
+
+def _read_data_stream(data):
+    """Return the content of a file-like object, and close it (which deletes spooled temporary files)."""
+    with data:
+        data.seek(0)
+        return data.read()
+
+
+def _dump_data_to_handover_file(data, handover_dir) -> Path:
+    """Write a bytestring or file-like object (then closed) to a new file, meant to be consumed by another process."""
+    with tempfile.NamedTemporaryFile(dir=str(handover_dir), prefix=HANDOVER_FILE_PREFIX, delete=False) as handover_file:
+        if isinstance(data, bytes):
+            handover_file.write(data)
+        else:
+            with data:
+                data.seek(0)
+                shutil.copyfileobj(data, handover_file)  # Chunked copy
+    return Path(handover_file.name)
+
+
+@catch_and_log_exception
+def encrypt_data_and_dump_container(
+    container_filepath, data, metadata, keychain_uid, encryption_conf, key_storage_pool, offload_data_ciphertext
+):
+    """Task to be run by a thread or process worker, which encrypts a payload into a disk container.
+
+    `data` may be a bytestring, a readable file-like object which gets closed afterwards, or
+    the Path of a handover file which gets deleted afterwards.
+
+    Returns the container basename, the duration of the encryption (in seconds), and the
+    index entry of the container (see `build_container_index_entry()`).
+    """
+    start_time = time.monotonic()
+
+    if isinstance(data, Path):
+        data_path = data
+        data = data_path.read_bytes()
+        data_path.unlink()  # Immediate safety, plaintext must not linger on disk
+    elif not isinstance(data, bytes):
+        data = _read_data_stream(data)
+
+    container = encrypt_data_into_container(
+        data=data,
+        conf=encryption_conf,
+        metadata=metadata,
+        keychain_uid=keychain_uid,
+        key_storage_pool=key_storage_pool,
+    )
+    dump_container_to_filesystem(
+        container_filepath, container=container, offload_data_ciphertext=offload_data_ciphertext
+    )
+
+    encryption_duration_s = time.monotonic() - start_time
+    logger.info(
+        "File %r successfully encrypted into storage container (%.2fs)",
+        container_filepath.name,
+        encryption_duration_s,
+    )
+    index_entry = build_container_index_entry(container_filepath, container=container)
+    return container_filepath.name, encryption_duration_s, index_entry
+
+
+class RecordingContainerStorage(ContainerStorage):
+    """
+    Container storage used by the recording toolchain.
+
+    Encryption is done by a pool of `max_workers` workers, which are threads or processes depending
+    on `executor_backend`. Statistics about queue depth and encryption latency are available
+    via `get_encryption_stats()`.
+
+    Besides bytestrings, it accepts readable file-like objects (e.g. spooled tarfiles) as data to encrypt:
+    with the thread backend, these are only read when a worker actually processes them.
+
+    The process backend keeps CPU-bound cryptography (AES, RSA, signatures, prehashing) away from the GIL
+    of the service process, and thus from sensor threads. There, plaintexts are handed over to
+    child processes as files in `handover_dir`, instead of pickled bytestrings.
+
+    If `queue_size` is set, containers waiting for a free worker are held in a BoundedQueueWorker
+    with this `overflow_policy`, instead of piling up in the executor (beware, dropping
+    means losing whole containers).
+
+    If a `container_index` is provided, it gets updated whenever a container is stored or deleted.
+
+    If a `retention_policy` (ContainerRetentionPolicy) is provided, it tracks stored containers, and
+    `enforce_retention()` deletes those it selects for eviction.
+
+    Containers being encrypted are tracked, so that they can't be purged while they are written.
+    """
+
+    _encryption_queue = None
+
+    _latency_history_size = 50
+
+    def __init__(
+        self,
+        *args,
+        executor_backend="thread",
+        max_workers=1,
+        handover_dir=None,
+        queue_size=None,
+        overflow_policy="block",
+        container_index=None,
+        retention_policy=None,
+        **kwargs
+    ):
+        assert executor_backend in ENCRYPTION_BACKENDS, executor_backend
+        super().__init__(*args, max_workers=max_workers, **kwargs)
+        self._executor_backend = executor_backend
+        self._max_workers = max_workers
+        self._container_index = container_index
+        self._retention_policy = retention_policy
+        if executor_backend == "process":
+            assert self._key_storage_pool is not None  # In-memory keys would be lost with child processes
+            assert handover_dir, handover_dir
+            self._handover_dir = Path(handover_dir)
+            self._purge_handover_files()
+            # Replaces the thread pool of parent class, "spawn" avoids forking a multithreaded process
+            self._thread_pool_executor.shutdown(wait=False)
+            self._thread_pool_executor = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        self._stats_lock = threading.Lock()
+        self._queued_count = 0
+        self._processed_count = 0
+        self._failed_count = 0
+        self._latencies_s = deque(maxlen=self._latency_history_size)
+        self._pending_container_names = set()
+        self._encryption_durations_s = deque(maxlen=self._latency_history_size)
+        if queue_size:
+            self._free_workers_semaphore = threading.Semaphore(max_workers)
+            self._encryption_queue = BoundedQueueWorker(
+                name="encryption",
+                consumer=self._consume_queued_encryption_task,
+                max_size=queue_size,
+                overflow_policy=overflow_policy,
+                on_drop=self._discard_encryption_task,
+            )
+
+    def set_max_containers_count(self, max_containers_count):
+        """Change the count of containers above which oldest ones get purged."""
+        self._max_containers_count = max_containers_count
+
+    def _purge_handover_files(self):
+        """Remove plaintexts left by a previous brutal shutdown of the service."""
+        for handover_file in self._handover_dir.glob(HANDOVER_FILE_PREFIX + "*"):
+            logger.warning("Deleting orphaned plaintext handover file %s", handover_file.name)
+            handover_file.unlink()
+
+    def _ensure_local_keypairs_exist(self, keychain_uid, encryption_conf):
+        """Attach or generate, in current process, the local keypairs needed by this encryption conf.
+
+        Child processes can then simply read them, since the free keys pool of a
+        FilesystemKeyStorage is not safe for multiprocessing."""
+        local_escrow_api = EscrowApi(self._key_storage_pool.get_local_key_storage())
+        for data_encryption_stratum in encryption_conf["data_encryption_strata"]:
+            for key_encryption_stratum in data_encryption_stratum["key_encryption_strata"]:
+                if key_encryption_stratum.get("key_escrow") == LOCAL_ESCROW_MARKER:
+                    local_escrow_api._ensure_keypair_exists(
+                        keychain_uid=key_encryption_stratum.get("keychain_uid") or keychain_uid,
+                        key_type=key_encryption_stratum["key_encryption_algo"],
+                    )
+            for signature_conf in data_encryption_stratum["data_signatures"]:
+                if signature_conf["signature_escrow"] == LOCAL_ESCROW_MARKER:
+                    local_escrow_api._ensure_keypair_exists(
+                        keychain_uid=signature_conf.get("keychain_uid") or keychain_uid,
+                        key_type=signature_conf["signature_algo"],
+                    )
+
+    def _on_encryption_done(self, future, enqueue_time, container_name):
+        with self._stats_lock:
+            self._pending_container_names.discard(container_name)
+        if self._encryption_queue is not None:
+            self._free_workers_semaphore.release()
+        latency_s = time.monotonic() - enqueue_time
+        # Result is None if an exception was caught and logged by worker
+        result = None if future.exception() else future.result()
+        with self._stats_lock:
+            self._queued_count -= 1
+            if result is None:
+                self._failed_count += 1
+                return
+            self._processed_count += 1
+            self._latencies_s.append(latency_s)
+            self._encryption_durations_s.append(result[1])
+        if self._container_index:
+            try:
+                self._container_index.add_container_entry(result[2])
+            except Exception as exc:
+                logger.error("Error when indexing container %r: %r", result[0], exc, exc_info=True)
+        if self._retention_policy:
+            self._retention_policy.add_container(result[0], size=result[2]["file_size"])
+
+    def _delete_container(self, container_name):
+        """Override of parent method, which also removes the container from index."""
+        super()._delete_container(container_name)
+        if self._container_index:
+            # Parent class lists containers as relative Paths, which sqlite can't bind
+            self._container_index.remove_container_entry(Path(container_name).name)
+        if self._retention_policy:
+            self._retention_policy.remove_container(Path(container_name).name)
+
+    @synchronized
+    def _prepare_encryption_task(self, filename_base, data, metadata, keychain_uid, encryption_conf):
+        encryption_conf = encryption_conf or self._default_encryption_conf
+
+        if not encryption_conf:
+            raise RuntimeError("Either default or file-specific encryption conf must be provided to ContainerStorage")
+
+        self._purge_exceeding_containers()
+        self._purge_executor_results()
+
+        if self._executor_backend == "process":
+            keychain_uid = keychain_uid or generate_uuid0()
+            self._ensure_local_keypairs_exist(keychain_uid=keychain_uid, encryption_conf=encryption_conf)
+            data = _dump_data_to_handover_file(data, handover_dir=self._handover_dir)
+
+        container_filepath = self._make_absolute(filename_base + CONTAINER_SUFFIX)
+        with self._stats_lock:
+            self._pending_container_names.add(container_filepath.name)
+
+        return dict(
+            container_filepath=container_filepath,
+            data=data,
+            metadata=metadata,
+            keychain_uid=keychain_uid,
+            encryption_conf=encryption_conf,
+            key_storage_pool=self._key_storage_pool,
+            offload_data_ciphertext=self._offload_data_ciphertext,
+        )
+
+    @synchronized
+    def _submit_encryption_task(self, task_kwargs):
+        with self._stats_lock:
+            self._queued_count += 1
+            queued_count = self._queued_count
+
+        enqueue_time = time.monotonic()
+        container_name = task_kwargs["container_filepath"].name
+        future = self._thread_pool_executor.submit(encrypt_data_and_dump_container, **task_kwargs)
+        future.add_done_callback(
+            lambda f: self._on_encryption_done(f, enqueue_time=enqueue_time, container_name=container_name)
+        )
+        self._pending_executor_futures.append(future)
+
+        if queued_count > 2 * self._max_workers:
+            logger.warning(
+                "Encryption is lagging behind, %d containers are waiting for %d %s worker(s)",
+                queued_count,
+                self._max_workers,
+                self._executor_backend,
+            )
+
+    def _consume_queued_encryption_task(self, task_kwargs):
+        self._free_workers_semaphore.acquire()  # Released when encryption is over
+        try:
+            self._submit_encryption_task(task_kwargs)
+        except Exception:
+            self._free_workers_semaphore.release()
+            with self._stats_lock:
+                self._pending_container_names.discard(task_kwargs["container_filepath"].name)
+            raise
+
+    def _discard_encryption_task(self, task_kwargs):
+        with self._stats_lock:
+            self._pending_container_names.discard(task_kwargs["container_filepath"].name)
+        data = task_kwargs["data"]
+        logger.warning("Discarding container %r, never encrypted", task_kwargs["container_filepath"].name)
+        if isinstance(data, Path):
+            data.unlink()  # Plaintext must not linger on disk
+        elif not isinstance(data, bytes):
+            data.close()  # Deletes spooled temporary files
+
+    def enqueue_file_for_encryption(self, filename_base, data, metadata, keychain_uid=None, encryption_conf=None):
+        """Full override of parent method, to dispatch encryption to thread or process workers."""
+        logger.info("Enqueuing file %r for encryption and storage", filename_base)
+
+        task_kwargs = self._prepare_encryption_task(
+            filename_base=filename_base,
+            data=data,
+            metadata=metadata,
+            keychain_uid=keychain_uid,
+            encryption_conf=encryption_conf,
+        )
+        if self._encryption_queue is not None:
+            self._encryption_queue.put(task_kwargs)  # Outside of lock, since it may block
+        else:
+            self._submit_encryption_task(task_kwargs)
+
+    def purge_all_containers(self, batch_size=PURGE_BATCH_SIZE, progress_callback=None):
+        """Delete all stored containers, except those still being encrypted, and return the count of deleted ones.
+
+        Containers are deleted by batches, each under the storage lock, so that a purge interleaves with
+        an active recording instead of racing with its container rotation.
+        `progress_callback(deleted_count, total_count)` is called after each batch.
+
+        Leftover files of the containers directory (e.g. offloaded ciphertexts of lost containers) are deleted too.
+        """
+        with self._stats_lock:
+            pending_container_names = set(self._pending_container_names)
+        container_names = [
+            container_name
+            for container_name in self.list_container_names(as_sorted=True)
+            if Path(container_name).name not in pending_container_names
+        ]
+        total_count = len(container_names)
+        deleted_count = 0
+        for batch_start in range(0, total_count, batch_size):
+            with self._lock:
+                for container_name in container_names[batch_start : batch_start + batch_size]:
+                    try:
+                        self._delete_container(container_name)
+                    except FileNotFoundError:
+                        pass  # Already deleted, e.g. by container rotation
+                    deleted_count += 1
+            if progress_callback:
+                progress_callback(deleted_count, total_count)
+
+        with self._lock:
+            with self._stats_lock:
+                kept_container_names = set(self._pending_container_names)
+            # Containers stored since the purge started are kept too
+            kept_container_names.update(Path(container_name).name for container_name in self.list_container_names())
+            kept_filenames = kept_container_names | {name + OFFLOADED_DATA_SUFFIX for name in kept_container_names}
+            for filepath in self._containers_dir.iterdir():
+                if filepath.name not in kept_filenames and filepath.is_file():
+                    filepath.unlink()
+        return deleted_count
+
+    @catch_and_log_exception
+    def enforce_retention(self):
+        """Delete the oldest containers exceeding the limits of the retention policy, by batch.
+
+        Returns the names of deleted containers."""
+        if not self._retention_policy:
+            return []
+        with self._lock:
+            container_names = self._retention_policy.pop_containers_to_evict()
+            for container_name in container_names:
+                try:
+                    self._delete_container(container_name)
+                except FileNotFoundError:
+                    pass  # Already deleted, e.g. by a purge
+        if container_names:
+            logger.info("Evicted %d containers according to retention policy", len(container_names))
+        return container_names
+
+    def get_retention_stats(self):
+        return self._retention_policy.get_stats() if self._retention_policy else None
+
+    def shutdown(self):
+        """Release the encryption workers right away, instead of on garbage collection.
+
+        The storage must not be used afterwards."""
+        self.wait_for_idle_state()
+        self._thread_pool_executor.shutdown(wait=True)
+
+    def wait_for_idle_state(self):
+        """Override of parent method, which also waits for queued containers."""
+        if self._encryption_queue is not None:
+            self._encryption_queue.wait_until_empty()
+        super().wait_for_idle_state()
+
+    def get_encryption_stats(self):
+        """Return a dict of statistics about the encryption pool.
+
+        Latencies measure the delay between enqueuing and storage of each container, whereas
+        durations only measure the encryption work itself (on the most recent containers)."""
+
+        def _get_average(values):
+            return sum(values) / len(values) if values else None
+
+        with self._stats_lock:
+            return dict(
+                executor_backend=self._executor_backend,
+                max_workers=self._max_workers,
+                queue_depth=self._queued_count,
+                processed_count=self._processed_count,
+                failed_count=self._failed_count,
+                last_latency_s=self._latencies_s[-1] if self._latencies_s else None,
+                average_latency_s=_get_average(self._latencies_s),
+                max_latency_s=max(self._latencies_s, default=None),
+                average_encryption_duration_s=_get_average(self._encryption_durations_s),
+                queue=self._encryption_queue.get_stats() if self._encryption_queue is not None else None,
+            )
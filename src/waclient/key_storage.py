@@ -0,0 +1,310 @@
+import math
+import multiprocessing
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from kivy.logger import Logger as logger
+
+from wacryptolib.exceptions import KeyDoesNotExist
+from wacryptolib.key_generation import generate_asymmetric_keypair
+from wacryptolib.key_storage import FilesystemKeyStorage, FilesystemKeyStoragePool
+from wacryptolib.utilities import TaskRunnerStateMachineBase
+
+
+def _generate_timed_keypair(key_generation_func, key_type):
+    """Task to be run by a thread or process worker, which returns a serialized keypair and its generation duration."""
+    start_time = time.monotonic()
+    keypair = key_generation_func(key_type=key_type, serialize=True)
+    return keypair, time.monotonic() - start_time
+
+
+class FreeKeysStats:
+    """
+    Thread-safe statistics about the consumption of free keys, per key type.
+
+    A "hit" is a free keypair successfully attached to a keychain, a "miss" means that the pool
+    was empty, so that a keypair had to be generated on the critical path of encryption.
+
+    Consumption rates are estimated on the latest `rate_window_size` consumptions (hits and misses).
+    """
+
+    rate_window_size = 20
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start_time = time.monotonic()
+        self._hits = {}
+        self._misses = {}
+        self._consumption_times = {}
+        self._wakeup_events = weakref.WeakSet()
+
+    def __getstate__(self):
+        return {}  # Statistics stay in the process which gathers them (e.g. not in encryption workers)
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def register_wakeup_event(self, event: threading.Event):
+        """Have `event` set on each consumption (it is only weakly referenced)."""
+        with self._lock:
+            self._wakeup_events.add(event)
+
+    def record_consumption(self, key_type: str, is_hit: bool):
+        with self._lock:
+            counters = self._hits if is_hit else self._misses
+            counters[key_type] = counters.get(key_type, 0) + 1
+            consumption_times = self._consumption_times.setdefault(key_type, deque(maxlen=self.rate_window_size))
+            consumption_times.append(time.monotonic())
+            wakeup_events = list(self._wakeup_events)
+        for event in wakeup_events:
+            event.set()
+
+    def get_observation_duration_s(self):
+        return time.monotonic() - self._start_time
+
+    def get_consumption_rate_per_s(self, key_type: str) -> float:
+        """Return the estimated count of keys of this type consumed per second, recently."""
+        with self._lock:
+            consumption_times = self._consumption_times.get(key_type)
+            if not consumption_times:
+                return 0.0
+            if len(consumption_times) == consumption_times.maxlen:
+                window_start_time = consumption_times[0]
+            else:
+                window_start_time = self._start_time
+            window_s = max(time.monotonic() - window_start_time, 1)
+            return len(consumption_times) / window_s
+
+    def get_stats(self, key_type: str) -> dict:
+        with self._lock:
+            hits = self._hits.get(key_type, 0)
+            misses = self._misses.get(key_type, 0)
+        return dict(
+            hits=hits,
+            misses=misses,
+            hit_ratio=(hits / (hits + misses)) if (hits + misses) else None,
+            consumption_rate_per_min=60 * self.get_consumption_rate_per_s(key_type),
+        )
+
+
+class MonitoredFilesystemKeyStorage(FilesystemKeyStorage):
+    """Filesystem key storage which records hits and misses of its free keys pools into a FreeKeysStats."""
+
+    def __init__(self, keys_dir, free_keys_stats: FreeKeysStats):
+        super().__init__(keys_dir)
+        self._free_keys_stats = free_keys_stats
+
+    def attach_free_keypair_to_uuid(self, *, keychain_uid, key_type: str):
+        try:
+            super().attach_free_keypair_to_uuid(keychain_uid=keychain_uid, key_type=key_type)
+        except KeyDoesNotExist:
+            self._free_keys_stats.record_consumption(key_type, is_hit=False)
+            raise
+        self._free_keys_stats.record_consumption(key_type, is_hit=True)
+
+
+class MonitoredFilesystemKeyStoragePool(FilesystemKeyStoragePool):
+    """Filesystem key storage pool, whose local key storage feeds the `free_keys_stats` of the pool."""
+
+    def __init__(self, root_dir):
+        super().__init__(root_dir)
+        self.free_keys_stats = FreeKeysStats()
+
+    def get_local_key_storage(self):
+        """Full override of parent method, to return a monitored key storage."""
+        local_key_storage_path = self._root_dir.joinpath(self.LOCAL_STORAGE_DIRNAME)
+        local_key_storage_path.mkdir(exist_ok=True)
+        return MonitoredFilesystemKeyStorage(local_key_storage_path, free_keys_stats=self.free_keys_stats)
+
+
+class AdaptiveFreeKeysGenerator(TaskRunnerStateMachineBase):
+    """
+    Background worker which pregenerates free keypairs in `key_storage`, according to
+    the real consumption of each key type (as measured by `free_keys_stats`, if provided).
+
+    The reserve targeted for each key type covers the consumption expected during `reserve_horizon_s`
+    seconds, bounded by `min_free_keys_per_type` and `max_free_keys_per_type`. Until consumption
+    has been observed for that long (or forever, without `free_keys_stats`), the full
+    `max_free_keys_per_type` reserve is targeted.
+
+    Once reserves are complete, the worker sleeps until a reserve is expected to fall below its target
+    (between `min_sleep_s` and `max_sleep_s`), or until a key gets consumed.
+
+    If `generation_workers_count` is above 1, keypairs are generated by a pool of child processes,
+    so that filling an empty pool uses several cores (and doesn't hold the GIL against sensors): each batch
+    mixes the key types with the largest deficits, and is written to `key_storage` by the worker thread,
+    since the free keys pool of a FilesystemKeyStorage is not safe for multiprocessing.
+    """
+
+    def __init__(
+        self,
+        key_storage,
+        key_types,
+        max_free_keys_per_type: int,
+        free_keys_stats: Optional[FreeKeysStats] = None,
+        min_free_keys_per_type: int = 1,
+        reserve_horizon_s: float = 600,
+        min_sleep_s: float = 1,
+        max_sleep_s: float = 60,
+        key_generation_func=generate_asymmetric_keypair,
+        generation_workers_count: int = 1,
+    ):
+        super().__init__()
+        assert key_types, key_types
+        assert generation_workers_count >= 1, generation_workers_count
+        assert 0 < min_free_keys_per_type <= max_free_keys_per_type, (min_free_keys_per_type, max_free_keys_per_type)
+        self._key_storage = key_storage
+        self._key_types = tuple(key_types)
+        self._max_free_keys_per_type = max_free_keys_per_type
+        self._min_free_keys_per_type = min_free_keys_per_type
+        self._free_keys_stats = free_keys_stats
+        self._reserve_horizon_s = reserve_horizon_s
+        self._min_sleep_s = min_sleep_s
+        self._max_sleep_s = max_sleep_s
+        self._key_generation_func = key_generation_func
+        self._generation_workers_count = generation_workers_count
+        self._process_pool_executor = None
+        self._wakeup_event = threading.Event()
+        if free_keys_stats:
+            free_keys_stats.register_wakeup_event(self._wakeup_event)
+        self._thread = None
+        self._generated_counts = {key_type: 0 for key_type in self._key_types}
+        self._generation_durations_s = {key_type: 0.0 for key_type in self._key_types}
+
+    def _get_consumption_rate_per_s(self, key_type):
+        return self._free_keys_stats.get_consumption_rate_per_s(key_type) if self._free_keys_stats else 0.0
+
+    def get_target_reserve(self, key_type: str) -> int:
+        if not self._free_keys_stats or self._free_keys_stats.get_observation_duration_s() < self._reserve_horizon_s:
+            return self._max_free_keys_per_type
+        expected_consumption = self._get_consumption_rate_per_s(key_type) * self._reserve_horizon_s
+        return min(self._max_free_keys_per_type, max(self._min_free_keys_per_type, math.ceil(expected_consumption)))
+
+    def _get_sleep_duration_s(self, free_keys_counts: dict) -> float:
+        sleep_s = self._max_sleep_s
+        for key_type, free_keys_count in free_keys_counts.items():
+            consumption_rate_per_s = self._get_consumption_rate_per_s(key_type)
+            if consumption_rate_per_s:
+                # Time before this reserve goes below its target
+                spare_keys_count = free_keys_count - self.get_target_reserve(key_type) + 1
+                sleep_s = min(sleep_s, spare_keys_count / consumption_rate_per_s)
+        return min(self._max_sleep_s, max(self._min_sleep_s, sleep_s))
+
+    def _select_key_types_to_generate(self, deficits: dict) -> list:
+        """Return the key types of the next batch of keypairs to generate, largest deficits first."""
+        deficits = dict(deficits)
+        key_types = []
+        while len(key_types) < self._generation_workers_count:
+            key_type = max(deficits, key=deficits.get)
+            if deficits[key_type] <= 0:
+                break
+            key_types.append(key_type)
+            deficits[key_type] -= 1
+        return key_types
+
+    def _generate_free_keypairs(self, key_types):
+        if self._process_pool_executor:
+            futures = [
+                self._process_pool_executor.submit(_generate_timed_keypair, self._key_generation_func, key_type)
+                for key_type in key_types
+            ]
+        else:
+            futures = None
+
+        first_exception = None
+        for idx, key_type in enumerate(key_types):
+            try:
+                if futures:
+                    keypair, generation_duration_s = futures[idx].result()
+                else:
+                    keypair, generation_duration_s = _generate_timed_keypair(self._key_generation_func, key_type)
+                self._key_storage.add_free_keypair(
+                    key_type=key_type, public_key=keypair["public_key"], private_key=keypair["private_key"]
+                )
+            except Exception as exc:
+                first_exception = first_exception or exc  # Other keypairs of the batch are still stored
+                continue
+            self._generated_counts[key_type] += 1
+            self._generation_durations_s[key_type] += generation_duration_s
+            logger.debug("New free key of type %s pregenerated" % key_type)
+
+        if first_exception:
+            raise first_exception
+
+    def _offloaded_generate_free_keys(self):
+        is_warm = False
+        while self.is_running:
+            self._wakeup_event.clear()
+            free_keys_counts = {
+                key_type: self._key_storage.get_free_keypairs_count(key_type) for key_type in self._key_types
+            }
+            deficits = {key_type: self.get_target_reserve(key_type) - count for key_type, count in free_keys_counts.items()}
+            key_types = self._select_key_types_to_generate(deficits)
+            if key_types:
+                try:
+                    self._generate_free_keypairs(key_types)
+                except Exception as exc:
+                    logger.error("Error when pregenerating free keys of types %s: %r", key_types, exc, exc_info=True)
+                    self._wakeup_event.wait(self._max_sleep_s)
+                continue
+            if not is_warm:
+                logger.info("Free keys pool is warm, with reserves %s", free_keys_counts)
+                is_warm = True
+            self._wakeup_event.wait(self._get_sleep_duration_s(free_keys_counts))
+
+    def start(self):
+        super().start()
+        if self._thread:
+            self._thread.join()  # Previous thread might still be finishing a generation
+        if self._generation_workers_count > 1 and not self._process_pool_executor:
+            # "spawn" avoids forking a multithreaded process
+            self._process_pool_executor = ProcessPoolExecutor(
+                max_workers=self._generation_workers_count, mp_context=multiprocessing.get_context("spawn")
+            )
+        self._wakeup_event.clear()
+        self._thread = threading.Thread(
+            target=self._offloaded_generate_free_keys, name="free_keys_generator", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Request the worker to stop, once the current key generation (if any) is over."""
+        super().stop()
+        self._wakeup_event.set()
+
+    def join(self):
+        super().join()
+        if self._thread:
+            self._thread.join()
+        if self._process_pool_executor:
+            self._process_pool_executor.shutdown(wait=True)
+            self._process_pool_executor = None
+
+    def get_warmup_progress(self) -> float:
+        """Return the ratio (between 0 and 1) of target reserves already filled, 1 meaning that the pool is warm."""
+        target_reserves = {key_type: self.get_target_reserve(key_type) for key_type in self._key_types}
+        filled_count = sum(
+            min(self._key_storage.get_free_keypairs_count(key_type), target_reserve)
+            for key_type, target_reserve in target_reserves.items()
+        )
+        return filled_count / sum(target_reserves.values())
+
+    def get_stats(self) -> dict:
+        """Return, for each key type, the statistics of pool hits/misses, of consumption and of pregeneration."""
+        stats = {}
+        for key_type in self._key_types:
+            generated_count = self._generated_counts[key_type]
+            stats[key_type] = dict(
+                self._free_keys_stats.get_stats(key_type) if self._free_keys_stats else {},
+                free_keys_count=self._key_storage.get_free_keypairs_count(key_type),
+                target_reserve=self.get_target_reserve(key_type),
+                generated_count=generated_count,
+                average_generation_duration_s=(
+                    self._generation_durations_s[key_type] / generated_count if generated_count else None
+                ),
+            )
+        return stats
@@ -2,21 +2,35 @@
 from kivy.logger import Logger as logger
 
 from oscpy.server import OSCThreadServer
+from waclient.aggregators import (
+    AdjustableJsonDataAggregator,
+    SpoolingTarfileRecordsAggregator,
+    PreEventTarfileRecordsAggregator,
+    ColumnarDataAggregator,
+)
 from waclient.common_config import (
+    INTERNAL_CACHE_DIR,
     INTERNAL_CONTAINERS_DIR,
     PREGENERATED_KEY_TYPES,
-    IS_ANDROID,
-    warn_if_permission_missing)
-from waclient.sensors.gps import get_gps_sensor
-from waclient.sensors.gyroscope import get_gyroscope_sensor
-from waclient.sensors.microphone import get_microphone_sensor
-from wacryptolib.container import ContainerStorage
-from wacryptolib.escrow import get_free_keys_generator_worker
+    IS_ANDROID)
+from waclient.utilities.bounded_queue import OVERFLOW_POLICIES
+from waclient.utilities.compression import is_compression_codec_available
+from waclient.utilities.shutdown import ShutdownCoordinator
+from waclient.sensors.fields import GPS_FIELD_NAMES, GPS_FIELD_SCALES, GYROSCOPE_FIELD_NAMES, GYROSCOPE_FIELD_SCALES
+from waclient.sensors.registry import (
+    build_sensor,
+    get_compressible_record_names,
+    get_registered_sensor_names,
+    get_sensor_config_key,
+)
+from waclient.container_index import get_container_index
+from waclient.container_retention import ContainerRetentionPolicy
+from waclient.container_storage import RecordingContainerStorage
+from waclient.key_storage import AdaptiveFreeKeysGenerator
 from wacryptolib.sensor import (
-    TarfileRecordsAggregator,
-    JsonDataAggregator,
     SensorsManager,
 )
+from wacryptolib.utilities import PeriodicTaskHandler
 
 
 osc = OSCThreadServer(encoding="utf8")
@@ -29,13 +43,55 @@ if IS_ANDROID:
     autoclass("org.jnius.NativeInvocationHandler")
 
 
-def build_recording_toolchain(config, key_storage_pool, encryption_conf):
-    """Instantiate the whole toolchain of sensors and aggregators, depending on the config.
+# Max number of items waiting between each stage of the pipeline (sensor values, tarfile records, containers)
+SENSOR_QUEUE_SIZE = 1000
+RECORDS_QUEUE_SIZE = 10
+ENCRYPTION_QUEUE_SIZE = 4
 
-    Returns None if no toolchain is enabled by config.
-    """
+RECORDING_MODES = ("continuous", "pre_event")
+
+PRE_EVENT_TRIGGERS = ("manual", "motion")
+
+# Max RAM used by the rolling window of records, in pre-event recording mode
+PRE_EVENT_WINDOW_MEMORY_SIZE = 20 * 1024 * 1024
+
+# Free keys are pregenerated to cover the consumption expected during this period
+FREE_KEYS_RESERVE_HORIZON_S = 600
+
+# Period of the checks of the container retention policy, each evicting a batch of containers at most
+RETENTION_CHECK_INTERVAL_S = 10
+
+RETENTION_SETTINGS = ("retention_max_total_mb", "retention_max_age_h", "retention_min_free_disk_mb")
+
+QUEUE_OVERFLOW_POLICY_SETTINGS = (
+    "sensor_queue_overflow_policy",
+    "records_queue_overflow_policy",
+    "encryption_queue_overflow_policy",
+)
+
+# Settings which can be changed on an existing (stopped) toolchain, without rebuilding it
+# (besides the config keys enabling registered sensors)
+HOT_RECONFIGURABLE_SETTINGS = frozenset(
+    [
+        "microphone_double_buffering",
+        "gyroscope_adaptive_polling",
+        "gyroscope_min_polling_interval_s",
+        "gyroscope_max_polling_interval_s",
+        "gps_min_distance_m",
+        "gps_max_error_m",
+        "camera_frame_rate",
+        "camera_jpeg_quality",
+        "polling_interval_s",
+        "container_member_duration_s",
+        "container_recording_duration_s",
+        "max_containers_count",
+        *RETENTION_SETTINGS,
+    ]
+)
 
-    # TODO make this part more resilient against exceptions
+
+def _read_toolchain_settings(config):
+    """Extract from config, and normalize, all the settings used by the recording toolchain."""
 
     def get_conf_value(*args, converter=None, **kwargs):
         value = config.getdefault("usersettings", *args, **kwargs)
@@ -43,117 +99,332 @@ def build_recording_toolchain(config, key_storage_pool, encryption_conf):
             value = converter(value)
         return value
 
-    # BEFORE ANYTHING we ensure that it's worth building all the nodes below
     # Note that values are stored as "0" or "1", so bool() is not a proper converter
-    record_gyroscope = get_conf_value("record_gyroscope", False, converter=int)
-    record_gps = get_conf_value("record_gps", False, converter=int)
-    record_microphone = get_conf_value("record_microphone", False, converter=int)
-    if not any([record_gyroscope, record_gps, record_microphone]):
-        logger.warning("No sensor is enabled, aborting recorder setup")
-        return None
-
-    max_containers_count = get_conf_value("max_containers_count", 100, converter=int)
-    container_recording_duration_s = get_conf_value(
-        "container_recording_duration_s", 60, converter=float
+    settings = dict(
+        max_containers_count=get_conf_value("max_containers_count", 100, converter=int),
+        retention_max_total_mb=get_conf_value("retention_max_total_mb", 0, converter=int),
+        retention_max_age_h=get_conf_value("retention_max_age_h", 0, converter=float),
+        retention_min_free_disk_mb=get_conf_value("retention_min_free_disk_mb", 0, converter=int),
+        container_recording_duration_s=get_conf_value("container_recording_duration_s", 60, converter=float),
+        container_member_duration_s=get_conf_value("container_member_duration_s", 60, converter=float),
+        polling_interval_s=get_conf_value("polling_interval_s", 0.5, converter=float),
+        gyroscope_adaptive_polling=get_conf_value("gyroscope_adaptive_polling", False, converter=int),
+        gyroscope_min_polling_interval_s=get_conf_value("gyroscope_min_polling_interval_s", 0.1, converter=float),
+        gyroscope_max_polling_interval_s=get_conf_value("gyroscope_max_polling_interval_s", 2, converter=float),
+        gps_min_distance_m=get_conf_value("gps_min_distance_m", 0, converter=float),
+        gps_max_error_m=get_conf_value("gps_max_error_m", 0, converter=float),
+        camera_frame_rate=get_conf_value("camera_frame_rate", 1, converter=float),
+        camera_jpeg_quality=get_conf_value("camera_jpeg_quality", 70, converter=int),
+        max_free_keys_per_type=get_conf_value("max_free_keys_per_type", 1, converter=int),
+        key_generation_workers_count=get_conf_value("key_generation_workers_count", 1, converter=int),
+        max_container_memory_kb=get_conf_value("max_container_memory_kb", 1024, converter=int),
+        encryption_workers_count=get_conf_value("encryption_workers_count", 1, converter=int),
+        encryption_workers_backend=get_conf_value("encryption_workers_backend", "thread"),
+        microphone_double_buffering=get_conf_value("microphone_double_buffering", True, converter=int),
+        sensor_data_encoding=get_conf_value("sensor_data_encoding", "json"),
+        sensor_data_compression=get_conf_value("sensor_data_compression", "none"),
+        sensor_queue_overflow_policy=get_conf_value("sensor_queue_overflow_policy", "decimate"),
+        records_queue_overflow_policy=get_conf_value("records_queue_overflow_policy", "block"),
+        encryption_queue_overflow_policy=get_conf_value("encryption_queue_overflow_policy", "block"),
+        recording_mode=get_conf_value("recording_mode", "continuous"),
+        pre_event_duration_s=get_conf_value("pre_event_duration_s", 30, converter=float),
+        post_event_duration_s=get_conf_value("post_event_duration_s", 10, converter=float),
+        pre_event_trigger=get_conf_value("pre_event_trigger", "manual"),
     )
-    container_member_duration_s = get_conf_value(
-        "container_member_duration_s", 60, converter=float
+
+    for sensor_name in get_registered_sensor_names():
+        config_key = get_sensor_config_key(sensor_name)
+        settings[config_key] = get_conf_value(config_key, False, converter=int)
+
+    if not is_compression_codec_available(settings["sensor_data_compression"]):
+        logger.warning(
+            "Compression codec %s is not available, using gzip instead", settings["sensor_data_compression"]
+        )
+        settings["sensor_data_compression"] = "gzip"
+
+    for setting_name in QUEUE_OVERFLOW_POLICY_SETTINGS:
+        if settings[setting_name] not in OVERFLOW_POLICIES:
+            logger.warning("Unknown queue overflow policy %r, using block instead", settings[setting_name])
+            settings[setting_name] = "block"
+
+    if settings["recording_mode"] not in RECORDING_MODES:
+        logger.warning("Unknown recording mode %r, using continuous instead", settings["recording_mode"])
+        settings["recording_mode"] = "continuous"
+
+    if settings["pre_event_trigger"] not in PRE_EVENT_TRIGGERS:
+        logger.warning("Unknown pre-event trigger %r, using manual instead", settings["pre_event_trigger"])
+        settings["pre_event_trigger"] = "manual"
+
+    if settings["encryption_workers_backend"] == "process" and IS_ANDROID:
+        logger.warning("Process-based encryption workers are not supported on Android, using threads instead")
+        settings["encryption_workers_backend"] = "thread"
+
+    if settings["key_generation_workers_count"] > 1 and IS_ANDROID:
+        logger.warning("Process-based key generation workers are not supported on Android, using a single thread")
+        settings["key_generation_workers_count"] = 1
+
+    return settings
+
+
+def _is_sensor_enabled(sensor_name, settings):
+    return bool(settings[get_sensor_config_key(sensor_name)])
+
+
+def _build_free_keys_generator_worker(toolchain):
+    settings = toolchain["settings"]
+    max_free_keys_per_type = settings["max_free_keys_per_type"]
+    if not max_free_keys_per_type:
+        return None
+    return AdaptiveFreeKeysGenerator(
+        key_storage=toolchain["local_key_storage"],
+        key_types=PREGENERATED_KEY_TYPES,
+        max_free_keys_per_type=max_free_keys_per_type,
+        # Without a monitored key storage pool, consumption is unknown, so max reserves are kept
+        free_keys_stats=getattr(toolchain["key_storage_pool"], "free_keys_stats", None),
+        reserve_horizon_s=FREE_KEYS_RESERVE_HORIZON_S,
+        generation_workers_count=settings["key_generation_workers_count"],
     )
-    polling_interval_s = get_conf_value("polling_interval_s", 0.5, converter=float)
-    max_free_keys_per_type = get_conf_value("max_free_keys_per_type", 1, converter=int)
 
-    logger.info(
-        "Toolchain configuration is %s",
-        str(
-            dict(
-                max_containers_count=max_containers_count,
-                container_recording_duration_s=container_recording_duration_s,
-                container_member_duration_s=container_member_duration_s,
-                polling_interval_s=polling_interval_s,
-            )
-        ),
+
+def _get_retention_limits(settings):
+    return dict(
+        max_total_bytes=settings["retention_max_total_mb"] * 1024 ** 2,
+        max_age_s=settings["retention_max_age_h"] * 3600,
+        min_free_disk_bytes=settings["retention_min_free_disk_mb"] * 1024 ** 2,
     )
 
-    container_storage = ContainerStorage(
+
+def _update_sensors_manager(toolchain):
+    sensors = [sensor for sensor in toolchain["sensors"].values() if sensor is not None]
+    if not sensors:
+        logger.warning("No sensor is allowed by app permissions, aborting recorder setup")
+        return False
+    toolchain["sensors_manager"] = SensorsManager(sensors=sensors)
+    return True
+
+
+def build_recording_toolchain(config, key_storage_pool, encryption_conf):
+    """Instantiate the whole toolchain of sensors and aggregators, depending on the config.
+
+    Returns None if no toolchain is enabled by config.
+    """
+
+    # TODO make this part more resilient against exceptions
+
+    settings = _read_toolchain_settings(config)
+
+    # BEFORE ANYTHING we ensure that it's worth building all the nodes below
+    if not any(_is_sensor_enabled(sensor_name, settings) for sensor_name in get_registered_sensor_names()):
+        logger.warning("No sensor is enabled, aborting recorder setup")
+        return None
+
+    logger.info("Toolchain configuration is %s", str(settings))
+
+    container_member_duration_s = settings["container_member_duration_s"]
+
+    retention_policy = ContainerRetentionPolicy(INTERNAL_CONTAINERS_DIR, **_get_retention_limits(settings))
+
+    container_storage = RecordingContainerStorage(
         default_encryption_conf=encryption_conf,
         containers_dir=INTERNAL_CONTAINERS_DIR,
-        max_containers_count=max_containers_count,
+        max_containers_count=settings["max_containers_count"],
         key_storage_pool=key_storage_pool,
+        max_workers=settings["encryption_workers_count"],
+        executor_backend=settings["encryption_workers_backend"],
+        handover_dir=INTERNAL_CACHE_DIR,
+        queue_size=ENCRYPTION_QUEUE_SIZE,
+        overflow_policy=settings["encryption_queue_overflow_policy"],
+        container_index=get_container_index(),
+        retention_policy=retention_policy,
     )
 
     # Tarfile builder level
 
-    tarfile_aggregator = TarfileRecordsAggregator(
+    tarfile_aggregator_kwargs = dict(
         container_storage=container_storage,
-        max_duration_s=container_recording_duration_s,
+        max_duration_s=settings["container_recording_duration_s"],
+        spool_dir=INTERNAL_CACHE_DIR,
+        max_memory_size=settings["max_container_memory_kb"] * 1024,  # Spooled to disk when exceeded
+        member_compression={
+            record_name: settings["sensor_data_compression"] for record_name in get_compressible_record_names()
+        },
+        queue_size=RECORDS_QUEUE_SIZE,
+        overflow_policy=settings["records_queue_overflow_policy"],
     )
+    if settings["recording_mode"] == "pre_event":
+        tarfile_aggregator = PreEventTarfileRecordsAggregator(
+            pre_event_duration_s=settings["pre_event_duration_s"],
+            post_event_duration_s=settings["post_event_duration_s"],
+            max_window_memory_size=PRE_EVENT_WINDOW_MEMORY_SIZE,
+            **tarfile_aggregator_kwargs
+        )
+    else:
+        tarfile_aggregator = SpoolingTarfileRecordsAggregator(**tarfile_aggregator_kwargs)
 
     # Data aggregation level
 
-    gyroscope_json_aggregator = JsonDataAggregator(
+    gyroscope_json_aggregator = ColumnarDataAggregator(
         max_duration_s=container_member_duration_s,
         tarfile_aggregator=tarfile_aggregator,
         sensor_name="gyroscope",
+        field_names=GYROSCOPE_FIELD_NAMES,
+        encoding=settings["sensor_data_encoding"],
+        field_scales=GYROSCOPE_FIELD_SCALES,
+        queue_size=SENSOR_QUEUE_SIZE,
+        overflow_policy=settings["sensor_queue_overflow_policy"],
     )
 
-    gps_json_aggregator = JsonDataAggregator(
-        max_duration_s=container_member_duration_s,
-        tarfile_aggregator=tarfile_aggregator,
-        sensor_name="gps",
+    data_aggregators = [gyroscope_json_aggregator]
+
+    if settings["sensor_data_encoding"] == "binary":
+        gps_json_aggregator = ColumnarDataAggregator(
+            max_duration_s=container_member_duration_s,
+            tarfile_aggregator=tarfile_aggregator,
+            sensor_name="gps",
+            field_names=GPS_FIELD_NAMES,
+            encoding="binary",
+            field_scales=GPS_FIELD_SCALES,
+            queue_size=SENSOR_QUEUE_SIZE,
+            overflow_policy=settings["sensor_queue_overflow_policy"],
+        )
+        # Non-numeric status messages can't be binary-encoded
+        gps_status_json_aggregator = AdjustableJsonDataAggregator(
+            max_duration_s=container_member_duration_s,
+            tarfile_aggregator=tarfile_aggregator,
+            sensor_name="gps_status",
+        )
+        data_aggregators += [gps_json_aggregator, gps_status_json_aggregator]
+    else:
+        gps_json_aggregator = AdjustableJsonDataAggregator(  # Also receives status messages
+            max_duration_s=container_member_duration_s,
+            tarfile_aggregator=tarfile_aggregator,
+            sensor_name="gps",
+        )
+        data_aggregators.append(gps_json_aggregator)
+
+    toolchain = dict(
+        settings=settings,
+        encryption_conf=encryption_conf,
+        key_storage_pool=key_storage_pool,
+        data_aggregators=data_aggregators,
+        tarfile_aggregators=[tarfile_aggregator],
+        container_storage=container_storage,
+        retention_policy=retention_policy,
+        local_key_storage=key_storage_pool.get_local_key_storage(),
+        is_broken=False,  # Set when a stop timed out, components might then be stuck
     )
 
     # Sensors level
 
-    sensors = []
-
-    if record_gyroscope:  # No need for specific permission!
-        gyroscope_sensor = get_gyroscope_sensor(
-            json_aggregator=gyroscope_json_aggregator, polling_interval_s=polling_interval_s
+    # Sensor modules are only imported once enabled
+    toolchain["sensors"] = {
+        sensor_name: (
+            build_sensor(sensor_name, toolchain=toolchain) if _is_sensor_enabled(sensor_name, settings) else None
         )
-        sensors.append(gyroscope_sensor)
+        for sensor_name in get_registered_sensor_names()
+    }
+    if not _update_sensors_manager(toolchain):
+        return None
 
-    if record_gps and not warn_if_permission_missing("ACCESS_FINE_LOCATION"):
-        gps_sensor = get_gps_sensor(
-            polling_interval_s=polling_interval_s, json_aggregator=gps_json_aggregator
-        )
-        sensors.append(gps_sensor)
+    # Off-band workers
 
-    if record_microphone and not warn_if_permission_missing("RECORD_AUDIO"):
-        microphone_sensor = get_microphone_sensor(
-            interval_s=container_member_duration_s, tarfile_aggregator=tarfile_aggregator
-        )
-        sensors.append(microphone_sensor)
+    toolchain["free_keys_generator_worker"] = _build_free_keys_generator_worker(toolchain)
+    toolchain["retention_worker"] = PeriodicTaskHandler(
+        interval_s=RETENTION_CHECK_INTERVAL_S, task_func=container_storage.enforce_retention
+    )
 
-    if not sensors:
-        logger.warning("No sensor is allowed by app permissions, aborting recorder setup")
+    return toolchain
+
+
+def update_recording_toolchain(toolchain, config, key_storage_pool, encryption_conf):
+    """Apply the changes of config to a stopped toolchain.
+
+    Settings of HOT_RECONFIGURABLE_SETTINGS are applied in place (e.g. only the concerned sensor is
+    created or removed), whereas other changes (and toolchains broken by a stop which timed out)
+    trigger a full rebuild.
+
+    Returns the toolchain to be used from now on (possibly a new one), or None if no toolchain is enabled by config.
+    """
+    if toolchain["is_broken"]:
+        logger.info("Rebuilding recording toolchain (previous stop timed out)")
+        return build_recording_toolchain(config, key_storage_pool=key_storage_pool, encryption_conf=encryption_conf)
+
+    assert not toolchain["sensors_manager"].is_running
+
+    settings = _read_toolchain_settings(config)
+    old_settings = toolchain["settings"]
+    changed_settings = {key for (key, value) in settings.items() if value != old_settings.get(key)}
+
+    sensor_config_keys = {get_sensor_config_key(sensor_name) for sensor_name in get_registered_sensor_names()}
+    cold_changes = changed_settings - HOT_RECONFIGURABLE_SETTINGS - sensor_config_keys
+    if (
+        cold_changes
+        or encryption_conf != toolchain["encryption_conf"]
+        or key_storage_pool is not toolchain["key_storage_pool"]
+    ):
+        logger.info("Rebuilding recording toolchain (changed settings: %s)", sorted(cold_changes) or "<none>")
+        return build_recording_toolchain(config, key_storage_pool=key_storage_pool, encryption_conf=encryption_conf)
+
+    sensors = toolchain["sensors"]
+    # E.g. sensors whose permission was missing so far, or which were registered since then
+    missing_sensor_names = set(
+        sensor_name
+        for sensor_name in get_registered_sensor_names()
+        if _is_sensor_enabled(sensor_name, settings) and not sensors.get(sensor_name)
+    )
+
+    if not changed_settings and not missing_sensor_names:
+        return toolchain
+
+    logger.info("Updating recording toolchain in place (changed settings: %s)", sorted(changed_settings))
+
+    if not any(_is_sensor_enabled(sensor_name, settings) for sensor_name in get_registered_sensor_names()):
+        logger.warning("No sensor is enabled, aborting recorder setup")
         return None
 
-    sensors_manager = SensorsManager(sensors=sensors)
+    toolchain["settings"] = settings
+    (tarfile_aggregator,) = toolchain["tarfile_aggregators"]
 
-    local_key_storage = key_storage_pool.get_local_key_storage()
+    if "max_containers_count" in changed_settings:
+        toolchain["container_storage"].set_max_containers_count(settings["max_containers_count"])
 
-    # Off-band workers
+    if changed_settings & set(RETENTION_SETTINGS):
+        retention_policy = toolchain["retention_policy"]
+        for limit_name, limit in _get_retention_limits(settings).items():
+            setattr(retention_policy, limit_name, limit)
 
-    if max_free_keys_per_type:
-        free_keys_generator_worker = get_free_keys_generator_worker(
-            key_storage=local_key_storage,
-            max_free_keys_per_type=max_free_keys_per_type,
-            sleep_on_overflow_s=0.5
-            * max_free_keys_per_type
-            * container_member_duration_s,  # TODO make it configurable?
-            key_types=PREGENERATED_KEY_TYPES,
-        )
-    else:
-        free_keys_generator_worker = None
+    if "container_recording_duration_s" in changed_settings:
+        tarfile_aggregator.set_max_duration(settings["container_recording_duration_s"])
 
-    toolchain = dict(
-        sensors_manager=sensors_manager,
-        data_aggregators=[gyroscope_json_aggregator, gps_json_aggregator],
-        tarfile_aggregators=[tarfile_aggregator],
-        container_storage=container_storage,
-        free_keys_generator_worker=free_keys_generator_worker,
-        local_key_storage=local_key_storage,
+    if "container_member_duration_s" in changed_settings:
+        for data_aggregator in toolchain["data_aggregators"]:
+            data_aggregator.set_max_duration(settings["container_member_duration_s"])
+        if sensors.get("microphone"):
+            sensors["microphone"].set_segment_duration(settings["container_member_duration_s"])
+
+    if "polling_interval_s" in changed_settings:
+        if sensors.get("gyroscope"):
+            sensors["gyroscope"].set_polling_interval(settings["polling_interval_s"])
+        if sensors.get("gps"):
+            sensors["gps"].set_polling_interval(settings["polling_interval_s"])
+
+    sensor_names_to_rebuild = missing_sensor_names | set(
+        sensor_name
+        for sensor_name in get_registered_sensor_names()
+        if get_sensor_config_key(sensor_name) in changed_settings
     )
+    if "microphone_double_buffering" in changed_settings:
+        sensor_names_to_rebuild.add("microphone")
+    for sensor_name in ("gyroscope", "gps", "camera"):
+        if any(setting.startswith(sensor_name + "_") for setting in changed_settings):
+            sensor_names_to_rebuild.add(sensor_name)
+    if sensor_names_to_rebuild:
+        for sensor_name in sensor_names_to_rebuild:
+            is_enabled = _is_sensor_enabled(sensor_name, settings)
+            sensors[sensor_name] = build_sensor(sensor_name, toolchain=toolchain) if is_enabled else None
+        if not _update_sensors_manager(toolchain):
+            return None
+
     return toolchain
 
 
@@ -161,6 +432,7 @@ def start_recording_toolchain(toolchain):
     """
     Start all the sensors, thus ensuring that the toolchain begins to record end-to-end.
     """
+    assert not toolchain["is_broken"], "Toolchain must be rebuilt after a stop which timed out"
 
     free_keys_generator_worker = toolchain["free_keys_generator_worker"]
     if free_keys_generator_worker:
@@ -169,48 +441,129 @@ def start_recording_toolchain(toolchain):
     else:
         logger.info("Ignoring the generator of free keys")
 
+    toolchain["retention_worker"].start()
+
     sensors_manager = toolchain["sensors_manager"]
     sensors_manager.start()
 
 
-def stop_recording_toolchain(toolchain):
+def get_recording_toolchain_stats(toolchain):
     """
-    Perform an ordered stop+flush of sensors and miscellaneous layers of aggregator.
+    Return a dict of statistics about the queues between the stages of the toolchain
+    (depth, drops...), about the pre-event window, about camera frames, about encryption workers, about container
+    retention (evictions, reclaimed bytes), and about free keys (pool hits/misses, reserves, warmup...).
+    """
+    sensor_queues = {
+        data_aggregator.sensor_name: data_aggregator.queue_stats
+        for data_aggregator in toolchain["data_aggregators"]
+        if getattr(data_aggregator, "queue_stats", None)  # Status messages are rare, thus not queued
+    }
+    (tarfile_aggregator,) = toolchain["tarfile_aggregators"]
+    free_keys_generator_worker = toolchain["free_keys_generator_worker"]
+    camera_sensor = toolchain["sensors"].get("camera")
+    return dict(
+        sensor_queues=sensor_queues,
+        pre_event_window=getattr(tarfile_aggregator, "window_stats", None),
+        camera_frames=camera_sensor.frame_stats if camera_sensor else None,
+        records_queue=tarfile_aggregator.queue_stats,
+        encryption=toolchain["container_storage"].get_encryption_stats(),
+        retention=toolchain["container_storage"].get_retention_stats(),
+        free_keys=free_keys_generator_worker.get_stats() if free_keys_generator_worker else None,
+        free_keys_warmup_progress=(
+            free_keys_generator_worker.get_warmup_progress() if free_keys_generator_worker else None
+        ),
+    )
 
-    All objets remain in a usable state
+
+def mark_recording_toolchain_event(toolchain):
     """
+    Have the pre-event window of the toolchain sealed into a container, along with post-event records.
 
-    # TODO push all this to sensor manager!!
+    On a new event, data aggregators and the ongoing microphone segment are flushed first,
+    so that the latest records are part of the sealed window.
 
-    # logger.info("stop_recording_toolchain starts")
+    Returns False if the toolchain is not in pre-event recording mode (then everything is recorded anyway).
+    """
+    (tarfile_aggregator,) = toolchain["tarfile_aggregators"]
+    if not isinstance(tarfile_aggregator, PreEventTarfileRecordsAggregator):
+        return False
+    if not tarfile_aggregator.window_stats["is_event_ongoing"]:  # Else new records are archived directly
+        for data_aggregator in toolchain["data_aggregators"]:
+            data_aggregator.flush_dataset()
+        microphone_sensor = toolchain["sensors"].get("microphone")
+        if microphone_sensor:
+            microphone_sensor.flush_current_segment()
+    tarfile_aggregator.mark_event()
+    return True
+
+
+def stop_recording_toolchain(toolchain, timeout_s=None):
+    """
+    Perform an ordered stop+flush of sensors and miscellaneous layers of aggregator.
+
+    Each stage (stopping sensors, flushing data aggregators, finalizing tarfiles, waiting for encryption)
+    runs its independent tasks concurrently, and the whole shutdown is bounded by `timeout_s` seconds if provided.
+
+    Returns the report of the ShutdownCoordinator (with per-stage durations, and stages which timed out),
+    or raises the first exception encountered once all stages were attempted.
+
+    All objets remain in a usable state, unless some stages timed out: then the next stages are skipped,
+    and the toolchain is marked as broken, so that `update_recording_toolchain()` rebuilds it.
+    """
 
     sensors_manager = toolchain["sensors_manager"]
     data_aggregators = toolchain["data_aggregators"]
     tarfile_aggregators = toolchain["tarfile_aggregators"]
     container_storage = toolchain["container_storage"]
     free_keys_generator_worker = toolchain["free_keys_generator_worker"]
+    retention_worker = toolchain["retention_worker"]
+
+    coordinator = ShutdownCoordinator(timeout_s=timeout_s)
+
+    def _stop_sensors_manager():
+        sensors_manager.stop()
+        sensors_manager.join()
+
+    def _stop_free_keys_generator_worker():
+        free_keys_generator_worker.stop()
+        free_keys_generator_worker.join()  # Might be finishing a key generation
 
+    def _stop_retention_worker():
+        retention_worker.stop()
+        retention_worker.join()  # Might be evicting a batch of containers
+
+    sensor_tasks = dict(sensors_manager=_stop_sensors_manager, retention_worker=_stop_retention_worker)
     if free_keys_generator_worker:
         logger.info("Stopping the generator of free keys")
-        free_keys_generator_worker.stop()
+        sensor_tasks["free_keys_generator"] = _stop_free_keys_generator_worker
+    coordinator.run_stage("sensors", sensor_tasks)
 
-    # logger.info("Stopping sensors manager")
-    sensors_manager.stop()
+    logger.info("Flushing data aggregators %s", ", ".join(repr(agg.sensor_name) for agg in data_aggregators))
+    coordinator.run_stage(
+        "data_aggregators",
+        {data_aggregator.sensor_name: data_aggregator.flush_dataset for data_aggregator in data_aggregators},
+    )
 
-    # logger.info("Joining sensors manager")
-    sensors_manager.join()
+    logger.info("Flushing %d tarfile builder(s)", len(tarfile_aggregators))
+    coordinator.run_stage(
+        "tarfile_aggregators",
+        {str(idx): tarfile_aggregator.finalize_tarfile for idx, tarfile_aggregator in enumerate(tarfile_aggregators)},
+    )
 
-    for idx, data_aggregator in enumerate(data_aggregators, start=1):
-        logger.info("Flushing '%s' data aggregator" % data_aggregator.sensor_name)
-        data_aggregator.flush_dataset()
+    # Encryption workers must finish their job
+    coordinator.run_stage("encryption", dict(container_storage=container_storage.wait_for_idle_state))
 
-    for idx, tarfile_aggregator in enumerate(tarfile_aggregators, start=1):
-        logger.info(
-            "Flushing tarfile builder"
-            + (" #%d" % idx if (len(tarfile_aggregators) > 1) else "")
-        )
-        tarfile_aggregator.finalize_tarfile()
+    if coordinator.timed_out_stages:
+        toolchain["is_broken"] = True
 
-    container_storage.wait_for_idle_state()  # Encryption workers must finish their job
+    report = coordinator.get_report()
+    logger.info(
+        "Recording toolchain stopped in %.3fs (%s)",
+        report["total_duration_s"],
+        ", ".join("%s=%.3fs" % stage_duration for stage_duration in report["stage_durations_s"].items()),
+    )
+    logger.info("Pipeline statistics: %s", get_recording_toolchain_stats(toolchain))
 
-    # logger.info("stop_recording_toolchain exits")
+    if coordinator.errors:
+        raise coordinator.errors[0]
+    return report
@@ -0,0 +1,256 @@
+import threading
+import time
+from datetime import timezone, datetime
+
+from kivy.logger import Logger as logger
+
+from waclient.common_config import IS_ANDROID
+from waclient.utilities.bounded_queue import BoundedQueueWorker
+from wacryptolib.utilities import PeriodicTaskHandler, synchronized
+
+# Max count of encoded frames waiting for the tarfile aggregator
+CAMERA_FRAME_RING_SIZE = 10
+
+
+class AndroidFrameSource:
+    """
+    Wrapper around an Android legacy Camera, whose preview runs on an offscreen texture.
+
+    Preview frames are only transferred to python when a capture is requested (via a one-shot callback),
+    so that idle frames cost nothing. They are then encoded to JPEG by the Android framework.
+    """
+
+    capture_timeout_s = 2
+
+    def __init__(self, width=640, height=480):
+
+        from jnius import autoclass, PythonJavaClass, java_method
+
+        # Delayed creation, to avoid breakage at service launch
+        Camera = autoclass("android.hardware.Camera")
+        SurfaceTexture = autoclass("android.graphics.SurfaceTexture")
+        self._ImageFormat = autoclass("android.graphics.ImageFormat")
+        self._YuvImage = autoclass("android.graphics.YuvImage")
+        self._Rect = autoclass("android.graphics.Rect")
+        self._ByteArrayOutputStream = autoclass("java.io.ByteArrayOutputStream")
+
+        frame_source = self
+
+        class _PreviewCallback(PythonJavaClass):
+            __javainterfaces__ = ["android/hardware/Camera$PreviewCallback"]
+            __javacontext__ = "app"
+
+            @java_method("([BLandroid/hardware/Camera;)V")
+            def onPreviewFrame(self, data, camera):
+                frame_source._on_preview_frame(data)
+
+        self._preview_callback = _PreviewCallback()  # Must stay referenced on python side
+        self._frame_ready = threading.Event()
+        self._preview_data = None
+
+        camera = Camera.open()
+        parameters = camera.getParameters()
+        parameters.setPreviewSize(width, height)
+        camera.setParameters(parameters)
+        preview_size = camera.getParameters().getPreviewSize()  # Might differ from requested one
+        self._width, self._height = preview_size.width, preview_size.height
+        self._texture = SurfaceTexture(0)  # No display, but a preview target is mandatory
+        camera.setPreviewTexture(self._texture)
+        self._camera = camera
+
+    def _on_preview_frame(self, data):
+        self._preview_data = data
+        self._frame_ready.set()
+
+    def start(self):
+        self._camera.startPreview()
+
+    def stop(self):
+        self._camera.stopPreview()
+        self._camera.release()
+
+    def capture_frame(self, jpeg_quality: int) -> bytes:
+        """Return the next preview frame, encoded as JPEG, or None if the camera didn't deliver it in time."""
+        self._frame_ready.clear()
+        self._camera.setOneShotPreviewCallback(self._preview_callback)
+        if not self._frame_ready.wait(self.capture_timeout_s):
+            return None
+        yuv_image = self._YuvImage(self._preview_data, self._ImageFormat.NV21, self._width, self._height, None)
+        self._preview_data = None
+        output_stream = self._ByteArrayOutputStream()
+        yuv_image.compressToJpeg(self._Rect(0, 0, self._width, self._height), jpeg_quality, output_stream)
+        return bytes(output_stream.toByteArray())
+
+
+class FakeFrameSource:
+    """
+    Desktop stand-in for AndroidFrameSource, which outputs fake JPEG data, and simulates the time
+    taken by a capture, as well as the influence of resolution and quality on frame size.
+    """
+
+    simulated_capture_delay_s = 0.01
+
+    def __init__(self, width=640, height=480):
+        self._width = width
+        self._height = height
+        self._frame_index = 0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def capture_frame(self, jpeg_quality: int) -> bytes:
+        time.sleep(self.simulated_capture_delay_s)
+        self._frame_index += 1
+        # Roughly 0.1 byte per pixel at quality 10, and 1 byte per pixel at quality 100
+        payload_size = self._width * self._height * jpeg_quality // 100
+        payload = (b"fake_camera_frame_%d_" % self._frame_index).ljust(payload_size, b"\x00")
+        return b"\xff\xd8" + payload + b"\xff\xd9"  # JPEG SOI and EOI markers
+
+
+class CameraSensor(PeriodicTaskHandler):
+    """
+    Sensor which captures JPEG frames at `frame_rate` frames per second, pushed to a tarfile aggregator.
+
+    Encoded frames wait in a ring of `ring_size` frames (a BoundedQueueWorker dropping its oldest items),
+    drained by a background thread, so that memory stays bounded even if aggregation or encryption lags
+    behind (the latest frames are then kept).
+
+    Each capture has a budget of one frame period: when a capture overruns it, next captures are
+    skipped until the budget is recovered, so that the camera never uses more than a core.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(
+        self,
+        frame_rate: float,
+        tarfile_aggregator,
+        jpeg_quality: int = 70,
+        ring_size: int = CAMERA_FRAME_RING_SIZE,
+        frame_source=None,
+    ):
+        assert frame_rate > 0, frame_rate
+        assert 1 <= jpeg_quality <= 100, jpeg_quality
+        super().__init__(interval_s=1 / frame_rate)
+        self._tarfile_aggregator = tarfile_aggregator
+        self._jpeg_quality = jpeg_quality
+        self._frame_source = frame_source
+        self._current_frame_source = None
+        self._frame_ring = BoundedQueueWorker(
+            name="camera_frames",
+            consumer=self._push_frame_to_aggregator,
+            max_size=ring_size,
+            overflow_policy="drop_oldest",
+        )
+        self._next_capture_time = 0
+        self._captured_count = 0
+        self._failed_count = 0
+        self._skipped_count = 0
+
+    @property
+    def frame_stats(self):
+        """Counters of captured, failed and skipped (over budget) frames, and stats of the frame ring."""
+        return dict(
+            captured_count=self._captured_count,
+            failed_count=self._failed_count,
+            skipped_count=self._skipped_count,
+            ring=self._frame_ring.get_stats(),
+        )
+
+    def _create_frame_source(self):
+        if self._frame_source:
+            return self._frame_source
+        return AndroidFrameSource() if IS_ANDROID else FakeFrameSource()
+
+    @staticmethod
+    def _get_utc_now():
+        return datetime.now(tz=timezone.utc)  # TODO make datetime utility with TZ
+
+    def _push_frame_to_aggregator(self, frame):
+        # Member names only have a one-second resolution, so the frame index keeps them unique
+        self._tarfile_aggregator.add_record(
+            sensor_name="camera",
+            from_datetime=frame["capture_datetime"],
+            to_datetime=frame["capture_datetime"],
+            extension=".%06d.jpg" % frame["frame_index"],
+            data=frame["data"],
+        )
+
+    def _offloaded_run_task(self):
+        """
+        Full override of TaskRunnerStateMachineBase method, which captures a frame within the time budget.
+        """
+        start_time = time.monotonic()
+        if start_time < self._next_capture_time:
+            self._skipped_count += 1
+            return
+
+        with self._lock:
+            if not self.is_running:
+                return  # Thread looped one last time after sensor got stopped, forget about it
+            capture_datetime = self._get_utc_now()
+            try:
+                data = self._current_frame_source.capture_frame(jpeg_quality=self._jpeg_quality)
+            except Exception as exc:
+                logger.error("Error when capturing camera frame: %r" % exc, exc_info=True)
+                data = None
+
+            if data is None:
+                self._failed_count += 1
+            else:
+                self._captured_count += 1
+                frame = dict(capture_datetime=capture_datetime, frame_index=self._captured_count, data=data)
+                self._frame_ring.put(frame)  # Never blocks
+
+        # Overruns of the budget are paid back by skipping captures for as long
+        end_time = time.monotonic()
+        self._next_capture_time = end_time + max(0, end_time - start_time - self._interval_s)
+
+    @synchronized
+    def start(self):
+        logger.info("Starting camera")
+        self._current_frame_source = self._create_frame_source()
+        self._current_frame_source.start()
+        self._next_capture_time = 0
+        super().start()
+        logger.info("Started camera")
+
+    @synchronized
+    def stop(self):
+        super().stop()
+        logger.info("Stopping camera")
+        self._current_frame_source.stop()
+        self._current_frame_source = None
+        self._frame_ring.wait_until_empty()  # Frames belong to current container
+        logger.info(
+            "Stopped camera (%d frames captured, %d failed, %d skipped)",
+            self._captured_count,
+            self._failed_count,
+            self._skipped_count,
+        )
+
+
+def get_camera_sensor(
+    frame_rate, tarfile_aggregator, jpeg_quality=70, ring_size=CAMERA_FRAME_RING_SIZE, frame_source=None
+):
+    return CameraSensor(
+        frame_rate=frame_rate,
+        tarfile_aggregator=tarfile_aggregator,
+        jpeg_quality=jpeg_quality,
+        ring_size=ring_size,
+        frame_source=frame_source,
+    )
+
+
+def build_camera_sensor(toolchain):
+    """Sensor factory of the registry, which configures the camera from toolchain settings."""
+    settings = toolchain["settings"]
+    (tarfile_aggregator,) = toolchain["tarfile_aggregators"]
+    return get_camera_sensor(
+        frame_rate=settings["camera_frame_rate"],
+        tarfile_aggregator=tarfile_aggregator,
+        jpeg_quality=settings["camera_jpeg_quality"],
+    )
@@ -0,0 +1,12 @@
+"""
+Record layouts of polled sensors, importable without loading the sensors themselves (and their platform backends).
+"""
+
+GPS_FIELD_NAMES = ("lat", "lon", "altitude", "speed", "bearing", "accuracy")
+
+GPS_FIELD_SCALES = dict(lat=10 ** 7, lon=10 ** 7, altitude=100, speed=100, bearing=100, accuracy=100)
+
+# Last field is the polling interval in use when the sample was taken
+GYROSCOPE_FIELD_NAMES = ("rotation_rate_x", "rotation_rate_y", "rotation_rate_z", "polling_interval_s")
+
+GYROSCOPE_FIELD_SCALES = dict(polling_interval_s=1000)
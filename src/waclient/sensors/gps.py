@@ -1,9 +1,14 @@
 import importlib
 import threading
+import time
 
+from kivy.logger import Logger as logger
 from plyer import gps
 from plyer.utils import platform
 
+from waclient.sensors.fields import GPS_FIELD_NAMES, GPS_FIELD_SCALES
+from waclient.sensors.registry import get_data_aggregator
+from waclient.utilities.gps_decimation import GpsFixDecimator
 from wacryptolib.sensor import (
     PeriodicValueMixin,
 )
@@ -17,12 +22,29 @@ except ImportError:
 
 
 class GpsValueProvider(PeriodicValueMixin, TaskRunnerStateMachineBase):
+    """
+    Sensor receiving location updates from the GPS.
+
+    Status messages go to `status_aggregator` if provided (e.g. when locations go to a
+    ColumnarDataAggregator, which only handles numeric fields), else to the main json aggregator.
+
+    Locations are timestamped, then decimated (see GpsFixDecimator) according to `interval_s`,
+    `min_distance_m` and `max_error_m`, before being pushed to the json aggregator.
+    """
 
     _lock = threading.RLock()  # Recursive due to PC testcase...
 
-    def __init__(self, interval_s: float, **kwargs):
+    def __init__(self, interval_s: float, status_aggregator=None, min_distance_m=0, max_error_m=0, **kwargs):
         super().__init__(**kwargs)
         self._interval_s = interval_s
+        self._decimator = GpsFixDecimator(
+            output_callback=self._offloaded_add_data,
+            min_distance_m=min_distance_m,
+            min_time_s=self._get_min_time_between_fixes(interval_s),
+            max_error_m=max_error_m,
+        )
+        # Beware, empty aggregators are falsy
+        self._status_aggregator = self._json_aggregator if status_aggregator is None else status_aggregator
         if gps_is_implemented:
             try:
                 gps.configure(on_location=self._on_location, on_status=self._on_status)
@@ -38,7 +60,7 @@ class GpsValueProvider(PeriodicValueMixin, TaskRunnerStateMachineBase):
         (typically: lon, lat, speed, bearing, altitude, and accuracy)
         """
         if self.is_running:  # Else, its' a final call after a st_nominal_recording_toolchain_caseop()?
-            self._offloaded_add_data(data_dict=kwargs)
+            self._decimator.add_fix(dict(kwargs, timestamp=time.time()))
 
     @synchronized
     def _on_status(self, message_type, status):
@@ -48,10 +70,28 @@ class GpsValueProvider(PeriodicValueMixin, TaskRunnerStateMachineBase):
         (the latter having a status formatted as "provider: substatus".
         """
         if self.is_running:  # Else, its' a final call after a stop()?
-            self._offloaded_add_data(data_dict=dict(message_type=message_type, status=status))
+            self._status_aggregator.add_data(dict(message_type=message_type, status=status))
+
+    @property
+    def received_fixes_count(self):
+        return self._decimator.received_fixes_count
+
+    @property
+    def dropped_fixes_count(self):
+        return self._decimator.dropped_fixes_count
+
+    @staticmethod
+    def _get_min_time_between_fixes(interval_s):
+        return 0.8 * interval_s  # Tolerates some jitter in GPS callbacks
+
+    def set_polling_interval(self, interval_s):
+        """Change the interval used at next start, which also determines the min delay between kept fixes."""
+        self._interval_s = interval_s
+        self._decimator.min_time_s = self._get_min_time_between_fixes(interval_s)
 
     @synchronized
     def start(self):
+        self._decimator.reset()
         super().start()
         if gps_is_implemented:
             gps.start(
@@ -68,10 +108,30 @@ class GpsValueProvider(PeriodicValueMixin, TaskRunnerStateMachineBase):
         super().stop()
         if gps_is_implemented:
             gps.stop()
+        self._decimator.flush()  # Last position must not be lost
+        logger.info(
+            "GPS decimation dropped %d fixes out of %d", self.dropped_fixes_count, self.received_fixes_count
+        )
 
 
-def get_gps_sensor(json_aggregator, polling_interval_s):
+def get_gps_sensor(json_aggregator, polling_interval_s, status_aggregator=None, min_distance_m=0, max_error_m=0):
     sensor = GpsValueProvider(
-        interval_s=polling_interval_s, json_aggregator=json_aggregator
+        interval_s=polling_interval_s,
+        json_aggregator=json_aggregator,
+        status_aggregator=status_aggregator,
+        min_distance_m=min_distance_m,
+        max_error_m=max_error_m,
     )
     return sensor
+
+
+def build_gps_sensor(toolchain):
+    """Sensor factory of the registry, which configures the GPS from toolchain settings."""
+    settings = toolchain["settings"]
+    return get_gps_sensor(
+        polling_interval_s=settings["polling_interval_s"],
+        json_aggregator=get_data_aggregator(toolchain, "gps"),
+        status_aggregator=get_data_aggregator(toolchain, "gps_status", required=False),  # Only with binary encoding
+        min_distance_m=settings["gps_min_distance_m"],
+        max_error_m=settings["gps_max_error_m"],
+    )
@@ -1,9 +1,17 @@
+import functools
 import importlib
 import threading
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Optional
 
+from kivy.logger import Logger as logger
 from plyer import gyroscope
 from plyer.utils import platform
 
+from waclient.aggregators import ColumnarDataAggregator
+from waclient.sensors.fields import GYROSCOPE_FIELD_NAMES, GYROSCOPE_FIELD_SCALES
+from waclient.sensors.registry import get_data_aggregator
+from waclient.utilities.streaming_stats import ExponentialMovingVariance
 from wacryptolib.sensor import PeriodicValuePoller
 from wacryptolib.utilities import synchronized
 
@@ -15,12 +23,89 @@ except ImportError:
 
 
 class GyroscopeValueProvider(PeriodicValuePoller):
+    """
+    Sensor polling the rotation rates of the device.
+
+    Values are appended as-is to a ColumnarDataAggregator if one is used, else
+    they are pushed as dicts to the json aggregator.
+
+    In `adaptive_polling` mode, a streaming variance estimator runs on recent rotation rates: polling
+    jumps to `min_interval_s` as soon as this variance exceeds `motion_variance_threshold` (in (rad/s)²),
+    and the interval doubles at each idle poll, up to `max_interval_s`.
+
+    If provided, `motion_callback` is called (without arguments) when motion is detected this way, e.g. to
+    trigger the sealing of a pre-event buffer. It runs in a background thread, so that polling isn't delayed
+    by it, and it's not called again while a previous call is still in progress.
+    """
 
     _gyroscope_is_enabled = False
     _lock = threading.Lock()
+    _motion_callback_future = None
+
+    _variance_estimator_alpha = 0.3
+
+    def __init__(
+        self,
+        interval_s: float,
+        adaptive_polling: bool = False,
+        min_interval_s: Optional[float] = None,
+        max_interval_s: Optional[float] = None,
+        motion_variance_threshold: float = 0.01,
+        motion_callback=None,
+        **kwargs
+    ):
+        super().__init__(interval_s=interval_s, **kwargs)
+        self._adaptive_polling = adaptive_polling
+        self._min_interval_s = min_interval_s or interval_s
+        self._max_interval_s = max_interval_s or interval_s
+        assert 0 < self._min_interval_s <= self._max_interval_s, (self._min_interval_s, self._max_interval_s)
+        self._motion_variance_threshold = motion_variance_threshold
+        self._motion_callback = motion_callback
+        if motion_callback:
+            self._motion_callback_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gyroscope_motion")
+        self._variance_estimators = [
+            ExponentialMovingVariance(alpha=self._variance_estimator_alpha) for _ in range(3)
+        ]
+        self.set_polling_interval(interval_s)
+
+    @property
+    def polling_interval_s(self):
+        return self._interval_s
+
+    def set_polling_interval(self, interval_s):
+        """Change the base polling interval (in adaptive mode, it's only the initial interval, within bounds)."""
+        if self._adaptive_polling:
+            interval_s = min(max(interval_s, self._min_interval_s), self._max_interval_s)
+        self._initial_interval_s = interval_s
+        self._change_polling_interval(interval_s)
+
+    def _change_polling_interval(self, interval_s):
+        self._interval_s = interval_s
+        self._multitimer.interval = interval_s  # Also applies to running timer
+
+    def _compute_motion_variance(self, rotation_rate):
+        """Update variance estimators, and return their total (or None if values are unusable)."""
+        if None in rotation_rate:
+            return None  # Fake or incomplete values
+        return sum(
+            variance_estimator.update(value)
+            for (variance_estimator, value) in zip(self._variance_estimators, rotation_rate)
+        )
+
+    def _adapt_polling_interval(self, total_variance):
+        if total_variance >= self._motion_variance_threshold:
+            interval_s = self._min_interval_s
+        else:
+            interval_s = min(self._interval_s * 2, self._max_interval_s)  # Progressive back-off
+        if interval_s != self._interval_s:
+            logger.debug("Changing gyroscope polling interval to %ss (variance=%.4f)", interval_s, total_variance)
+            self._change_polling_interval(interval_s)
 
     @synchronized
     def start(self):
+        self._change_polling_interval(self._initial_interval_s)
+        for variance_estimator in self._variance_estimators:
+            variance_estimator.reset()
         super().start()
         if gyroscope_is_implemented:
             gyroscope.enable()
@@ -33,28 +118,84 @@ class GyroscopeValueProvider(PeriodicValuePoller):
             gyroscope.disable()
         self._gyroscope_is_enabled = False
 
+    @staticmethod
+    def _read_rotation_rate():
+        if gyroscope_is_implemented:
+            return gyroscope.rotation
+        return (None, None, None)  # Fake values
+
     @synchronized
     def _task_func(self):
         if not self.is_running:
             return  # End of recording
         assert self._gyroscope_is_enabled  # Sanity check for desktop platform
 
-        if gyroscope_is_implemented:
-            rotation_rate = gyroscope.rotation
-        else:
-            rotation_rate = (None, None, None)  # Fake values
+        rotation_rate = tuple(self._read_rotation_rate())
+        polling_interval_s = self._interval_s
+
+        if self._adaptive_polling or self._motion_callback:
+            total_variance = self._compute_motion_variance(rotation_rate)
+            if total_variance is not None:
+                if self._adaptive_polling:
+                    self._adapt_polling_interval(total_variance)
+                if self._motion_callback and total_variance >= self._motion_variance_threshold:
+                    self._notify_motion()
+
+        # print("> got rotation rate", rotation_rate)
+        return rotation_rate + (polling_interval_s,)
+
+    def _notify_motion(self):
+        if self._motion_callback_future and not self._motion_callback_future.done():
+            return  # Motion is already being handled
+        self._motion_callback_future = self._motion_callback_executor.submit(self._offloaded_call_motion_callback)
 
-        rotation_dict = {
-            "rotation_rate_x": rotation_rate[0],
-            "rotation_rate_y": rotation_rate[1],
-            "rotation_rate_z": rotation_rate[2],
-        }
-        # print("> got rotation rate", rotation_dict)
-        return rotation_dict
+    def _offloaded_call_motion_callback(self):
+        try:
+            self._motion_callback()
+        except Exception as exc:
+            logger.error("Error in motion callback of gyroscope: %r", exc, exc_info=True)
+
+    def _offloaded_add_data(self, values):
+        if values is None:
+            return  # Poll happened after stop()
+        if isinstance(self._json_aggregator, ColumnarDataAggregator):
+            self._json_aggregator.add_values(values)  # No intermediate dict
+        else:
+            self._json_aggregator.add_data(dict(zip(GYROSCOPE_FIELD_NAMES, values)))
 
 
-def get_gyroscope_sensor(json_aggregator, polling_interval_s):
+def get_gyroscope_sensor(
+    json_aggregator,
+    polling_interval_s,
+    adaptive_polling=False,
+    min_polling_interval_s=None,
+    max_polling_interval_s=None,
+    motion_callback=None,
+):
     sensor = GyroscopeValueProvider(
-        interval_s=polling_interval_s, json_aggregator=json_aggregator
+        interval_s=polling_interval_s,
+        json_aggregator=json_aggregator,
+        adaptive_polling=adaptive_polling,
+        min_interval_s=min_polling_interval_s,
+        max_interval_s=max_polling_interval_s,
+        motion_callback=motion_callback,
     )
     return sensor
+
+
+def build_gyroscope_sensor(toolchain):
+    """Sensor factory of the registry, which configures the gyroscope from toolchain settings."""
+    settings = toolchain["settings"]
+    motion_callback = None
+    if settings["recording_mode"] == "pre_event" and settings["pre_event_trigger"] == "motion":
+        from waclient.recording_toolchain import mark_recording_toolchain_event  # Avoid circular import
+
+        motion_callback = functools.partial(mark_recording_toolchain_event, toolchain)
+    return get_gyroscope_sensor(
+        json_aggregator=get_data_aggregator(toolchain, "gyroscope"),
+        polling_interval_s=settings["polling_interval_s"],
+        adaptive_polling=bool(settings["gyroscope_adaptive_polling"]),
+        min_polling_interval_s=settings["gyroscope_min_polling_interval_s"],
+        max_polling_interval_s=settings["gyroscope_max_polling_interval_s"],
+        motion_callback=motion_callback,
+    )
@@ -1,117 +1,260 @@
 import threading
+import time
+from collections import deque
+from concurrent.futures.thread import ThreadPoolExecutor
 from datetime import timezone, datetime
 
 from kivy.logger import Logger as logger
 
+from waclient.aggregators import SpoolingTarfileRecordsAggregator
 from waclient.common_config import IS_ANDROID, INTERNAL_CACHE_DIR
-from wacryptolib.sensor import TarfileRecordsAggregator
 from wacryptolib.utilities import PeriodicTaskHandler, synchronized
 
 
+class AndroidAudioRecorder:
+    """
+    Wrapper around an Android MediaRecorder, which records audio to a single output file.
+
+    The recorder is fully prepared at instantiation, so that `start()` is as fast as possible.
+    """
+
+    def __init__(self, output_path):
+
+        # See https://stackoverflow.com/questions/13974234/android-record-mic-to-bytearray-without-saving-audio-file/42750515 to bypass disk
+
+        from jnius import autoclass
+
+        # Delayed creation, o avoid berakage at service launch
+        MediaRecorder = autoclass("android.media.MediaRecorder")
+        AudioSource = autoclass("android.media.MediaRecorder$AudioSource")
+        OutputFormat = autoclass("android.media.MediaRecorder$OutputFormat")
+        AudioEncoder = autoclass("android.media.MediaRecorder$AudioEncoder")
+
+        self.output_path = output_path
+
+        # create out recorder
+        recorder = MediaRecorder()
+        self._recorder = recorder
+
+        recorder.setAudioSource(AudioSource.MIC)
+        recorder.setOutputFormat(OutputFormat.MPEG_4)
+        recorder.setAudioEncoder(
+            AudioEncoder.AAC
+        )  # Take OPUS Later (Added in API level 29)
+        recorder.setAudioSamplingRate(16000)
+        # mRecorder.setAudioEncodingBitRate(384000);
+
+        recorder.setOutputFile(str(output_path))
+        recorder.prepare()
+
+    def start(self):
+        self._recorder.start()
+
+    def stop(self):
+        self._recorder.stop()
+        self._recorder.release()
+
+    def release(self):
+        """Discard a recorder which was never started."""
+        self._recorder.release()
+
+
+class FakeAudioRecorder:
+    """
+    Desktop stand-in for AndroidAudioRecorder, which outputs fake audio data,
+    and simulates the time taken by the different steps of a real MediaRecorder.
+    """
+
+    simulated_prepare_delay_s = 0.03
+    simulated_start_delay_s = 0.01
+    simulated_stop_delay_s = 0.03
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        time.sleep(self.simulated_prepare_delay_s)
+
+    def start(self):
+        time.sleep(self.simulated_start_delay_s)
+
+    def stop(self):
+        time.sleep(self.simulated_stop_delay_s)
+        self.output_path.write_bytes(b"fake_microphone_recording_data")
+
+    def release(self):
+        pass
+
+
 class MicrophoneSensor(PeriodicTaskHandler):
+    """
+    Sensor which records audio in consecutive files of `interval_s` seconds, pushed to a tarfile aggregator.
 
-    _recorder = None  # Android MediaRecorder instance
+    In `double_buffered` mode, the next recorder is prepared ahead of time, and started
+    before the current one gets stopped, so that no audio is lost during rotations (on platforms
+    which don't support concurrent captures, the old recorder is stopped first, but the gap remains
+    short). Old recorders are finalized and pushed to aggregator by a background thread.
+
+    The delays between the end of a segment and the start of the next one are available
+    as `rotation_gaps_s` (negative values mean overlapping segments).
+    """
+
+    _recorder = None  # Current recorder instance
+    _next_recorder_future = None  # Only used in double-buffered mode
 
     _lock = threading.Lock()
     _current_start_time = None
+    _segment_index = 0
+
+    _rotation_gaps_history_size = 100
 
-    def __init__(self, interval_s: float, tarfile_aggregator: TarfileRecordsAggregator):
+    def __init__(
+        self, interval_s: float, tarfile_aggregator: SpoolingTarfileRecordsAggregator, double_buffered: bool = False
+    ):
         super().__init__(interval_s=interval_s, runonstart=False)
         self._tarfile_aggregator = tarfile_aggregator
+        self._double_buffered = double_buffered
+        self._rotation_gaps_s = deque(maxlen=self._rotation_gaps_history_size)
+        self._finalization_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="microphone_finalizer")
+        self._pending_finalizations = []
+        self._output_path_lock = threading.Lock()  # Paths are allocated by sensor and finalization threads
 
     @property
-    def temp_file_path(self):
-        return INTERNAL_CACHE_DIR.joinpath("temp_microphone_output_file.dat")
-
-    @property
-    def temp_file_path_finished(self):
-        return INTERNAL_CACHE_DIR.joinpath("temp_microphone_output_file.finished.dat")
+    def rotation_gaps_s(self):
+        return list(self._rotation_gaps_s)
+
+    def set_segment_duration(self, interval_s):
+        """Change the duration of audio segments, used at next start."""
+        self._interval_s = interval_s
+        self._multitimer.interval = interval_s
+
+    @staticmethod
+    def _create_recorder(output_path):
+        recorder_class = AndroidAudioRecorder if IS_ANDROID else FakeAudioRecorder
+        return recorder_class(output_path)
+
+    def _get_next_output_path(self):
+        with self._output_path_lock:
+            while True:
+                self._segment_index += 1
+                output_path = INTERNAL_CACHE_DIR.joinpath("temp_microphone_output_file.%d.dat" % self._segment_index)
+                if not output_path.exists():  # Else it's a former segment, still pending in aggregator
+                    return output_path
 
     def _cleanup_temp_files(self):
-        for filepath in (self.temp_file_path, self.temp_file_path_finished):
+        # Files of previous segments might still be owned by the aggregator (e.g. in a pre-event window)
+        pending_filepaths = self._tarfile_aggregator.get_pending_record_filepaths()
+        for filepath in INTERNAL_CACHE_DIR.glob("temp_microphone_output_file*"):
+            if filepath in pending_filepaths:
+                continue
             try:
                 filepath.unlink()  # TODO use missing_ok=True later
             except FileNotFoundError:
                 pass
 
-    def _do_start_recording(self):
+    @staticmethod
+    def _get_utc_now():
+        return datetime.now(tz=timezone.utc)  # TODO make datetime utility with TZ
 
-        if IS_ANDROID:
+    def _do_start_recording(self, recorder=None):
+        """Start the provided recorder, or a newly created one."""
+        recorder = recorder or self._create_recorder(self._get_next_output_path())
+        recorder.start()
+        self._recorder = recorder
+        self._current_start_time = self._get_utc_now()
 
-            # See https://stackoverflow.com/questions/13974234/android-record-mic-to-bytearray-without-saving-audio-file/42750515 to bypass disk
-
-            from jnius import autoclass
-
-            # Delayed creation, o avoid berakage at service launch
-            MediaRecorder = autoclass("android.media.MediaRecorder")
-            AudioSource = autoclass("android.media.MediaRecorder$AudioSource")
-            OutputFormat = autoclass("android.media.MediaRecorder$OutputFormat")
-            AudioEncoder = autoclass("android.media.MediaRecorder$AudioEncoder")
+    def _do_stop_recording(self):
+        """Stop current recorder, and return it along with its recording start and end times."""
+        recorder = self._recorder
+        from_datetime = self._current_start_time
+        to_datetime = self._get_utc_now()
+        recorder.stop()
+        self._recorder = None
+        self._current_start_time = None
+        return recorder, from_datetime, to_datetime
 
-            # create out recorder
-            recorder = MediaRecorder()
-            self._recorder = recorder
+    def _do_push_temporary_file_to_aggregator(self, recorder, from_datetime, to_datetime):
+        assert from_datetime and to_datetime, (from_datetime, to_datetime)
+        temp_file_path = recorder.output_path
+        if not temp_file_path.exists():
+            logger.warning("Temporary microphone file %r is missing" % temp_file_path.name)
+            return
+        # Aggregator takes ownership of the file, and streams it into its archive
+        self._tarfile_aggregator.add_record_from_file(
+            sensor_name="microphone",
+            from_datetime=from_datetime,
+            to_datetime=to_datetime,
+            extension=".mp4",  # Beware, change this if recorder output format changes!
+            filepath=temp_file_path,
+        )
 
-            recorder.setAudioSource(AudioSource.MIC)
-            recorder.setOutputFormat(OutputFormat.MPEG_4)
-            recorder.setAudioEncoder(
-                AudioEncoder.AAC
-            )  # Take OPUS Later (Added in API level 29)
-            recorder.setAudioSamplingRate(16000)
-            # mRecorder.setAudioEncodingBitRate(384000);
+    def _offloaded_prepare_next_recorder(self):
+        """Background task which returns a ready-to-start recorder, or None on error."""
+        try:
+            return self._create_recorder(self._get_next_output_path())
+        except Exception as exc:
+            logger.error("Error when preparing next microphone recorder: %r" % exc, exc_info=True)
+            return None
+
+    def _offloaded_finalize_recorder(self, recorder, from_datetime, next_start_time):
+        """Background task which stops an outdated recorder, and pushes its data."""
+        try:
+            to_datetime = self._get_utc_now()
+            recorder.stop()
+            self._rotation_gaps_s.append((next_start_time - to_datetime).total_seconds())
+            self._do_push_temporary_file_to_aggregator(
+                recorder, from_datetime=from_datetime, to_datetime=to_datetime
+            )
+        except Exception as exc:
+            logger.error("Error when finalizing microphone recorder: %r" % exc, exc_info=True)
 
-            recorder.setOutputFile(str(self.temp_file_path))
-            recorder.prepare()
-            recorder.start()
+    def _submit_next_recorder_preparation(self):
+        self._next_recorder_future = self._finalization_executor.submit(self._offloaded_prepare_next_recorder)
 
-        else:
-            pass  # Do nothing for now, on PC and such
+    def _pop_next_recorder(self):
+        next_recorder = self._next_recorder_future.result()  # Normally ready since long ago
+        self._next_recorder_future = None
+        return next_recorder
 
-        self._current_start_time = datetime.now(
-            tz=timezone.utc  # TODO make datetime utility with TZ
+    def _rotate_recorders_sequentially(self):
+        old_recorder, from_datetime, to_datetime = self._do_stop_recording()
+        self._do_start_recording()  # Must be restarted immediately, to avoid missing audio data
+        self._rotation_gaps_s.append((self._current_start_time - to_datetime).total_seconds())
+        self._do_push_temporary_file_to_aggregator(
+            old_recorder, from_datetime=from_datetime, to_datetime=to_datetime
         )
 
-    def _do_stop_recording(self):
+    def _rotate_recorders_with_double_buffering(self):
+        self._pending_finalizations = [f for f in self._pending_finalizations if not f.done()]
 
-        if IS_ANDROID:
-            recorder = self._recorder
-            recorder.stop()
-            recorder.release()
-            self._recorder = None
-        else:
-            # We fake the output of audio data by the media recorder
-            self.temp_file_path.write_bytes(b"fake_microphone_recording_data")
-
-        temp_file_path = self.temp_file_path
-        if temp_file_path.exists():
-            if (
-                self.temp_file_path_finished.exists()
-            ):  # Should have been deleted by data pusher
-                logger.warning(
-                    "Beware, microphone recorder unexpectedly overwrites temporary file %s"
-                    % self.temp_file_path_finished.name
-                )
-            temp_file_path.rename(self.temp_file_path_finished)
-        else:
+        old_recorder = self._recorder
+        old_start_time = self._current_start_time
+        next_recorder = self._pop_next_recorder() or self._create_recorder(self._get_next_output_path())
+
+        try:
+            self._do_start_recording(next_recorder)  # Both recorders are running now
+        except Exception as exc:
             logger.warning(
-                "Temporary microphone file %r is missing" % temp_file_path.name
+                "Concurrent microphone recorders seem unsupported, stopping old recorder first (%r)" % exc
+            )
+            self._recorder, self._current_start_time = old_recorder, old_start_time
+            self._rotate_recorders_sequentially()  # Next recorder can't be reused after a failed start
+            next_recorder.release()
+        else:
+            future = self._finalization_executor.submit(
+                self._offloaded_finalize_recorder,
+                old_recorder,
+                from_datetime=old_start_time,
+                next_start_time=self._current_start_time,
             )
+            self._pending_finalizations.append(future)
 
-        self._current_start_time = None
+        self._submit_next_recorder_preparation()
 
-    def _do_push_temporary_file_to_aggregator(self, from_datetime, to_datetime):
-        assert from_datetime and to_datetime, (from_datetime, to_datetime)
-        if not self.temp_file_path_finished.exists():
-            return  # Might be a user's manual action?
-        data = self.temp_file_path_finished.read_bytes()
-        self.temp_file_path_finished.unlink()  # Immediate safety
-        self._tarfile_aggregator.add_record(
-            sensor_name="microphone",
-            from_datetime=from_datetime,
-            to_datetime=to_datetime,
-            extension=".mp4",  # Beware, change this if recorder output format changes!
-            data=data,
-        )
+    def _rotate_recorders(self):
+        logger.info("Changing the output file of microphone recorder")
+        if self._double_buffered:
+            self._rotate_recorders_with_double_buffering()
+        else:
+            self._rotate_recorders_sequentially()
 
     @synchronized
     def _offloaded_run_task(self):
@@ -121,19 +264,20 @@ class MicrophoneSensor(PeriodicTaskHandler):
         """
         if not self.is_running:
             return  # Thread looped one last time after sensor got stopped, forget about it
+        self._rotate_recorders()
 
-        logger.info("Changing the output file of microphone recorder")
-        from_datetime = self._current_start_time
-        to_datetime = datetime.now(
-            tz=timezone.utc  # TODO make datetime utility with TZ
-        )
-
-        self._do_stop_recording()  # Renames target file
-        self._do_start_recording()  # Must be restarted immediately, to avoid missing audio data
-
-        self._do_push_temporary_file_to_aggregator(
-            from_datetime=from_datetime, to_datetime=to_datetime
-        )
+    @synchronized
+    def flush_current_segment(self):
+        """
+        Push the ongoing audio segment to the aggregator right away (e.g. before an event gets sealed),
+        and go on recording in a new segment.
+        """
+        if not self.is_running:
+            return
+        self._rotate_recorders()
+        for future in self._pending_finalizations:
+            future.result()  # Exceptions were already caught
+        self._pending_finalizations = []
 
     @synchronized
     def start(self):
@@ -142,6 +286,8 @@ class MicrophoneSensor(PeriodicTaskHandler):
         logger.info("Starting microphone media recorder")
         self._cleanup_temp_files()  # Security
         self._do_start_recording()
+        if self._double_buffered:
+            self._submit_next_recorder_preparation()
         logger.info("Started microphone media recorder")
 
     @synchronized
@@ -149,19 +295,33 @@ class MicrophoneSensor(PeriodicTaskHandler):
         super().stop()
 
         logger.info("Stopping microphone media recorder")
-        from_datetime = self._current_start_time
-        to_datetime = datetime.now(
-            tz=timezone.utc  # TODO make datetime utility with TZ
-        )
-        self._do_stop_recording()
+        recorder, from_datetime, to_datetime = self._do_stop_recording()
+        for future in self._pending_finalizations:
+            future.result()  # Previous segments must be pushed first (exceptions were already caught)
+        self._pending_finalizations = []
         self._do_push_temporary_file_to_aggregator(
-            from_datetime=from_datetime, to_datetime=to_datetime
+            recorder, from_datetime=from_datetime, to_datetime=to_datetime
         )
+        if self._next_recorder_future:
+            next_recorder = self._pop_next_recorder()
+            if next_recorder:
+                next_recorder.release()
         self._cleanup_temp_files()  # Double security
         logger.info("Stopped microphone media recorder")
 
 
-def get_microphone_sensor(interval_s, tarfile_aggregator):
+def get_microphone_sensor(interval_s, tarfile_aggregator, double_buffered=False):
     return MicrophoneSensor(
-        interval_s=interval_s, tarfile_aggregator=tarfile_aggregator
+        interval_s=interval_s, tarfile_aggregator=tarfile_aggregator, double_buffered=double_buffered
+    )
+
+
+def build_microphone_sensor(toolchain):
+    """Sensor factory of the registry, which records audio members directly into the tarfile aggregator."""
+    settings = toolchain["settings"]
+    (tarfile_aggregator,) = toolchain["tarfile_aggregators"]
+    return get_microphone_sensor(
+        interval_s=settings["container_member_duration_s"],
+        tarfile_aggregator=tarfile_aggregator,
+        double_buffered=bool(settings["microphone_double_buffering"]),
     )
@@ -0,0 +1,97 @@
+"""
+Registry of the sensors available to the recording toolchain.
+
+Each sensor is enabled by a config key (e.g. "record_gps"), and built by a factory receiving the toolchain dict.
+Factories may be given as "module:function" paths, so that a sensor module (and the platform backends
+it probes at import time) is only imported once this sensor is actually enabled.
+"""
+
+import importlib
+
+from waclient.common_config import warn_if_permission_missing
+
+_SENSOR_REGISTRY = {}
+
+
+def register_sensor(sensor_name: str, factory, permission=None, config_key=None, compressible_records=()):
+    """Make a sensor available to recording toolchains.
+
+    :param sensor_name: name of the sensor, also used as key in toolchain["sensors"]
+    :param factory: callable, or "module:function" path, which returns the sensor for a toolchain dict
+    :param permission: Android permission required by this sensor, if any
+    :param config_key: boolean setting enabling this sensor (defaults to "record_<sensor_name>")
+    :param compressible_records: names of the records of this sensor which benefit from compression
+        (already compressed media, like audio, gain nothing from it)
+    """
+    _SENSOR_REGISTRY[sensor_name] = dict(
+        factory=factory,
+        permission=permission,
+        config_key=config_key or "record_" + sensor_name,
+        compressible_records=tuple(compressible_records),
+    )
+
+
+def unregister_sensor(sensor_name: str):
+    del _SENSOR_REGISTRY[sensor_name]
+
+
+def get_registered_sensor_names() -> list:
+    return list(_SENSOR_REGISTRY)
+
+
+def get_sensor_config_key(sensor_name: str) -> str:
+    return _SENSOR_REGISTRY[sensor_name]["config_key"]
+
+
+def get_compressible_record_names() -> list:
+    """Return the names of records, among all registered sensors, which benefit from compression."""
+    return [
+        record_name
+        for sensor_entry in _SENSOR_REGISTRY.values()
+        for record_name in sensor_entry["compressible_records"]
+    ]
+
+
+def _resolve_factory(sensor_name):
+    sensor_entry = _SENSOR_REGISTRY[sensor_name]
+    factory = sensor_entry["factory"]
+    if isinstance(factory, str):
+        module_name, function_name = factory.split(":")
+        factory = getattr(importlib.import_module(module_name), function_name)
+        sensor_entry["factory"] = factory  # Cached for next builds
+    return factory
+
+
+def build_sensor(sensor_name: str, toolchain):
+    """Return the sensor `sensor_name` plugged to the aggregators of toolchain, or None if it's not allowed."""
+    permission = _SENSOR_REGISTRY[sensor_name]["permission"]
+    if permission and warn_if_permission_missing(permission):
+        return None
+    return _resolve_factory(sensor_name)(toolchain)
+
+
+def get_data_aggregator(toolchain, sensor_name, required=True):
+    """Return the data aggregator of toolchain dedicated to `sensor_name`, for use by sensor factories.
+
+    If no such aggregator exists, None is returned, unless `required` is True (then an error is raised).
+    """
+    data_aggregators = [
+        aggregator for aggregator in toolchain["data_aggregators"] if aggregator.sensor_name == sensor_name
+    ]
+    if not data_aggregators and not required:
+        return None
+    (data_aggregator,) = data_aggregators
+    return data_aggregator
+
+
+register_sensor(  # No need for specific permission!
+    "gyroscope", "waclient.sensors.gyroscope:build_gyroscope_sensor", compressible_records=("gyroscope",)
+)
+register_sensor(
+    "gps",
+    "waclient.sensors.gps:build_gps_sensor",
+    permission="ACCESS_FINE_LOCATION",
+    compressible_records=("gps", "gps_status"),
+)
+register_sensor("microphone", "waclient.sensors.microphone:build_microphone_sensor", permission="RECORD_AUDIO")
+register_sensor("camera", "waclient.sensors.camera:build_camera_sensor", permission="CAMERA")
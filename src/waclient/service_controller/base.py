@@ -33,8 +33,17 @@ class ServiceControllerBase:
     def stop_recording(self):
         self._send_message("/stop_recording")
 
+    def mark_event(self):
+        self._send_message("/mark_event")
+
     def broadcast_recording_state(self):
         self._send_message("/broadcast_recording_state")
 
+    def broadcast_pipeline_stats(self):
+        self._send_message("/broadcast_pipeline_stats")
+
     def attempt_container_decryption(self, container_filepath):
         self._send_message("/attempt_container_decryption", container_filepath)
+
+    def purge_all_containers(self):
+        self._send_message("/purge_all_containers")
@@ -0,0 +1,148 @@
+import inspect
+import threading
+import weakref
+from collections import deque
+from concurrent.futures.thread import ThreadPoolExecutor
+
+from kivy.logger import Logger as logger
+
+OVERFLOW_POLICIES = ("block", "drop_oldest", "decimate")
+
+
+class BoundedQueueWorker:
+    """
+    Bounded FIFO queue, whose items are passed one by one to `consumer` by a background thread,
+    so that producers don't wait for the consumer unless the queue is full.
+
+    When `max_size` items are already waiting, the `overflow_policy` applies:
+
+    - "block": the producer waits for a free slot (no data loss, backpressure goes up to the producer)
+    - "drop_oldest": the oldest waiting item is discarded
+    - "decimate": every other waiting item is discarded, so that waiting items still span the same
+      period of time, at half the rate
+
+    Discarded items are passed to `on_drop` if provided (e.g. to release their resources).
+    Exceptions raised by `consumer` or `on_drop` are logged and swallowed.
+
+    Callbacks which are bound methods are weakly referenced, so that the queue doesn't keep its owner alive
+    (e.g. a container storage, whose executor is shut down on deletion). The worker thread exits when
+    this object gets garbage collected.
+    """
+
+    def __init__(self, name: str, consumer, max_size: int, overflow_policy: str = "block", on_drop=None):
+        assert max_size > 0, max_size
+        assert overflow_policy in OVERFLOW_POLICIES, overflow_policy
+        self._name = name
+        self._get_consumer = self._make_callback_getter(consumer)
+        self._max_size = max_size
+        self._overflow_policy = overflow_policy
+        self._get_on_drop = self._make_callback_getter(on_drop)
+        self._items = deque()
+        self._condition = threading.Condition()
+        self._is_draining = False  # True while the worker thread processes items
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="%s_queue" % name)
+        self._enqueued_count = 0
+        self._processed_count = 0
+        self._dropped_count = 0
+        self._blocked_count = 0
+        self._max_depth = 0
+
+    def __len__(self):
+        with self._condition:
+            return len(self._items)
+
+    @property
+    def name(self):
+        return self._name
+
+    @staticmethod
+    def _make_callback_getter(callback):
+        if inspect.ismethod(callback):
+            return weakref.WeakMethod(callback)  # Returns None once owner is deleted
+        return lambda: callback
+
+    def _drop_items(self, items):
+        on_drop = self._get_on_drop()
+        for item in items:
+            if on_drop:
+                try:
+                    on_drop(item)
+                except Exception as exc:
+                    logger.error("Error when discarding item of %r queue: %r", self._name, exc, exc_info=True)
+
+    def _make_room(self):
+        """Apply the overflow policy, and return the items discarded from the (full) queue."""
+        if self._overflow_policy == "block":
+            self._blocked_count += 1
+            self._condition.wait_for(lambda: len(self._items) < self._max_size)
+            return []
+        if self._overflow_policy == "drop_oldest":
+            return [self._items.popleft()]
+        items = list(self._items)
+        kept_items = items[-1::-2][::-1]  # Newest item is always kept, whatever the parity of the queue size
+        dropped_items = items[-2::-2][::-1]
+        if not dropped_items:  # Single waiting item
+            return [self._items.popleft()]
+        self._items.clear()
+        self._items.extend(kept_items)
+        return dropped_items
+
+    def put(self, item):
+        """Append an item to the queue, applying the overflow policy if it is full."""
+        with self._condition:
+            dropped_items = []
+            if len(self._items) >= self._max_size:
+                dropped_items = self._make_room()
+                self._dropped_count += len(dropped_items)
+            self._items.append(item)
+            self._enqueued_count += 1
+            self._max_depth = max(self._max_depth, len(self._items))
+            if not self._is_draining:
+                self._is_draining = True
+                self._executor.submit(self._offloaded_drain_items)
+        if dropped_items:
+            logger.warning("Queue %r is full, %d item(s) were dropped", self._name, len(dropped_items))
+            self._drop_items(dropped_items)
+
+    def _offloaded_drain_items(self):
+        while True:
+            with self._condition:
+                if not self._items:
+                    self._is_draining = False
+                    self._condition.notify_all()
+                    return
+                item = self._items.popleft()
+                self._condition.notify_all()  # A slot is free for blocked producers
+            consumer = self._get_consumer()
+            if consumer is None:  # Owner is being deleted
+                with self._condition:
+                    self._dropped_count += 1
+                self._drop_items([item])
+                continue
+            try:
+                consumer(item)
+            except Exception as exc:
+                logger.error("Error when consuming item of %r queue: %r", self._name, exc, exc_info=True)
+            with self._condition:
+                self._processed_count += 1
+
+    def wait_until_empty(self, timeout_s=None) -> bool:
+        """
+        Wait until all queued items have been processed, and return True on success,
+        or False on timeout. Must not be called by the consumer itself.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._items and not self._is_draining, timeout=timeout_s)
+
+    def get_stats(self) -> dict:
+        with self._condition:
+            return dict(
+                overflow_policy=self._overflow_policy,
+                max_size=self._max_size,
+                depth=len(self._items),
+                max_depth=self._max_depth,
+                enqueued_count=self._enqueued_count,
+                processed_count=self._processed_count,
+                dropped_count=self._dropped_count,
+                blocked_count=self._blocked_count,
+            )
@@ -0,0 +1,84 @@
+"""
+Utilities to compress records before encryption, and to transparently decompress them afterwards.
+
+The "zstd" codec requires the optional `zstandard` package.
+"""
+
+import gzip
+import lzma
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_CODECS = ("none", "gzip", "xz", "zstd")
+
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "xz": ".xz", "zstd": ".zst"}
+
+_COMPRESSION_MAGIC_NUMBERS = {"gzip": b"\x1f\x8b", "xz": b"\xfd7zXZ\x00", "zstd": b"\x28\xb5\x2f\xfd"}
+
+_MAGIC_NUMBER_MAX_LENGTH = max(len(magic) for magic in _COMPRESSION_MAGIC_NUMBERS.values())
+
+
+def is_compression_codec_available(codec: str) -> bool:
+    assert codec in COMPRESSION_CODECS, codec
+    return codec != "zstd" or zstandard is not None
+
+
+def compress_data(data: bytes, codec: str) -> bytes:
+    """Compress a bytestring with the given codec (levels favour speed, since we run on phones)."""
+    assert is_compression_codec_available(codec), codec
+    if codec == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    elif codec == "xz":
+        return lzma.compress(data, preset=3)
+    elif codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def detect_compression_codec(header: bytes):
+    """Return the codec matching the first bytes of a stream, or None if it isn't compressed (or unknown)."""
+    for codec, magic in _COMPRESSION_MAGIC_NUMBERS.items():
+        if header.startswith(magic):
+            return codec
+    return None
+
+
+def _peek_header(fileobj) -> bytes:
+    if hasattr(fileobj, "peek"):  # E.g. buffered streams, like tarfile members in streaming mode
+        return fileobj.peek(_MAGIC_NUMBER_MAX_LENGTH)[:_MAGIC_NUMBER_MAX_LENGTH]
+    position = fileobj.tell()
+    header = fileobj.read(_MAGIC_NUMBER_MAX_LENGTH)
+    fileobj.seek(position)
+    return header
+
+
+def open_decompressed_stream(fileobj, codec=None):
+    """
+    Return a readable stream of the decompressed content of `fileobj`, or `fileobj` itself if it's not compressed.
+
+    If `codec` is not provided, it's detected from the first bytes of `fileobj`, which must then be
+    seekable (or peekable).
+    """
+    if codec is None:
+        codec = detect_compression_codec(_peek_header(fileobj))
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    elif codec == "xz":
+        return lzma.LZMAFile(fileobj, mode="rb")
+    elif codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("The zstandard package is required to decompress zstd data")
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    return fileobj
+
+
+def split_compression_extension(filename: str) -> tuple:
+    """Return `filename` without its compression extension, and the matching codec (or "none")."""
+    for codec, extension in COMPRESSION_EXTENSIONS.items():
+        if filename.endswith(extension):
+            return filename[: -len(extension)], codec
+    return filename, "none"
+
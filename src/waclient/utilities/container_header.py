@@ -0,0 +1,141 @@
+"""
+Utilities to read the "header" of a container (keychain uid, encryption strata, metadata...), without
+loading its ciphertext, which is skipped while streaming the JSON document.
+"""
+
+import json
+from pathlib import Path
+
+from wacryptolib.utilities import load_from_json_bytes
+
+CONTAINER_HEADER_SKIPPED_KEYS = ("data_ciphertext",)
+
+_SCALAR_END_CHARS = b",}] \t\r\n"
+
+_WHITESPACE_CHARS = b" \t\r\n"
+
+
+class _JsonStreamScanner:
+    """
+    Minimal scanner of a JSON byte stream, which can capture or skip whole values, chunk by chunk.
+
+    Strings, which contain the bulk of containers (base64 ciphertexts), are jumped over with bytes searches
+    instead of being walked byte by byte.
+    """
+
+    def __init__(self, fileobj, chunk_size):
+        self._fileobj = fileobj
+        self._chunk_size = chunk_size
+        self._buffer = b""
+        self._pos = 0
+
+    def _ensure_buffer(self):
+        if self._pos >= len(self._buffer):
+            self._buffer = self._fileobj.read(self._chunk_size)
+            self._pos = 0
+            if not self._buffer:
+                raise ValueError("Unexpected end of JSON stream")
+
+    def peek_char(self) -> bytes:
+        """Return the next non-whitespace char, without consuming it."""
+        while True:
+            self._ensure_buffer()
+            char = self._buffer[self._pos : self._pos + 1]
+            if char not in _WHITESPACE_CHARS:
+                return char
+            self._pos += 1
+
+    def read_char(self) -> bytes:
+        char = self.peek_char()
+        self._pos += 1
+        return char
+
+    def expect_char(self, expected_char: bytes):
+        char = self.read_char()
+        if char != expected_char:
+            raise ValueError("Expected %r in JSON stream, got %r" % (expected_char, char))
+
+    def _scan_string(self, pieces):
+        self.expect_char(b'"')
+        if pieces is not None:
+            pieces.append(b'"')
+        while True:
+            self._ensure_buffer()
+            end = self._buffer.find(b'"', self._pos)
+            if end < 0:
+                end = len(self._buffer)
+            backslash_index = self._buffer.find(b"\\", self._pos, end)
+            if backslash_index >= 0:
+                end = backslash_index
+            if pieces is not None:
+                pieces.append(self._buffer[self._pos : end])
+            self._pos = end
+            if end == len(self._buffer):
+                continue  # Next chunk
+            special_char = self._buffer[end : end + 1]
+            self._pos += 1
+            if pieces is not None:
+                pieces.append(special_char)
+            if special_char == b'"':
+                return
+            self._ensure_buffer()  # Escaped char might be in next chunk
+            if pieces is not None:
+                pieces.append(self._buffer[self._pos : self._pos + 1])
+            self._pos += 1
+
+    def scan_value(self, capture=True):
+        """Consume the next JSON value, and return its raw bytes (or None if `capture` is False)."""
+        pieces = [] if capture else None
+        char = self.peek_char()
+        if char == b'"':
+            self._scan_string(pieces)
+        elif char in (b"{", b"["):
+            depth = 0
+            while True:
+                char = self.peek_char()
+                if char == b'"':
+                    self._scan_string(pieces)
+                    continue
+                self._pos += 1
+                if pieces is not None:
+                    pieces.append(char)
+                if char in (b"{", b"["):
+                    depth += 1
+                elif char in (b"}", b"]"):
+                    depth -= 1
+                    if not depth:
+                        break
+        else:  # Number, boolean or null
+            while True:
+                self._ensure_buffer()
+                char = self._buffer[self._pos : self._pos + 1]
+                if char in _SCALAR_END_CHARS:
+                    break
+                self._pos += 1
+                if pieces is not None:
+                    pieces.append(char)
+        return b"".join(pieces) if capture else None
+
+
+def load_container_header(container_filepath: Path, skipped_keys=CONTAINER_HEADER_SKIPPED_KEYS, chunk_size=64 * 1024):
+    """Load a container from its JSON file, without the top-level fields `skipped_keys` (i.e. its ciphertext).
+
+    Skipped fields are never held in memory, be their values inline ciphertexts or markers of offloaded ones.
+    Other fields are decoded like by `load_container_from_filesystem()`.
+    """
+    header_fields = []
+    with open(container_filepath, "rb") as fileobj:
+        scanner = _JsonStreamScanner(fileobj, chunk_size=chunk_size)
+        scanner.expect_char(b"{")
+        if scanner.peek_char() == b"}":
+            return {}
+        while True:
+            key = json.loads(scanner.scan_value().decode("utf8"))
+            scanner.expect_char(b":")
+            is_skipped = key in skipped_keys
+            raw_value = scanner.scan_value(capture=not is_skipped)
+            if not is_skipped:
+                header_fields.append(b"%s:%s" % (json.dumps(key).encode("utf8"), raw_value))
+            if scanner.read_char() == b"}":
+                break  # Trailing data is ignored
+    return load_from_json_bytes(b"{" + b",".join(header_fields) + b"}")
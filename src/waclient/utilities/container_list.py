@@ -0,0 +1,90 @@
+"""
+Paged listing of container files, to feed virtualized GUI lists without stat-ing whole directories.
+"""
+
+import os
+from pathlib import Path
+
+from wacryptolib.container import CONTAINER_SUFFIX
+
+CONTAINER_LIST_PAGE_SIZE = 100
+
+
+class ContainerListSource:
+    """
+    Sorted list of the container files of a directory, served page by page.
+
+    Refreshing only lists filenames (sorted by name, i.e. by date for recorded containers), whereas
+    file sizes are only fetched for the pages actually requested, and cached as long as files remain.
+    """
+
+    def __init__(self, containers_dir, page_size=CONTAINER_LIST_PAGE_SIZE, reverse=True):
+        assert page_size > 0, page_size
+        self._containers_dir = Path(containers_dir)
+        self._page_size = page_size
+        self._reverse = reverse
+        self._container_names = []
+        self._size_cache = {}
+
+    def __len__(self):
+        return len(self._container_names)
+
+    @property
+    def page_size(self):
+        return self._page_size
+
+    @property
+    def pages_count(self):
+        return -(-len(self._container_names) // self._page_size)
+
+    def set_sorting(self, reverse: bool):
+        """Change the sorting order of names (most recent containers first, by default)."""
+        if reverse != self._reverse:
+            self._reverse = reverse
+            self._container_names.reverse()
+
+    def refresh(self):
+        """Rescan the containers directory, and return the new count of containers."""
+        try:
+            with os.scandir(self._containers_dir) as dir_entries:
+                container_names = [
+                    dir_entry.name
+                    for dir_entry in dir_entries
+                    if dir_entry.name.endswith(CONTAINER_SUFFIX) and dir_entry.is_file()
+                ]
+        except FileNotFoundError:
+            container_names = []
+        container_names.sort(reverse=self._reverse)
+        existing_container_names = set(container_names)
+        self._size_cache = {
+            container_name: size
+            for (container_name, size) in self._size_cache.items()
+            if container_name in existing_container_names
+        }
+        self._container_names = container_names
+        return len(container_names)
+
+    def _get_container_size(self, container_name):
+        size = self._size_cache.get(container_name)
+        if size is None:
+            try:
+                size = self._containers_dir.joinpath(container_name).stat().st_size
+            except FileNotFoundError:
+                size = 0  # Deleted since last refresh
+            self._size_cache[container_name] = size
+        return size
+
+    def get_rows(self, start: int, end: int) -> list:
+        """Return dicts (name, path, file_size) describing the containers in the slice [start:end] of the list."""
+        return [
+            dict(
+                name=container_name,
+                path=str(self._containers_dir.joinpath(container_name)),
+                file_size=self._get_container_size(container_name),
+            )
+            for container_name in self._container_names[start:end]
+        ]
+
+    def get_page(self, page_index: int) -> list:
+        start = page_index * self._page_size
+        return self.get_rows(start, start + self._page_size)
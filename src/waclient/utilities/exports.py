@@ -0,0 +1,41 @@
+"""
+Utilities to export the content of decrypted containers as human-readable files, chunk by chunk.
+"""
+
+import shutil
+import tarfile
+from pathlib import Path
+
+from waclient.utilities.compression import open_decompressed_stream, split_compression_extension
+from waclient.utilities.sensor_data import SENSOR_DATA_EXTENSION, convert_sensor_data_file_to_json
+
+EXPORT_CHUNK_SIZE = 256 * 1024
+
+
+def export_tarfile_stream(fileobj, target_directory: Path, chunk_size=EXPORT_CHUNK_SIZE) -> list:
+    """
+    Extract the members of the (possibly compressed) tar archive `fileobj` into `target_directory`,
+    with compressed members (i.e. those with the extension of a compression codec) being decompressed,
+    and binary sensor data converted to json.
+
+    The archive is read sequentially (`fileobj` must just be seekable or peekable), and each member is written
+    to disk chunk by chunk, so that memory usage doesn't depend on the size of the archive.
+
+    Members are flattened to their basename (archives built by aggregators have no subfolders anyway), and
+    special members (directories, links...) are ignored. Returns the paths of exported files.
+    """
+    exported_filepaths = []
+    with tarfile.open(mode="r|", fileobj=open_decompressed_stream(fileobj), bufsize=chunk_size) as tarfile_obj:
+        for member in tarfile_obj:
+            if not member.isfile():
+                continue
+            # Content is not sniffed, since uncompressed members (e.g. raw media) might look compressed
+            member_filename, codec = split_compression_extension(Path(member.name).name)
+            member_stream = open_decompressed_stream(tarfile_obj.extractfile(member), codec=codec)
+            member_filepath = target_directory.joinpath(member_filename)
+            with open(member_filepath, "wb") as member_file:
+                shutil.copyfileobj(member_stream, member_file, chunk_size)
+            if member_filepath.suffix == SENSOR_DATA_EXTENSION:  # Small enough to be converted in memory
+                member_filepath = convert_sensor_data_file_to_json(member_filepath)
+            exported_filepaths.append(member_filepath)
+    return exported_filepaths
@@ -0,0 +1,125 @@
+import math
+
+EARTH_RADIUS_M = 6371000
+
+
+def _project_to_plane_m(origin, point):
+    """Equirectangular projection of (lat, lon) `point` around `origin`, as (x, y) in meters.
+
+    Precise enough for the short distances between consecutive GPS fixes."""
+    origin_lat, origin_lon = origin
+    lat, lon = point
+    x = math.radians(lon - origin_lon) * math.cos(math.radians((lat + origin_lat) / 2)) * EARTH_RADIUS_M
+    y = math.radians(lat - origin_lat) * EARTH_RADIUS_M
+    return x, y
+
+
+def get_distance_m(point1, point2):
+    """Return the approximate distance in meters between two (lat, lon) points."""
+    x, y = _project_to_plane_m(point1, point2)
+    return math.hypot(x, y)
+
+
+def get_distance_to_segment_m(point, segment_start, segment_end):
+    """Return the approximate distance in meters between a (lat, lon) point and a segment."""
+    px, py = _project_to_plane_m(segment_start, point)
+    ex, ey = _project_to_plane_m(segment_start, segment_end)
+    segment_length_squared = ex * ex + ey * ey
+    if not segment_length_squared:
+        return math.hypot(px, py)
+    ratio = min(max((px * ex + py * ey) / segment_length_squared, 0), 1)
+    return math.hypot(px - ratio * ex, py - ratio * ey)
+
+
+class GpsFixDecimator:
+    """
+    Streaming filter for GPS fixes (dicts with "lat" and "lon" keys), which forwards only
+    the fixes needed to reconstruct the track to `output_callback`.
+
+    - A fix is dropped if it comes less than `min_time_s` seconds after the previous kept fix,
+      or less than `min_distance_m` meters away from it.
+    - Remaining fixes go through an online Douglas-Peucker simplifier ("opening window" variant):
+      a fix is only emitted when the track can't be approximated anymore, within `max_error_m` meters,
+      by a straight segment from the last emitted fix. A `max_error_m` of 0 disables this stage.
+
+    Since the latest fix may be held back by the simplifier, `flush()` must be called at the end of the track.
+    Fixes without coordinates are forwarded immediately.
+
+    Fixes must carry a "timestamp" key (epoch seconds), since they may be forwarded later. Thresholds
+    can be changed between fixes, via the attributes of the same name. This class is not thread-safe.
+    """
+
+    def __init__(self, output_callback, min_distance_m=0, min_time_s=0, max_error_m=0):
+        self._output_callback = output_callback
+        self.min_distance_m = min_distance_m
+        self.min_time_s = min_time_s
+        self.max_error_m = max_error_m
+        self.reset()
+
+    def reset(self):
+        self._last_filtered_fix = None  # Last fix which went through the min distance/time filter
+        self._anchor_fix = None  # Last emitted fix of the track
+        self._window_fixes = []  # Fixes received after the anchor, not emitted yet
+        self.received_fixes_count = 0
+        self.dropped_fixes_count = 0
+
+    @staticmethod
+    def _get_point(fix):
+        return fix["lat"], fix["lon"]
+
+    def _emit(self, fix):
+        self._output_callback(fix)
+
+    def _is_filtered_out(self, fix):
+        last_fix = self._last_filtered_fix
+        if last_fix is None:
+            return False
+        if fix["timestamp"] - last_fix["timestamp"] < self.min_time_s:
+            return True
+        return get_distance_m(self._get_point(last_fix), self._get_point(fix)) < self.min_distance_m
+
+    def _window_fits_segment(self, segment_end_fix):
+        segment_start = self._get_point(self._anchor_fix)
+        segment_end = self._get_point(segment_end_fix)
+        return all(
+            get_distance_to_segment_m(self._get_point(fix), segment_start, segment_end) <= self.max_error_m
+            for fix in self._window_fixes
+        )
+
+    def add_fix(self, fix: dict):
+        """Process a new fix, which may be forwarded now, later or never."""
+        self.received_fixes_count += 1
+
+        if fix.get("lat") is None or fix.get("lon") is None:
+            self._emit(fix)
+            return
+
+        if self._is_filtered_out(fix):
+            self.dropped_fixes_count += 1
+            return
+        self._last_filtered_fix = fix
+
+        if self._anchor_fix is None or not self.max_error_m:
+            self._anchor_fix = fix
+            self._emit(fix)
+            return
+
+        if self._window_fits_segment(fix):
+            self._window_fixes.append(fix)  # Might become useless
+            return
+
+        # The previous fix is needed to follow the track, so it becomes the new anchor
+        new_anchor_fix = self._window_fixes.pop()
+        self.dropped_fixes_count += len(self._window_fixes)
+        self._anchor_fix = new_anchor_fix
+        self._window_fixes = [fix]
+        self._emit(new_anchor_fix)
+
+    def flush(self):
+        """Emit the fix ending the current track, if it was held back, and start a new track."""
+        if self._window_fixes:
+            self.dropped_fixes_count += len(self._window_fixes) - 1
+            self._emit(self._window_fixes[-1])
+        self._anchor_fix = None
+        self._window_fixes = []
+        self._last_filtered_fix = None
@@ -0,0 +1,36 @@
+import threading
+from collections import OrderedDict
+
+
+class LruCache:
+    """
+    Thread-safe mapping which keeps at most `max_size` items, by evicting the least recently used ones.
+    """
+
+    def __init__(self, max_size: int):
+        assert max_size > 0, max_size
+        self._max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
@@ -0,0 +1,149 @@
+"""
+Compact binary encoding for numeric time series of sensors, used as an alternative to json members.
+
+Layout (all integers little-endian):
+
+- header: magic "WASD", format version (u8), columns count (u8), samples count (u32)
+- then for each column: name length (u8), utf8 name, fixed-point scale (f64),
+  typecode of deltas (1 char among b/h/i/q), missing values flag (u8), first value (i64),
+  then a bitmap of missing values (if flag is set), then the packed deltas between
+  consecutive values.
+
+Values are stored as `round(value * scale)` integers, so the precision of a column is `1 / scale`.
+"""
+
+import json
+import math
+import struct
+import sys
+from array import array
+from pathlib import Path
+
+SENSOR_DATA_MAGIC = b"WASD"
+SENSOR_DATA_FORMAT_VERSION = 1
+SENSOR_DATA_EXTENSION = ".wasd"
+
+_HEADER_STRUCT = struct.Struct("<4sBBI")
+_COLUMN_STRUCT = struct.Struct("<dcBq")
+_DELTA_TYPECODES = ("b", "h", "i", "q")  # Narrowest type which fits all deltas is chosen
+
+
+def _pack_array(values_array):
+    if sys.byteorder == "big":
+        values_array.byteswap()
+    return values_array.tobytes()
+
+
+def _unpack_array(typecode, data):
+    values_array = array(typecode)
+    values_array.frombytes(data)
+    if sys.byteorder == "big":
+        values_array.byteswap()
+    return values_array
+
+
+def _encode_column(name, values, scale):
+    fixed_values = []
+    missing_bits = bytearray((len(values) + 7) // 8)
+    previous_fixed_value = 0
+    for idx, value in enumerate(values):
+        if value is None or not math.isfinite(value):  # Infinities can't be stored as fixed-point
+            missing_bits[idx // 8] |= 1 << (idx % 8)
+            fixed_values.append(previous_fixed_value)  # Keeps delta at 0
+        else:
+            previous_fixed_value = round(value * scale)
+            fixed_values.append(previous_fixed_value)
+    has_missing_values = any(missing_bits)
+
+    deltas = [(next_value - value) for (value, next_value) in zip(fixed_values, fixed_values[1:])]
+    max_abs_delta = max((abs(delta) for delta in deltas), default=0)
+    for typecode in _DELTA_TYPECODES:
+        itemsize = array(typecode).itemsize
+        if max_abs_delta < 2 ** (8 * itemsize - 1):
+            break
+    else:
+        raise ValueError("Fixed-point values of column %r are too large" % name)
+
+    encoded_name = name.encode("utf8")
+    chunks = [
+        struct.pack("<B", len(encoded_name)),
+        encoded_name,
+        _COLUMN_STRUCT.pack(scale, typecode.encode("ascii"), has_missing_values, fixed_values[0] if values else 0),
+    ]
+    if has_missing_values:
+        chunks.append(bytes(missing_bits))
+    chunks.append(_pack_array(array(typecode, deltas)))
+    return b"".join(chunks)
+
+
+def encode_sensor_data(columns: dict, scales: dict) -> bytes:
+    """
+    Encode a dict of equal-length columns of numbers (None, NaN or infinities meaning "missing value"),
+    using the fixed-point scale given for each column in `scales`.
+    """
+    lengths = set(len(values) for values in columns.values())
+    assert len(lengths) <= 1, "Columns must have the same length"
+    samples_count = lengths.pop() if lengths else 0
+    chunks = [_HEADER_STRUCT.pack(SENSOR_DATA_MAGIC, SENSOR_DATA_FORMAT_VERSION, len(columns), samples_count)]
+    for name, values in columns.items():
+        chunks.append(_encode_column(name, values=values, scale=scales[name]))
+    return b"".join(chunks)
+
+
+def decode_sensor_data(data: bytes) -> dict:
+    """
+    Decode the output of `encode_sensor_data()` into a dict of lists of floats (NaN for missing values).
+    """
+    magic, format_version, columns_count, samples_count = _HEADER_STRUCT.unpack_from(data, 0)
+    if magic != SENSOR_DATA_MAGIC:
+        raise ValueError("Not a binary sensor data file")
+    if format_version != SENSOR_DATA_FORMAT_VERSION:
+        raise ValueError("Unsupported binary sensor data version %d" % format_version)
+    offset = _HEADER_STRUCT.size
+
+    columns = {}
+    for _ in range(columns_count):
+        (name_length,) = struct.unpack_from("<B", data, offset)
+        offset += 1
+        name = data[offset : offset + name_length].decode("utf8")
+        offset += name_length
+        scale, typecode, has_missing_values, fixed_value = _COLUMN_STRUCT.unpack_from(data, offset)
+        offset += _COLUMN_STRUCT.size
+
+        missing_bits = None
+        if has_missing_values:
+            missing_bits_length = (samples_count + 7) // 8
+            missing_bits = data[offset : offset + missing_bits_length]
+            offset += missing_bits_length
+
+        typecode = typecode.decode("ascii")
+        deltas_length = max(samples_count - 1, 0) * array(typecode).itemsize
+        deltas = _unpack_array(typecode, data[offset : offset + deltas_length])
+        offset += deltas_length
+
+        values = []
+        if samples_count:
+            values.append(fixed_value / scale)
+            for delta in deltas:
+                fixed_value += delta
+                values.append(fixed_value / scale)
+        if missing_bits:
+            for idx in range(samples_count):
+                if missing_bits[idx // 8] & (1 << (idx % 8)):
+                    values[idx] = math.nan
+        columns[name] = values
+
+    return columns
+
+
+def convert_sensor_data_file_to_json(filepath: Path) -> Path:
+    """
+    Replace a binary sensor data file by its json equivalent (same layout as columnar json members,
+    with missing values as null), and return the path of the new file.
+    """
+    columns = decode_sensor_data(filepath.read_bytes())
+    columns = {name: [None if math.isnan(value) else value for value in values] for (name, values) in columns.items()}
+    json_filepath = filepath.with_suffix(".json")
+    json_filepath.write_text(json.dumps(columns, allow_nan=False), encoding="utf8")
+    filepath.unlink()
+    return json_filepath
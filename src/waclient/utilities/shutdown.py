@@ -0,0 +1,93 @@
+import threading
+import time
+
+from kivy.logger import Logger as logger
+
+
+class ShutdownCoordinator:
+    """
+    Run the successive stages of a shutdown, within an overall time budget of `timeout_s` seconds (None for no limit).
+
+    The tasks of a same stage are independent, so they run concurrently, in daemon threads. When the deadline
+    is reached, the current stage is abandoned (its tasks keep running in the background, but nobody waits
+    for them anymore), and the next stages are skipped, since each stage relies on the previous ones
+    being completed (e.g. aggregators can't be flushed while sensors may still push data).
+
+    Exceptions raised by tasks are logged and collected in `errors`, without interrupting the shutdown.
+    The duration of each stage is available in `stage_durations_s`, the names of the stages
+    which didn't complete in time in `timed_out_stages`, and those which were not run in `skipped_stages`.
+    """
+
+    def __init__(self, timeout_s=None):
+        self._timeout_s = timeout_s
+        self._start_time = time.monotonic()
+        self.stage_durations_s = {}
+        self.timed_out_stages = []
+        self.skipped_stages = []
+        self.errors = []
+
+    def get_remaining_time_s(self):
+        """Return the seconds left before the deadline (possibly 0), or None if there is no deadline."""
+        if self._timeout_s is None:
+            return None
+        return max(0, self._start_time + self._timeout_s - time.monotonic())
+
+    @property
+    def deadline_exceeded(self):
+        return self.get_remaining_time_s() == 0
+
+    def _run_task(self, stage_name, task_name, task_func):
+        try:
+            task_func()
+        except Exception as exc:
+            logger.error("Error in %r task of %r shutdown stage: %r", task_name, stage_name, exc, exc_info=True)
+            self.errors.append(exc)
+
+    def run_stage(self, stage_name: str, tasks: dict) -> bool:
+        """
+        Run concurrently the callables of `tasks` (a dict of names to callables, which may be empty),
+        and wait for them until the deadline. Return True if the whole stage completed in time.
+
+        If a previous stage timed out, tasks are not run, and False is returned.
+        """
+        if self.timed_out_stages:
+            logger.warning("Skipping shutdown stage %r, since stage %r timed out", stage_name, self.timed_out_stages[0])
+            self.skipped_stages.append(stage_name)
+            return False
+
+        stage_start_time = time.monotonic()
+        threads = []
+        for task_name, task_func in tasks.items():
+            thread = threading.Thread(
+                target=self._run_task,
+                args=(stage_name, task_name, task_func),
+                name="shutdown_%s_%s" % (stage_name, task_name),
+                daemon=True,  # Must not prevent process exit if a task is stuck
+            )
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join(timeout=self.get_remaining_time_s())
+
+        self.stage_durations_s[stage_name] = time.monotonic() - stage_start_time
+        is_completed = not any(thread.is_alive() for thread in threads)
+        if not is_completed:
+            logger.warning(
+                "Shutdown stage %r didn't complete before deadline (%ss), tasks left running: %s",
+                stage_name,
+                self._timeout_s,
+                ", ".join(thread.name for thread in threads if thread.is_alive()),
+            )
+            self.timed_out_stages.append(stage_name)
+        return is_completed
+
+    def get_report(self) -> dict:
+        """Return a summary of the shutdown, e.g. for logging."""
+        return dict(
+            total_duration_s=time.monotonic() - self._start_time,
+            stage_durations_s=dict(self.stage_durations_s),
+            timed_out_stages=list(self.timed_out_stages),
+            skipped_stages=list(self.skipped_stages),
+            errors_count=len(self.errors),
+        )
@@ -0,0 +1,29 @@
+class ExponentialMovingVariance:
+    """
+    Streaming estimator of the mean and variance of a signal, in constant time and memory.
+
+    Each new sample has a weight `alpha` (between 0 and 1), so the estimations follow recent samples
+    more or less quickly (roughly, the last `2 / alpha` samples matter).
+    """
+
+    def __init__(self, alpha: float):
+        assert 0 < alpha <= 1, alpha
+        self._alpha = alpha
+        self.reset()
+
+    def reset(self):
+        self.mean = None
+        self.variance = 0.0
+        self.count = 0
+
+    def update(self, value: float) -> float:
+        """Take a new sample into account, and return the updated variance."""
+        if self.mean is None:
+            self.mean = value
+        else:
+            delta = value - self.mean
+            increment = self._alpha * delta
+            self.mean += increment
+            self.variance = (1 - self._alpha) * (self.variance + delta * increment)
+        self.count += 1
+        return self.variance
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os
 import webbrowser
 
 from kivy.animation import Animation
@@ -10,12 +11,18 @@ from kivy.properties import (
     ListProperty,
     StringProperty,
     NumericProperty,
+    BooleanProperty,
 )
+from kivy.uix.behaviors import ButtonBehavior
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.label import Label
 from kivy.uix.progressbar import ProgressBar
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
 from kivy.uix.textinput import TextInput
 
+from waclient.utilities.container_list import ContainerListSource, CONTAINER_LIST_PAGE_SIZE
+
 
 class TransitionProgress(ProgressBar):  # FIXME what for ??
     """ProgressBar with pre-defined animations for fading in and out."""
@@ -119,5 +126,70 @@ class KivyConsole(BoxLayout):
         super(KivyConsole, self).__init__(**kwargs)
 
 
+class ContainerListEntry(RecycleDataViewBehavior, ButtonBehavior, BoxLayout):
+    """Row of a ContainerListView, recycled when scrolling."""
+
+    name = StringProperty("")
+    path = StringProperty("")
+    file_size = NumericProperty(0)
+    is_selected = BooleanProperty(False)
+
+    _list_view = None
+
+    def refresh_view_attrs(self, rv, index, data):
+        self._list_view = rv
+        self.is_selected = data["path"] in rv.selection
+        return super(ContainerListEntry, self).refresh_view_attrs(rv, index, data)
+
+    def on_release(self):
+        self._list_view.select_path(self.path)
+
+
+class ContainerListView(RecycleView):
+    """
+    Virtualized list of the containers of `path`, which only creates widgets for visible rows.
+
+    Rows are loaded page by page from a ContainerListSource, when scrolling approaches the end of loaded ones,
+    so that opening and scrolling stay fast even with thousands of containers.
+    """
+
+    path = StringProperty("")
+
+    selection = ListProperty([])
+    """List of selected container paths (at most one)."""
+
+    page_size = NumericProperty(CONTAINER_LIST_PAGE_SIZE)
+
+    preload_threshold = NumericProperty(0.1)
+    """Ratio of remaining scroll height, under which the next page gets loaded."""
+
+    _source = None
+
+    def __init__(self, **kwargs):
+        super(ContainerListView, self).__init__(**kwargs)
+        self.bind(scroll_y=self._on_scroll_y)
+
+    def refresh(self):
+        """Rescan containers, and reset the list to its first page, while keeping a still existing selection."""
+        if self._source is None or self._source.page_size != self.page_size:
+            self._source = ContainerListSource(self.path, page_size=self.page_size)
+        self._source.refresh()
+        self.data = self._source.get_page(0)
+        if self.selection and not os.path.exists(self.selection[0]):
+            self.selection = []
+        self.scroll_y = 1
+
+    def _on_scroll_y(self, instance, scroll_y):
+        if scroll_y <= self.preload_threshold and self._source and len(self.data) < len(self._source):
+            self.data.extend(self._source.get_rows(len(self.data), len(self.data) + self.page_size))
+
+    def select_path(self, path):
+        self.selection = [] if path in self.selection else [path]
+
+    def on_selection(self, instance, selection):
+        for entry in self.layout_manager.children:
+            entry.is_selected = entry.path in selection
+
+
 if __name__ == "__main__":
     runTouchApp(KivyConsole())
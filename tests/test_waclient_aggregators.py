@@ -0,0 +1,381 @@
+import gzip
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from waclient.aggregators import (
+    SpoolingTarfileRecordsAggregator,
+    PreEventTarfileRecordsAggregator,
+    ColumnarDataAggregator,
+)
+from waclient.common_config import get_encryption_conf
+from waclient.container_storage import RecordingContainerStorage
+from wacryptolib.sensor import TarfileRecordsAggregator, JsonDataAggregator
+from wacryptolib.utilities import load_from_json_bytes
+
+
+def _get_container_storage(containers_dir):
+    return RecordingContainerStorage(
+        default_encryption_conf=get_encryption_conf("test"), containers_dir=containers_dir
+    )
+
+
+def test_spooling_tarfile_aggregator(tmp_path):
+
+    spool_dir = tmp_path / "spool"
+    spool_dir.mkdir()
+
+    for max_memory_size in (None, 0, 100, 10 ** 6):
+
+        containers_dir = tmp_path / ("containers%s" % max_memory_size)
+        containers_dir.mkdir()
+        container_storage = _get_container_storage(containers_dir)
+
+        enqueued_streams = []
+        original_enqueue = container_storage.enqueue_file_for_encryption
+
+        def _spy_enqueue(data, **kwargs):
+            enqueued_streams.append(data)
+            return original_enqueue(data=data, **kwargs)
+
+        container_storage.enqueue_file_for_encryption = _spy_enqueue
+
+        tarfile_aggregator = SpoolingTarfileRecordsAggregator(
+            container_storage=container_storage,
+            max_duration_s=100,
+            spool_dir=spool_dir,
+            max_memory_size=max_memory_size,
+        )
+
+        now = datetime.now(tz=timezone.utc)
+        for idx in range(3):
+            tarfile_aggregator.add_record(
+                sensor_name="sensor%d" % idx,
+                from_datetime=now,
+                to_datetime=now,
+                extension=".dat",
+                data=b"abcdef" * 100,
+            )
+        assert len(tarfile_aggregator) == 3
+
+        tarfile_aggregator.finalize_tarfile()
+        assert len(tarfile_aggregator) == 0
+        tarfile_aggregator.finalize_tarfile()  # No-op
+
+        (archive_stream,) = enqueued_streams
+        is_rolled_over = isinstance(archive_stream, tempfile.SpooledTemporaryFile) and archive_stream._rolled
+        assert is_rolled_over == (max_memory_size == 100)
+
+        container_storage.wait_for_idle_state()
+        assert archive_stream.closed  # Temporary file was released by worker
+
+        assert len(container_storage) == 1
+        tarfile_bytestring = container_storage.decrypt_container_from_storage(0)
+        tar_file = TarfileRecordsAggregator.read_tarfile_from_bytestring(tarfile_bytestring)
+        assert len(tar_file.getnames()) == 3
+        for member in tar_file.getmembers():
+            assert tar_file.extractfile(member).read() == b"abcdef" * 100
+
+    assert not list(spool_dir.iterdir())  # Anonymous temporary files only
+
+
+def test_spooling_tarfile_aggregator_add_record_from_file(tmp_path):
+
+    containers_dir = tmp_path / "containers"
+    containers_dir.mkdir()
+    container_storage = _get_container_storage(containers_dir)
+
+    tarfile_aggregator = SpoolingTarfileRecordsAggregator(
+        container_storage=container_storage, max_duration_s=100, spool_dir=tmp_path, max_memory_size=1024
+    )
+
+    record_data = b"abcdefgh" * 10000
+    record_filepath = tmp_path / "my_record.dat"
+    record_filepath.write_bytes(record_data)
+
+    now = datetime.now(tz=timezone.utc)
+    tarfile_aggregator.add_record_from_file(
+        sensor_name="mysensor", from_datetime=now, to_datetime=now, extension=".mp4", filepath=record_filepath
+    )
+    assert not record_filepath.exists()  # Aggregator took ownership of file
+    assert len(tarfile_aggregator) == 1
+
+    with pytest.raises(FileNotFoundError):
+        tarfile_aggregator.add_record_from_file(
+            sensor_name="mysensor", from_datetime=now, to_datetime=now, extension=".mp4", filepath=record_filepath
+        )
+    assert len(tarfile_aggregator) == 1
+
+    tarfile_aggregator.add_record(
+        sensor_name="othersensor", from_datetime=now, to_datetime=now, extension=".json", data=b"[]"
+    )
+    tarfile_aggregator.finalize_tarfile()
+    container_storage.wait_for_idle_state()
+
+    container = container_storage.load_container_from_storage(0)
+    members_metadata = container["metadata"]["members"]
+    assert len(members_metadata) == 2
+    (mp4_member_name,) = [name for name in members_metadata if name.endswith(".mp4")]
+    assert members_metadata[mp4_member_name]["size"] == len(record_data)
+
+    tarfile_bytestring = container_storage.decrypt_container_from_storage(0)
+    tar_file = TarfileRecordsAggregator.read_tarfile_from_bytestring(tarfile_bytestring)
+    assert tar_file.extractfile(mp4_member_name).read() == record_data
+
+
+def test_spooling_tarfile_aggregator_member_compression(tmp_path):
+
+    containers_dir = tmp_path / "containers"
+    containers_dir.mkdir()
+    container_storage = _get_container_storage(containers_dir)
+
+    tarfile_aggregator = SpoolingTarfileRecordsAggregator(
+        container_storage=container_storage,
+        max_duration_s=100,
+        spool_dir=tmp_path,
+        member_compression=dict(compressed_sensor="gzip", uncompressed_sensor="none"),
+    )
+
+    record_data = b"abcdefgh" * 1000
+    now = datetime.now(tz=timezone.utc)
+    for sensor_name in ("compressed_sensor", "uncompressed_sensor", "other_sensor"):
+        tarfile_aggregator.add_record(
+            sensor_name=sensor_name, from_datetime=now, to_datetime=now, extension=".json", data=record_data
+        )
+    tarfile_aggregator.finalize_tarfile()
+    container_storage.wait_for_idle_state()
+
+    tarfile_bytestring = container_storage.decrypt_container_from_storage(0)
+    tar_file = TarfileRecordsAggregator.read_tarfile_from_bytestring(tarfile_bytestring)
+    member_names = sorted(member.name for member in tar_file.getmembers())
+    assert member_names[0].endswith("_compressed_sensor.json.gz")
+    assert member_names[1].endswith("_other_sensor.json")
+    assert member_names[2].endswith("_uncompressed_sensor.json")
+
+    compressed_data = tar_file.extractfile(member_names[0]).read()
+    assert len(compressed_data) < len(record_data) / 10
+    assert gzip.decompress(compressed_data) == record_data
+    assert tar_file.extractfile(member_names[1]).read() == record_data
+
+
+class _RecordsCollector(SpoolingTarfileRecordsAggregator):
+    def __init__(self):
+        self._test_records = []
+
+    def add_record(self, **kwargs):
+        self._test_records.append(kwargs)
+
+
+def test_pre_event_tarfile_aggregator(tmp_path):
+
+    containers_dir = tmp_path / "containers"
+    containers_dir.mkdir()
+    container_storage = _get_container_storage(containers_dir)
+
+    tarfile_aggregator = PreEventTarfileRecordsAggregator(
+        container_storage=container_storage,
+        max_duration_s=100,
+        spool_dir=tmp_path,
+        pre_event_duration_s=10,
+        post_event_duration_s=0.5,
+        max_window_memory_size=1000,
+    )
+
+    def _add_record(sensor_name, age_s, data=b"x" * 100):
+        to_datetime = datetime.now(tz=timezone.utc) - timedelta(seconds=age_s)
+        tarfile_aggregator.add_record(
+            sensor_name=sensor_name, from_datetime=to_datetime - timedelta(seconds=1), to_datetime=to_datetime,
+            extension=".dat", data=data,
+        )
+
+    # Outside of events, only recent records are kept, within memory bounds
+
+    _add_record("gyroscope", age_s=20)  # Outdated at once
+    for age_s in (8, 6, 4, 2):
+        _add_record("gyroscope", age_s=age_s)
+        _add_record("gps", age_s=age_s)
+    _add_record("gps_status", age_s=1, data=b"y" * 300)  # Evicts the oldest record, to free memory
+    record_filepath = tmp_path / "my_record.mp4"
+    record_filepath.write_bytes(b"audio")
+    tarfile_aggregator.add_record_from_file(
+        sensor_name="microphone", from_datetime=datetime.now(tz=timezone.utc), to_datetime=datetime.now(tz=timezone.utc),
+        extension=".mp4", filepath=record_filepath,
+    )
+    assert record_filepath.exists()  # Stays on disk while in window
+
+    assert len(tarfile_aggregator) == 0
+    window_stats = tarfile_aggregator.window_stats
+    assert window_stats["records_count"] == 9
+    assert window_stats["memory_size"] == 1000
+    assert window_stats["evicted_count"] == 2
+    assert not window_stats["is_event_ongoing"]
+
+    # An event seals window and post-event records into a container
+
+    tarfile_aggregator.mark_event()
+    time.sleep(0.2)
+    assert tarfile_aggregator.window_stats["is_event_ongoing"]
+    assert not record_filepath.exists()
+    _add_record("gyroscope", age_s=0)
+    tarfile_aggregator.mark_event()  # Extends the ongoing event
+    assert len(tarfile_aggregator) == 10
+
+    time.sleep(1)
+    assert len(tarfile_aggregator) == 0
+    window_stats = tarfile_aggregator.window_stats
+    assert window_stats["events_count"] == 2
+    assert not window_stats["is_event_ongoing"]
+
+    container_storage.wait_for_idle_state()
+    assert len(container_storage) == 1
+    tar_file = TarfileRecordsAggregator.read_tarfile_from_bytestring(container_storage.decrypt_container_from_storage(0))
+    member_names = tar_file.getnames()
+    assert len(member_names) == 10
+    assert sum("microphone" in member_name for member_name in member_names) == 1
+
+    # Records are buffered again, and discarded on finalization
+
+    _add_record("gps", age_s=0)
+    record_filepath.write_bytes(b"audio")
+    tarfile_aggregator.add_record_from_file(
+        sensor_name="microphone", from_datetime=datetime.now(tz=timezone.utc), to_datetime=datetime.now(tz=timezone.utc),
+        extension=".mp4", filepath=record_filepath,
+    )
+    assert tarfile_aggregator.window_stats["records_count"] == 2
+    tarfile_aggregator.finalize_tarfile()
+    assert tarfile_aggregator.window_stats["records_count"] == 0
+    assert not record_filepath.exists()
+    container_storage.wait_for_idle_state()
+    assert len(container_storage) == 1
+
+
+def test_columnar_data_aggregator():
+
+    records_collector = _RecordsCollector()
+
+    columnar_aggregator = ColumnarDataAggregator(
+        tarfile_aggregator=records_collector, sensor_name="mysensor", max_duration_s=100, field_names=("x", "y")
+    )
+    assert columnar_aggregator.sensor_name == "mysensor"
+    assert len(columnar_aggregator) == 0
+
+    with pytest.raises(AssertionError):
+        ColumnarDataAggregator(
+            tarfile_aggregator=records_collector, sensor_name="a", max_duration_s=1, field_names=("timestamp",)
+        )
+
+    columnar_aggregator.add_values((1.5, -2), timestamp=1000.5)
+    columnar_aggregator.add_values((None, 3.25))
+    columnar_aggregator.add_data(dict(x=4, z=8))
+    assert len(columnar_aggregator) == 3
+
+    with pytest.raises(AssertionError):
+        columnar_aggregator.add_values((1, 2, 3))
+    assert len(columnar_aggregator) == 3
+
+    columnar_aggregator.flush_dataset()
+    assert len(columnar_aggregator) == 0
+    columnar_aggregator.flush_dataset()  # No-op
+
+    (record,) = records_collector._test_records
+    assert record["sensor_name"] == "mysensor"
+    assert record["extension"] == ".json"
+    assert record["from_datetime"] <= record["to_datetime"]
+
+    assert b"NaN" not in record["data"]  # Missing values must be valid json
+    dataset = load_from_json_bytes(record["data"])
+    assert set(dataset) == {"timestamp", "x", "y"}
+    assert dataset["timestamp"][0] == 1000.5
+    assert dataset["timestamp"][1] <= dataset["timestamp"][2] <= time.time()
+    assert dataset["x"] == [1.5, None, 4]
+    assert dataset["y"] == [-2, 3.25, None]
+
+
+def test_queued_data_and_tarfile_aggregators(tmp_path):
+
+    container_storage = _get_container_storage(tmp_path)
+
+    tarfile_aggregator = SpoolingTarfileRecordsAggregator(
+        container_storage=container_storage, max_duration_s=100, spool_dir=tmp_path, queue_size=2
+    )
+    columnar_aggregator = ColumnarDataAggregator(
+        tarfile_aggregator=tarfile_aggregator,
+        sensor_name="mysensor",
+        max_duration_s=100,
+        field_names=("x",),
+        queue_size=1000,
+        overflow_policy="drop_oldest",
+    )
+
+    before_time = time.time()
+    for idx in range(500):
+        columnar_aggregator.add_values((idx,))
+    columnar_aggregator.flush_dataset()  # Waits for queued values
+    assert len(columnar_aggregator) == 0
+
+    stats = columnar_aggregator.queue_stats
+    assert stats["overflow_policy"] == "drop_oldest"
+    assert stats["processed_count"] == 500
+    assert stats["dropped_count"] == 0
+
+    tarfile_aggregator.finalize_tarfile()  # Waits for queued records
+    assert tarfile_aggregator.queue_stats["processed_count"] == 1
+    container_storage.wait_for_idle_state()
+
+    tarfile_bytes = container_storage.decrypt_container_from_storage(0)
+    tar_file = TarfileRecordsAggregator.read_tarfile_from_bytestring(tarfile_bytes)
+    (member,) = tar_file.getmembers()
+    dataset = load_from_json_bytes(tar_file.extractfile(member).read())
+    assert dataset["x"] == list(range(500))
+    assert before_time <= dataset["timestamp"][0] <= dataset["timestamp"][-1] <= time.time()
+
+    assert _get_container_storage(tmp_path).get_encryption_stats()["queue"] is None
+    assert ColumnarDataAggregator(
+        tarfile_aggregator=tarfile_aggregator, sensor_name="a", max_duration_s=1, field_names=("x",)
+    ).queue_stats is None
+
+
+def _measure_aggregation_cost(data_aggregator, add_sample, samples):
+    tracemalloc.start()
+    start_time = time.process_time()
+    for sample in samples:
+        add_sample(data_aggregator, sample)
+    _current_size, peak_memory = tracemalloc.get_traced_memory()
+    data_aggregator.flush_dataset()
+    cpu_time_s = time.process_time() - start_time
+    tracemalloc.stop()
+    (record,) = data_aggregator._tarfile_aggregator._test_records
+    return cpu_time_s, peak_memory, len(record["data"])
+
+
+def test_columnar_data_aggregator_benchmark():
+
+    field_names = ("rotation_rate_x", "rotation_rate_y", "rotation_rate_z")
+    samples = [tuple(random.uniform(-10, 10) for _ in field_names) for _ in range(20000)]
+
+    json_aggregator = JsonDataAggregator(
+        tarfile_aggregator=_RecordsCollector(), sensor_name="gyroscope", max_duration_s=1000
+    )
+    json_costs = _measure_aggregation_cost(
+        json_aggregator, lambda aggregator, sample: aggregator.add_data(dict(zip(field_names, sample))), samples
+    )
+
+    columnar_aggregator = ColumnarDataAggregator(
+        tarfile_aggregator=_RecordsCollector(), sensor_name="gyroscope", max_duration_s=1000, field_names=field_names
+    )
+    columnar_costs = _measure_aggregation_cost(
+        columnar_aggregator, lambda aggregator, sample: aggregator.add_values(sample), samples
+    )
+
+    for label, (cpu_time_s, peak_memory, payload_size) in (("dicts/json", json_costs), ("columnar", columnar_costs)):
+        print(
+            "Aggregation of %d samples with %s: cpu=%.3fs buffer_peak=%dKB payload=%dKB"
+            % (len(samples), label, cpu_time_s, peak_memory // 1024, payload_size // 1024)
+        )
+
+    assert columnar_costs[1] < json_costs[1]  # Buffered samples take less memory
+    assert columnar_costs[2] < json_costs[2]  # Serialized payload is smaller
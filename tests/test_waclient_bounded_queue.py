@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+from waclient.utilities.bounded_queue import BoundedQueueWorker
+
+
+def _get_blocked_queue(overflow_policy, max_size=4):
+    """Return a queue whose consumer is stuck on its first item, until the returned event is set."""
+    consumed_items = []
+    dropped_items = []
+    unblock_event = threading.Event()
+
+    def _consumer(item):
+        unblock_event.wait()
+        consumed_items.append(item)
+
+    queue = BoundedQueueWorker(
+        name="test", consumer=_consumer, max_size=max_size, overflow_policy=overflow_policy, on_drop=dropped_items.append
+    )
+    queue.put(0)
+    time.sleep(0.1)  # First item is now being consumed
+    assert len(queue) == 0
+    return queue, unblock_event, consumed_items, dropped_items
+
+
+def test_bounded_queue_worker_nominal():
+
+    consumed_items = []
+
+    def _consumer(item):
+        if item == "broken":
+            raise ValueError(item)
+        time.sleep(0.01)
+        consumed_items.append(item)
+
+    queue = BoundedQueueWorker(name="test", consumer=_consumer, max_size=100)
+    assert queue.name == "test"
+    assert queue.wait_until_empty(timeout_s=0)
+
+    for item in range(10):
+        queue.put(item)
+    queue.put("broken")  # Errors are only logged
+    queue.put(10)
+    assert queue.wait_until_empty(timeout_s=5)
+    assert consumed_items == list(range(11))
+
+    stats = queue.get_stats()
+    assert stats["depth"] == 0
+    assert 1 <= stats["max_depth"] <= 12
+    assert stats["enqueued_count"] == stats["processed_count"] == 12
+    assert stats["dropped_count"] == stats["blocked_count"] == 0
+
+    queue.put(11)  # Worker thread restarts on demand
+    assert queue.wait_until_empty(timeout_s=5)
+    assert consumed_items[-1] == 11
+
+    with pytest.raises(AssertionError):
+        BoundedQueueWorker(name="test", consumer=_consumer, max_size=10, overflow_policy="whatever")
+
+
+@pytest.mark.parametrize(
+    "max_size, expected_consumed_items",
+    [(1, [0, 4]), (3, [0, 1, 3, 4]), (4, [0, 1, 2, 3, 4])],
+)
+def test_bounded_queue_worker_decimate_policy_keeps_newest_item(max_size, expected_consumed_items):
+
+    queue, unblock_event, consumed_items, dropped_items = _get_blocked_queue("decimate", max_size=max_size)
+
+    for item in range(1, 5):
+        queue.put(item)
+    assert len(queue) <= max_size
+
+    unblock_event.set()
+    assert queue.wait_until_empty(timeout_s=5)
+    assert consumed_items == expected_consumed_items
+    assert sorted(dropped_items + consumed_items) == list(range(5))
+
+
+def test_bounded_queue_worker_block_policy():
+
+    queue, unblock_event, consumed_items, dropped_items = _get_blocked_queue("block")
+
+    for item in range(1, 5):
+        queue.put(item)
+    assert not queue.wait_until_empty(timeout_s=0.1)
+
+    threading.Timer(0.3, unblock_event.set).start()
+    start_time = time.monotonic()
+    queue.put(5)  # Waits for a free slot
+    assert time.monotonic() - start_time >= 0.25
+
+    assert queue.wait_until_empty(timeout_s=5)
+    assert consumed_items == [0, 1, 2, 3, 4, 5]
+    assert dropped_items == []
+    assert queue.get_stats()["blocked_count"] == 1
+
+
+@pytest.mark.parametrize(
+    "overflow_policy, expected_consumed_items",
+    [("drop_oldest", [0, 6, 7, 8, 9]), ("decimate", [0, 6, 8, 9])],
+)
+def test_bounded_queue_worker_dropping_policies(overflow_policy, expected_consumed_items):
+
+    queue, unblock_event, consumed_items, dropped_items = _get_blocked_queue(overflow_policy)
+
+    for item in range(1, 10):
+        queue.put(item)  # Never blocks
+    assert len(queue) <= 4
+
+    unblock_event.set()
+    assert queue.wait_until_empty(timeout_s=5)
+    assert consumed_items == expected_consumed_items
+    assert sorted(dropped_items + consumed_items) == list(range(10))
+
+    stats = queue.get_stats()
+    assert stats["enqueued_count"] == 10
+    assert stats["dropped_count"] == len(dropped_items)
+    assert stats["processed_count"] == len(expected_consumed_items)
+    assert stats["max_depth"] == 4
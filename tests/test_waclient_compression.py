@@ -0,0 +1,47 @@
+import io
+
+import pytest
+
+from waclient.utilities.compression import (
+    COMPRESSION_CODECS,
+    COMPRESSION_EXTENSIONS,
+    is_compression_codec_available,
+    compress_data,
+    detect_compression_codec,
+    open_decompressed_stream,
+    split_compression_extension,
+)
+
+
+@pytest.mark.parametrize("codec", COMPRESSION_CODECS)
+def test_compression_roundtrip(codec):
+
+    if not is_compression_codec_available(codec):
+        pytest.skip("Compression codec %s is not available" % codec)
+
+    data = b'{"timestamp": [1.0, 2.0, 3.0]}' * 1000
+    compressed_data = compress_data(data, codec=codec)
+
+    if codec == "none":
+        assert compressed_data == data
+        assert detect_compression_codec(compressed_data) is None
+        stream = io.BytesIO(compressed_data)
+        assert open_decompressed_stream(stream) is stream
+        assert open_decompressed_stream(stream, codec="none") is stream
+        assert split_compression_extension("record_without_extension") == ("record_without_extension", "none")
+        return
+
+    assert len(compressed_data) < len(data) / 10
+    assert detect_compression_codec(compressed_data) == codec
+
+    stream = io.BytesIO(b"xyz" + compressed_data)
+    stream.seek(3)
+    assert open_decompressed_stream(stream).read() == data
+
+    # Peekable streams (like tarfile members in streaming mode) are inspected without seeking
+    stream = io.BufferedReader(io.BytesIO(compressed_data))
+    assert open_decompressed_stream(stream).read() == data
+
+    assert split_compression_extension("record.json" + COMPRESSION_EXTENSIONS[codec]) == ("record.json", codec)
+    assert open_decompressed_stream(io.BytesIO(compressed_data), codec=codec).read() == data
+
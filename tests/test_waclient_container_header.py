@@ -0,0 +1,61 @@
+import os
+import time
+import tracemalloc
+
+import pytest
+
+from waclient.common_config import get_encryption_conf
+from waclient.utilities.container_header import load_container_header
+from wacryptolib.container import (
+    dump_container_to_filesystem,
+    encrypt_data_into_container,
+    get_encryption_configuration_summary,
+    load_container_from_filesystem,
+)
+from wacryptolib.key_storage import FilesystemKeyStoragePool
+
+
+def _measure_loading(loader, container_filepath):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    container = loader(container_filepath)
+    duration = time.perf_counter() - start_time
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return container, duration, peak_memory
+
+
+@pytest.mark.parametrize("offload_data_ciphertext", [False, True])
+def test_load_container_header(tmp_path, offload_data_ciphertext):
+
+    keys_dir = tmp_path / "keys"
+    keys_dir.mkdir()
+
+    audio_data = os.urandom(8 * 1024 ** 2)  # Like a few minutes of compressed audio
+    metadata = {"members": {"20200101_000000_microphone.mp4": dict(size=len(audio_data))}}
+    container = encrypt_data_into_container(
+        data=audio_data,
+        conf=get_encryption_conf("test"),
+        metadata=metadata,
+        key_storage_pool=FilesystemKeyStoragePool(keys_dir),
+    )
+    container_filepath = tmp_path / "audio.crypt"
+    dump_container_to_filesystem(
+        container_filepath, container=container, offload_data_ciphertext=offload_data_ciphertext
+    )
+
+    header, header_duration, header_peak_memory = _measure_loading(load_container_header, container_filepath)
+    _, full_duration, full_peak_memory = _measure_loading(load_container_from_filesystem, container_filepath)
+    print(
+        "Container header loaded in %.3fs with %d KB peak memory (full loading: %.3fs with %d KB)"
+        % (header_duration, header_peak_memory // 1024, full_duration, full_peak_memory // 1024)
+    )
+
+    assert "data_ciphertext" not in header
+    assert header == {key: value for (key, value) in container.items() if key != "data_ciphertext"}
+    assert header["metadata"] == metadata
+    assert get_encryption_configuration_summary(header) == get_encryption_configuration_summary(container)
+
+    assert header_peak_memory < 1024 ** 2  # Ciphertext is never loaded
+    if not offload_data_ciphertext:
+        assert header_peak_memory < full_peak_memory / 10
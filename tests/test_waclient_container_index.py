@@ -0,0 +1,82 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from waclient.common_config import get_encryption_conf
+from waclient.container_index import ContainerIndex
+from waclient.container_storage import RecordingContainerStorage
+from wacryptolib.key_storage import FilesystemKeyStoragePool
+
+
+def _wait_for_index_size(container_index, size):
+    # Done callbacks of encryption futures might run after wait_for_idle_state() returns
+    for _ in range(50):
+        if len(container_index.list_container_names()) == size:
+            return
+        time.sleep(0.1)
+    raise AssertionError("Container index never reached size %d" % size)
+
+
+def test_container_index(tmp_path):
+
+    containers_dir = tmp_path / "containers"
+    containers_dir.mkdir()
+    keys_dir = tmp_path / "keys"
+    keys_dir.mkdir()
+
+    container_index = ContainerIndex(tmp_path / "container_index.sqlite")
+    assert container_index.list_container_names() == []
+    assert container_index.get_container_entry("unknown.crypt") is None
+
+    container_storage = RecordingContainerStorage(
+        default_encryption_conf=get_encryption_conf("test"),
+        containers_dir=containers_dir,
+        key_storage_pool=FilesystemKeyStoragePool(keys_dir),
+        max_containers_count=2,
+        container_index=container_index,
+    )
+
+    now = datetime.now(tz=timezone.utc)
+    metadata = {
+        "members": {
+            "20200101_000000_gyroscope.bin": dict(size=122, mtime=now - timedelta(seconds=10)),
+            "20200101_000000_microphone.mp4": dict(size=555, mtime=now),
+        }
+    }
+    for idx in range(3):
+        container_storage.enqueue_file_for_encryption(
+            filename_base="file%d" % idx, data=b"abc" * 1000, metadata=metadata
+        )
+        container_storage.wait_for_idle_state()
+        _wait_for_index_size(container_index, min(idx + 1, 2))
+
+    # Oldest container was purged from both storage and index
+    assert container_index.list_container_names() == ["file1.crypt", "file2.crypt"]
+
+    entry = container_index.get_container_entry("file2.crypt")
+    container = container_storage.load_container_from_storage("file2.crypt")
+    assert entry["container_name"] == "file2.crypt"
+    assert entry["keychain_uid"] == str(container["keychain_uid"])
+    assert entry["members"] == {
+        "20200101_000000_gyroscope.bin": dict(size=122),
+        "20200101_000000_microphone.mp4": dict(size=555),
+    }
+    assert entry["from_timestamp"] == (now - timedelta(seconds=10)).timestamp()
+    assert entry["to_timestamp"] == now.timestamp()
+    assert entry["encryption_summary"]
+    assert entry["file_size"] > 0
+
+    entries = container_index.list_container_entries()
+    assert [entry["container_name"] for entry in entries] == ["file1.crypt", "file2.crypt"]
+
+    # Index is persistent, and gets resynchronized with the containers directory
+
+    container_index.close()
+    container_index = ContainerIndex(tmp_path / "container_index.sqlite")
+    assert container_index.get_container_entry("file2.crypt") == entry
+
+    container_index.remove_container_entry("file1.crypt")
+    container_index.add_container_entry(dict(entry, container_name="vanished.crypt"))
+    assert container_index.synchronize_with_directory(containers_dir) == dict(added_count=1, removed_count=1)
+    assert container_index.list_container_names() == ["file1.crypt", "file2.crypt"]
+    assert container_index.get_container_entry("file1.crypt")["members"] == entry["members"]
+    assert container_index.synchronize_with_directory(containers_dir) == dict(added_count=0, removed_count=0)
@@ -0,0 +1,65 @@
+import time
+
+from waclient.utilities.container_list import ContainerListSource
+from wacryptolib.container import CONTAINER_SUFFIX, OFFLOADED_DATA_SUFFIX
+
+
+def test_container_list_source(tmp_path):
+
+    containers_count = 10000
+    for idx in range(containers_count):
+        tmp_path.joinpath("20200101_%06d_container.crypt" % idx).write_bytes(b"x" * (idx % 7))
+    offloaded_data_filename = "20200101_000000_container" + CONTAINER_SUFFIX + OFFLOADED_DATA_SUFFIX
+    tmp_path.joinpath(offloaded_data_filename).write_bytes(b"xxx")  # Offloaded ciphertext
+    tmp_path.joinpath("somedir.crypt").mkdir()
+
+    source = ContainerListSource(tmp_path, page_size=50)
+    assert len(source) == 0
+
+    start_time = time.perf_counter()
+    assert source.refresh() == containers_count
+    refresh_duration = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    first_page = source.get_page(0)
+    page_duration = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for page_index in range(source.pages_count):  # Like scrolling through the whole list
+        source.get_page(page_index)
+    scrolling_duration = time.perf_counter() - start_time
+
+    print(
+        "Listed %d containers in %.3fs, first page loaded in %.4fs, all pages in %.3fs"
+        % (containers_count, refresh_duration, page_duration, scrolling_duration)
+    )
+    assert refresh_duration < 1
+    assert page_duration < 0.05
+
+    assert source.pages_count == 200
+    assert len(first_page) == 50
+    assert first_page[0] == dict(
+        name="20200101_009999_container.crypt",
+        path=str(tmp_path / "20200101_009999_container.crypt"),
+        file_size=9999 % 7,
+    )
+    assert source.get_page(199)[-1]["name"] == "20200101_000000_container.crypt"
+    assert source.get_page(200) == []
+    assert source.get_rows(10, 12) == first_page[10:12]
+
+    source.set_sorting(reverse=False)
+    assert source.get_page(0)[0]["name"] == "20200101_000000_container.crypt"
+
+    # Cached sizes are dropped for vanished containers, and fetched for new ones
+
+    tmp_path.joinpath("20200101_000000_container.crypt").unlink()
+    tmp_path.joinpath("20200101_000000_container.crypt").write_bytes(b"abcdef")
+    assert source.get_page(0)[0]["file_size"] == 0  # Cached
+    assert source.refresh() == containers_count
+    assert source.get_page(0)[0]["file_size"] == 0  # Still cached, since file remains
+
+    tmp_path.joinpath("20200101_000000_container.crypt").unlink()
+    assert source.refresh() == containers_count - 1
+    tmp_path.joinpath("20200101_000000_container.crypt").write_bytes(b"abcdef")
+    assert source.refresh() == containers_count
+    assert source.get_page(0)[0]["file_size"] == 6
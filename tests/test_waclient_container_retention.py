@@ -0,0 +1,109 @@
+import shutil
+import time
+from collections import namedtuple
+
+from waclient.common_config import get_encryption_conf
+from waclient.container_retention import ContainerRetentionPolicy
+from waclient.container_storage import RecordingContainerStorage
+from wacryptolib.container import CONTAINER_SUFFIX, OFFLOADED_DATA_SUFFIX
+from wacryptolib.key_storage import FilesystemKeyStoragePool
+
+
+def test_container_retention_policy(tmp_path, monkeypatch):
+
+    # Existing containers are scanned on first use, including offloaded ciphertexts
+    tmp_path.joinpath("20200101_000000_container.crypt").write_bytes(b"x" * 10)
+    tmp_path.joinpath("20200101_000000_container" + CONTAINER_SUFFIX + OFFLOADED_DATA_SUFFIX).write_bytes(b"x" * 90)
+    tmp_path.joinpath("20200102_000000_container.crypt").write_bytes(b"x" * 100)
+    tmp_path.joinpath("other.txt").write_bytes(b"x" * 1000)
+
+    policy = ContainerRetentionPolicy(tmp_path)
+    assert policy.get_stats() == dict(containers_count=None, total_bytes=None, evicted_count=0, reclaimed_bytes=0)
+
+    policy.add_container("20200103_000000_container.crypt", size=100, mtime=3000)
+    policy.add_container("20200104_000000_container.crypt", size=100, mtime=4000)
+    assert policy.get_stats()["containers_count"] == 4
+    assert policy.get_stats()["total_bytes"] == 400
+
+    # No limit at all
+    assert policy.pop_containers_to_evict(now=10000) == []
+
+    # Byte quota, with containers deleted by other means being skipped
+
+    policy.remove_container("20200101_000000_container.crypt")
+    policy.max_total_bytes = 150
+    assert policy.pop_containers_to_evict(now=10000) == [
+        "20200102_000000_container.crypt",
+        "20200103_000000_container.crypt",
+    ]
+    assert policy.get_stats() == dict(containers_count=1, total_bytes=100, evicted_count=2, reclaimed_bytes=200)
+    policy.max_total_bytes = None
+
+    # Max age
+
+    for idx in range(5, 9):
+        policy.add_container("2020010%d_000000_container.crypt" % idx, size=100, mtime=idx * 1000)
+    policy.max_age_s = 2500
+    assert policy.pop_containers_to_evict(now=8000, max_count=1) == ["20200104_000000_container.crypt"]
+    assert policy.pop_containers_to_evict(now=8000) == ["20200105_000000_container.crypt"]
+    assert policy.pop_containers_to_evict(now=8000) == []
+    policy.max_age_s = 0
+
+    # Free disk space floor, which rises with evictions
+
+    DiskUsage = namedtuple("DiskUsage", "total used free")
+    monkeypatch.setattr(shutil, "disk_usage", lambda path: DiskUsage(10000, 9850, 150))
+    policy.min_free_disk_bytes = 300
+    assert policy.pop_containers_to_evict(now=8000) == [
+        "20200106_000000_container.crypt",
+        "20200107_000000_container.crypt",
+    ]
+
+    assert policy.get_stats() == dict(containers_count=1, total_bytes=100, evicted_count=6, reclaimed_bytes=600)
+
+
+def _wait_for_retention_containers_count(container_storage, count):
+    # Done callbacks of encryption futures might run after wait_for_idle_state() returns
+    for _ in range(50):
+        if container_storage.get_retention_stats()["containers_count"] == count:
+            return
+        time.sleep(0.1)
+    raise AssertionError("Retention policy never tracked %d containers" % count)
+
+
+def test_recording_container_storage_retention(tmp_path):
+
+    containers_dir = tmp_path / "containers"
+    containers_dir.mkdir()
+    keys_dir = tmp_path / "keys"
+    keys_dir.mkdir()
+
+    retention_policy = ContainerRetentionPolicy(containers_dir)
+    container_storage = RecordingContainerStorage(
+        default_encryption_conf=get_encryption_conf("test"),
+        containers_dir=containers_dir,
+        key_storage_pool=FilesystemKeyStoragePool(keys_dir),
+        retention_policy=retention_policy,
+    )
+    assert container_storage.enforce_retention() == []
+
+    for idx in range(5):
+        container_storage.enqueue_file_for_encryption(
+            filename_base="file%d" % idx, data=b"abc" * 10000, metadata=None
+        )
+        container_storage.wait_for_idle_state()
+    _wait_for_retention_containers_count(container_storage, 5)
+
+    stats = container_storage.get_retention_stats()
+    container_size = stats["total_bytes"] // 5
+    assert container_size > 30000
+
+    retention_policy.max_total_bytes = int(2.5 * container_size)
+    assert container_storage.enforce_retention() == ["file0.crypt", "file1.crypt", "file2.crypt"]
+    assert sorted(str(name) for name in container_storage.list_container_names()) == ["file3.crypt", "file4.crypt"]
+    assert all(filepath.name.startswith(("file3.", "file4.")) for filepath in containers_dir.iterdir())
+
+    stats = container_storage.get_retention_stats()
+    assert stats["containers_count"] == 2
+    assert stats["evicted_count"] == 3
+    assert stats["reclaimed_bytes"] >= 3 * container_size - 100
@@ -0,0 +1,182 @@
+import io
+import os
+import statistics
+import time
+
+import pytest
+
+from waclient.common_config import get_encryption_conf
+from waclient.container_storage import RecordingContainerStorage
+from wacryptolib.container import CONTAINER_SUFFIX, OFFLOADED_DATA_SUFFIX
+from wacryptolib.key_storage import FilesystemKeyStoragePool
+from wacryptolib.utilities import PeriodicTaskHandler
+
+
+def _get_container_storage(tmp_path, **extra_kwargs):
+    containers_dir = tmp_path / "containers"
+    containers_dir.mkdir(parents=True, exist_ok=True)
+    keys_dir = tmp_path / "keys"
+    keys_dir.mkdir(parents=True, exist_ok=True)
+    handover_dir = tmp_path / "handover"
+    handover_dir.mkdir(parents=True, exist_ok=True)
+    return RecordingContainerStorage(
+        default_encryption_conf=get_encryption_conf("test"),
+        containers_dir=containers_dir,
+        key_storage_pool=FilesystemKeyStoragePool(keys_dir),
+        handover_dir=handover_dir,
+        **extra_kwargs
+    )
+
+
+@pytest.mark.parametrize("executor_backend", ["thread", "process"])
+def test_recording_container_storage_worker_pool(tmp_path, executor_backend):
+
+    container_storage = _get_container_storage(tmp_path, executor_backend=executor_backend, max_workers=3)
+
+    stats = container_storage.get_encryption_stats()
+    assert stats["executor_backend"] == executor_backend
+    assert stats["max_workers"] == 3
+    assert stats["queue_depth"] == 0
+    assert stats["processed_count"] == 0
+    assert stats["average_latency_s"] is None
+
+    for idx in range(5):
+        data = b"xyz%d" % idx
+        if idx % 2:
+            data = io.BytesIO(data)  # Streams are supported too
+        container_storage.enqueue_file_for_encryption(filename_base="file%d" % idx, data=data, metadata=None)
+
+    assert container_storage.get_encryption_stats()["queue_depth"] >= 1
+
+    container_storage.wait_for_idle_state()
+
+    stats = container_storage.get_encryption_stats()
+    assert stats["queue_depth"] == 0
+    assert stats["processed_count"] == 5
+    assert stats["failed_count"] == 0
+    assert 0 < stats["average_encryption_duration_s"] <= stats["average_latency_s"] <= stats["max_latency_s"]
+
+    assert len(container_storage) == 5
+    for idx in range(5):
+        assert container_storage.decrypt_container_from_storage("file%d.crypt" % idx) == b"xyz%d" % idx
+
+    assert not list((tmp_path / "handover").iterdir())  # Plaintexts don't linger on disk
+
+
+@pytest.mark.parametrize("executor_backend", ["thread", "process"])
+def test_recording_container_storage_encryption_queue(tmp_path, executor_backend):
+
+    # Block policy: no container is lost
+
+    container_storage = _get_container_storage(
+        tmp_path / "block", executor_backend=executor_backend, max_workers=1, queue_size=1
+    )
+    for idx in range(4):
+        container_storage.enqueue_file_for_encryption(filename_base="file%d" % idx, data=b"abc", metadata=None)
+    container_storage.wait_for_idle_state()
+
+    stats = container_storage.get_encryption_stats()
+    assert stats["processed_count"] == 4
+    assert stats["queue"]["enqueued_count"] == 4
+    assert stats["queue"]["dropped_count"] == 0
+    assert len(container_storage) == 4
+    assert not list((tmp_path / "block" / "handover").iterdir())
+
+
+def test_recording_container_storage_encryption_queue_overflow(tmp_path):
+
+    container_storage = _get_container_storage(tmp_path, max_workers=1, queue_size=1, overflow_policy="drop_oldest")
+
+    streams = [io.BytesIO(b"xyz%d" % idx) for idx in range(6)]
+    for idx, data in enumerate(streams):
+        container_storage.enqueue_file_for_encryption(filename_base="file%d" % idx, data=data, metadata=None)
+    container_storage.wait_for_idle_state()
+
+    stats = container_storage.get_encryption_stats()
+    dropped_count = stats["queue"]["dropped_count"]
+    assert dropped_count >= 1  # Encryption is much slower than enqueuing
+    assert stats["processed_count"] == len(container_storage) == 6 - dropped_count
+    assert container_storage.decrypt_container_from_storage("file5.crypt") == b"xyz5"  # Newest is kept
+    assert all(data.closed for data in streams)  # Including discarded ones
+
+
+def test_recording_container_storage_handover_files_purge(tmp_path):
+
+    handover_dir = tmp_path / "handover"
+    handover_dir.mkdir(parents=True, exist_ok=True)
+    orphaned_file = handover_dir / "container_plaintext_abcd"
+    orphaned_file.write_bytes(b"secret")
+    other_file = handover_dir / "other.dat"
+    other_file.write_bytes(b"stuff")
+
+    _get_container_storage(tmp_path, executor_backend="process")
+
+    assert not orphaned_file.exists()
+    assert other_file.exists()
+
+
+def test_recording_container_storage_purge_all_containers(tmp_path):
+
+    container_storage = _get_container_storage(tmp_path)
+    for idx in range(7):
+        container_storage.enqueue_file_for_encryption(filename_base="file%d" % idx, data=b"abc", metadata=None)
+    container_storage.wait_for_idle_state()
+    assert len(container_storage) == 7
+
+    containers_dir = tmp_path / "containers"
+    lost_data_filename = "lost" + CONTAINER_SUFFIX + OFFLOADED_DATA_SUFFIX
+    (containers_dir / lost_data_filename).write_bytes(b"xyz")  # Offloaded ciphertext of a lost container
+    (containers_dir / "pending.crypt").write_bytes(b"{")  # Container being written
+    container_storage._pending_container_names.add("pending.crypt")
+
+    progress = []
+    deleted_count = container_storage.purge_all_containers(
+        batch_size=3, progress_callback=lambda *args: progress.append(args)
+    )
+    assert deleted_count == 7
+    assert progress == [(3, 7), (6, 7), (7, 7)]
+    assert [filepath.name for filepath in containers_dir.iterdir()] == ["pending.crypt"]
+
+    container_storage._pending_container_names.clear()
+    assert container_storage.purge_all_containers() == 1
+    assert not list(containers_dir.iterdir())
+
+    container_storage.shutdown()
+    with pytest.raises(RuntimeError):  # Workers are released
+        container_storage.enqueue_file_for_encryption(filename_base="late", data=b"abc", metadata=None)
+
+
+def _measure_polling_jitter_during_encryption(tmp_path, executor_backend):
+
+    polling_interval_s = 0.02
+    timestamps = []
+
+    container_storage = _get_container_storage(tmp_path, executor_backend=executor_backend)
+    container_storage.enqueue_file_for_encryption(filename_base="warmup", data=b"abc", metadata=None)
+    container_storage.wait_for_idle_state()  # Workers and keys are ready
+
+    poller = PeriodicTaskHandler(interval_s=polling_interval_s, task_func=lambda: timestamps.append(time.monotonic()))
+    poller.start()
+    for idx in range(3):
+        container_storage.enqueue_file_for_encryption(
+            filename_base="file%d" % idx, data=os.urandom(3 * 1024 ** 2), metadata=None
+        )
+    container_storage.wait_for_idle_state()
+    poller.stop()
+    poller.join()
+
+    intervals = [(t2 - t1) for (t1, t2) in zip(timestamps, timestamps[1:])]
+    return statistics.pstdev(intervals), max(intervals)
+
+
+def test_sensor_polling_jitter_benchmark(tmp_path):
+
+    for executor_backend in ("thread", "process"):
+        jitter_stdev_s, max_interval_s = _measure_polling_jitter_during_encryption(
+            tmp_path / executor_backend, executor_backend=executor_backend
+        )
+        print(
+            "Polling jitter with %s encryption backend: stdev=%.4fs max_interval=%.4fs"
+            % (executor_backend, jitter_stdev_s, max_interval_s)
+        )
+        assert max_interval_s < 5
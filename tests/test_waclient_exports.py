@@ -0,0 +1,66 @@
+import gzip
+import io
+import json
+import os
+import tarfile
+import tracemalloc
+
+from waclient.utilities.exports import export_tarfile_stream
+from waclient.utilities.sensor_data import SENSOR_DATA_EXTENSION, encode_sensor_data
+
+
+def _build_tarfile_bytes(members):
+    tarfile_bytesio = io.BytesIO()
+    with tarfile.open(mode="w", fileobj=tarfile_bytesio) as tarfile_obj:
+        for member_name, data in members.items():
+            tarinfo = tarfile.TarInfo(member_name)
+            tarinfo.size = len(data)
+            tarfile_obj.addfile(tarinfo, io.BytesIO(data))
+        tarinfo = tarfile.TarInfo("somedir")
+        tarinfo.type = tarfile.DIRTYPE
+        tarfile_obj.addfile(tarinfo)
+    return tarfile_bytesio.getvalue()
+
+
+def test_export_tarfile_stream(tmp_path):
+
+    audio_data = os.urandom(20 * 1024 ** 2)
+    gyroscope_columns = {"timestamp": [1.0, 2.0], "x": [0.5, 0.25]}
+    tarfile_bytes = _build_tarfile_bytes(
+        {
+            "20200101_000000_microphone.mp4": audio_data,
+            "20200101_000000_gyroscope" + SENSOR_DATA_EXTENSION + ".gz": gzip.compress(
+                encode_sensor_data(gyroscope_columns, scales=dict(timestamp=1000, x=1000))
+            ),
+            "20200101_000000_gps_status.json.gz": gzip.compress(b'[{"status": "ok"}]'),
+            "20200101_000000_notes.txt": gzip.compress(b"abc", mtime=0),  # Looks compressed, but isn't named so
+            "../escaping.txt": b"abc",
+        }
+    )
+
+    for idx, payload in enumerate([tarfile_bytes, gzip.compress(tarfile_bytes, compresslevel=1)]):
+
+        target_directory = tmp_path / str(idx)
+        target_directory.mkdir()
+
+        tracemalloc.start()
+        exported_filepaths = export_tarfile_stream(io.BytesIO(payload), target_directory=target_directory)
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("Tarfile of %d bytes exported with %d KB peak memory" % (len(payload), peak_memory // 1024))
+        assert peak_memory < 4 * 1024 ** 2  # Independent from the size of members
+
+        assert sorted(filepath.name for filepath in exported_filepaths) == sorted(
+            filepath.name for filepath in target_directory.iterdir()
+        ) == [
+            "20200101_000000_gps_status.json",
+            "20200101_000000_gyroscope.json",
+            "20200101_000000_microphone.mp4",
+            "20200101_000000_notes.txt",
+            "escaping.txt",
+        ]
+        assert target_directory.joinpath("20200101_000000_microphone.mp4").read_bytes() == audio_data
+        assert json.loads(target_directory.joinpath("20200101_000000_gyroscope.json").read_text()) == gyroscope_columns
+        assert target_directory.joinpath("20200101_000000_gps_status.json").read_bytes() == b'[{"status": "ok"}]'
+        assert target_directory.joinpath("20200101_000000_notes.txt").read_bytes() == gzip.compress(b"abc", mtime=0)
+        assert target_directory.joinpath("escaping.txt").read_bytes() == b"abc"
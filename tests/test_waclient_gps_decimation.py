@@ -0,0 +1,82 @@
+import pytest
+
+from waclient.utilities.gps_decimation import GpsFixDecimator, get_distance_m, get_distance_to_segment_m
+
+METER_IN_DEGREES = 1 / 111195  # Along a meridian
+
+
+def _make_fix(north_m, east_m=0, timestamp=0):
+    # Around the equator, where degrees of latitude and longitude have the same length
+    return dict(lat=north_m * METER_IN_DEGREES, lon=east_m * METER_IN_DEGREES, timestamp=timestamp, altitude=10)
+
+
+def _get_point(fix):
+    return fix["lat"], fix["lon"]
+
+
+def test_geographic_distances():
+
+    assert get_distance_m((48.8566, 2.3522), (48.8566, 2.3522)) == 0
+    assert get_distance_m((0, 0), (100 * METER_IN_DEGREES, 0)) == pytest.approx(100, rel=0.001)
+    assert get_distance_m((48.8566, 2.3522), (51.5074, -0.1278)) == pytest.approx(343500, rel=0.01)  # Paris-London
+
+    start, end = _get_point(_make_fix(0)), _get_point(_make_fix(100))
+    assert get_distance_to_segment_m(_get_point(_make_fix(50, 3)), start, end) == pytest.approx(3, rel=0.001)
+    assert get_distance_to_segment_m(_get_point(_make_fix(-4)), start, end) == pytest.approx(4, rel=0.001)
+    assert get_distance_to_segment_m(_get_point(_make_fix(105)), start, end) == pytest.approx(5, rel=0.001)
+    assert get_distance_to_segment_m(_get_point(_make_fix(3, 4)), start, start) == pytest.approx(5, rel=0.001)
+
+
+def test_gps_fix_decimator_min_distance_and_time():
+
+    emitted_fixes = []
+    decimator = GpsFixDecimator(emitted_fixes.append, min_distance_m=5, min_time_s=2)
+
+    decimator.add_fix(_make_fix(0, timestamp=0))
+    decimator.add_fix(_make_fix(10, timestamp=1))  # Too early
+    decimator.add_fix(_make_fix(3, timestamp=3))  # Too close
+    decimator.add_fix(_make_fix(6, timestamp=4))
+    decimator.add_fix(dict(altitude=3, timestamp=4))  # Forwarded as is
+    decimator.add_fix(_make_fix(7, timestamp=10))  # Stationary phone
+
+    assert [fix["timestamp"] for fix in emitted_fixes] == [0, 4, 4]
+    assert emitted_fixes[-1] == dict(altitude=3, timestamp=4)
+    assert decimator.received_fixes_count == 6
+    assert decimator.dropped_fixes_count == 3
+
+    decimator.flush()
+    assert len(emitted_fixes) == 3  # Nothing held back without simplifier
+
+    decimator.reset()
+    assert decimator.received_fixes_count == decimator.dropped_fixes_count == 0
+
+
+def test_gps_fix_decimator_track_simplification():
+
+    emitted_fixes = []
+    decimator = GpsFixDecimator(emitted_fixes.append, max_error_m=2)
+
+    # Straight line northwards with small noise, then a turn eastwards
+    track = [(0, 0), (10, 1), (20, -1), (30, 0), (40, 1.5), (50, 0), (50, 10), (50, 20), (51, 30)]
+    for timestamp, (north_m, east_m) in enumerate(track):
+        decimator.add_fix(_make_fix(north_m, east_m, timestamp=timestamp))
+
+    assert [fix["timestamp"] for fix in emitted_fixes] == [0, 5]  # Start and corner of the track
+    decimator.flush()
+    assert [fix["timestamp"] for fix in emitted_fixes] == [0, 5, 8]  # End of the track
+    assert decimator.dropped_fixes_count == 6
+    assert emitted_fixes[1]["altitude"] == 10  # Fixes are forwarded untouched
+
+    # Each flush starts a new track
+    decimator.add_fix(_make_fix(60, timestamp=20))
+    assert emitted_fixes[-1]["timestamp"] == 20
+
+    # Zigzags beyond tolerance are fully kept
+    emitted_fixes[:] = []
+    decimator.reset()
+    decimator.flush()
+    for timestamp in range(6):
+        decimator.add_fix(_make_fix(timestamp * 10, east_m=(timestamp % 2) * 10, timestamp=timestamp))
+    decimator.flush()
+    assert len(emitted_fixes) == 6
+    assert decimator.dropped_fixes_count == 0
@@ -0,0 +1,158 @@
+import pickle
+import time
+import uuid
+
+import pytest
+
+from waclient.key_storage import AdaptiveFreeKeysGenerator, FreeKeysStats, MonitoredFilesystemKeyStoragePool
+from wacryptolib.exceptions import KeyDoesNotExist
+
+
+def _fake_key_generation_func(key_type, serialize):
+    time.sleep(0.01)
+    return dict(public_key=b"public-" + key_type.encode(), private_key=b"private-" + key_type.encode())
+
+
+def test_monitored_key_storage_pool(tmp_path):
+
+    key_storage_pool = MonitoredFilesystemKeyStoragePool(tmp_path)
+    free_keys_stats = key_storage_pool.free_keys_stats
+    assert free_keys_stats.get_stats("RSA_OAEP") == dict(
+        hits=0, misses=0, hit_ratio=None, consumption_rate_per_min=0
+    )
+
+    local_key_storage = key_storage_pool.get_local_key_storage()
+    local_key_storage.add_free_keypair(key_type="RSA_OAEP", public_key=b"pub", private_key=b"priv")
+
+    other_local_key_storage = key_storage_pool.get_local_key_storage()  # Shares statistics
+    other_local_key_storage.attach_free_keypair_to_uuid(keychain_uid=uuid.uuid4(), key_type="RSA_OAEP")
+    with pytest.raises(KeyDoesNotExist):
+        local_key_storage.attach_free_keypair_to_uuid(keychain_uid=uuid.uuid4(), key_type="RSA_OAEP")
+
+    stats = free_keys_stats.get_stats("RSA_OAEP")
+    assert stats["hits"] == stats["misses"] == 1
+    assert stats["hit_ratio"] == 0.5
+    assert stats["consumption_rate_per_min"] == pytest.approx(120)  # Rate window is at least 1s
+    assert free_keys_stats.get_stats("DSA_DSS")["hits"] == 0
+
+    # Statistics are not shared with other processes
+    unpickled_key_storage_pool = pickle.loads(pickle.dumps(key_storage_pool))
+    assert unpickled_key_storage_pool.free_keys_stats.get_stats("RSA_OAEP")["hits"] == 0
+
+
+def test_free_keys_stats_consumption_rate():
+
+    free_keys_stats = FreeKeysStats()
+    free_keys_stats.rate_window_size = 5
+    for _ in range(10):
+        free_keys_stats.record_consumption("ECC_DSS", is_hit=True)
+        time.sleep(0.25)
+    # Only the latest consumptions matter
+    assert free_keys_stats.get_consumption_rate_per_s("ECC_DSS") == pytest.approx(4, rel=0.3)
+    assert free_keys_stats.get_consumption_rate_per_s("RSA_OAEP") == 0
+
+
+def test_adaptive_free_keys_generator(tmp_path):
+
+    key_storage_pool = MonitoredFilesystemKeyStoragePool(tmp_path)
+    free_keys_stats = key_storage_pool.free_keys_stats
+    local_key_storage = key_storage_pool.get_local_key_storage()
+    key_types = ["RSA_OAEP", "DSA_DSS"]
+
+    generator = AdaptiveFreeKeysGenerator(
+        key_storage=local_key_storage,
+        key_types=key_types,
+        max_free_keys_per_type=4,
+        free_keys_stats=free_keys_stats,
+        reserve_horizon_s=1,
+        min_sleep_s=0.1,
+        max_sleep_s=10,
+        key_generation_func=_fake_key_generation_func,
+    )
+
+    # Until consumption is known, reserves are full
+
+    generator.start()
+    time.sleep(0.5)
+    assert generator.is_running
+    for key_type in key_types:
+        assert local_key_storage.get_free_keypairs_count(key_type) == 4
+
+    # Consumption wakes the generator up at once
+
+    for _ in range(3):
+        key_storage_pool.get_local_key_storage().attach_free_keypair_to_uuid(
+            keychain_uid=uuid.uuid4(), key_type="RSA_OAEP"
+        )
+    time.sleep(0.3)
+    assert local_key_storage.get_free_keypairs_count("RSA_OAEP") == 4
+
+    start_time = time.monotonic()
+    generator.stop()
+    generator.join()
+    assert time.monotonic() - start_time < 1  # Long sleeps are interrupted
+
+    # Reserves then follow consumption rates
+
+    time.sleep(0.6)  # Past reserve horizon
+    assert generator.get_target_reserve("DSA_DSS") == 1  # Not consumed at all
+    assert 2 <= generator.get_target_reserve("RSA_OAEP") <= 3  # 3 keys consumed in ~1.5s
+
+    stats = generator.get_stats()
+    assert stats["RSA_OAEP"]["hits"] == 3
+    assert stats["RSA_OAEP"]["misses"] == 0
+    assert stats["RSA_OAEP"]["generated_count"] == 7
+    assert stats["RSA_OAEP"]["free_keys_count"] == 4
+    assert stats["RSA_OAEP"]["target_reserve"] in (2, 3)
+    assert stats["RSA_OAEP"]["average_generation_duration_s"] >= 0.01
+    assert stats["DSA_DSS"]["generated_count"] == 4
+
+    # Without consumption tracking, max reserves are kept
+
+    unmonitored_generator = AdaptiveFreeKeysGenerator(
+        key_storage=local_key_storage, key_types=key_types, max_free_keys_per_type=6, reserve_horizon_s=0
+    )
+    assert unmonitored_generator.get_target_reserve("DSA_DSS") == 6
+    assert "hits" not in unmonitored_generator.get_stats()["DSA_DSS"]
+
+    generator.start()  # Restartable
+    generator.stop()
+    generator.join()
+
+
+def test_adaptive_free_keys_generator_with_process_workers(tmp_path):
+
+    key_storage_pool = MonitoredFilesystemKeyStoragePool(tmp_path)
+    local_key_storage = key_storage_pool.get_local_key_storage()
+    key_types = ["RSA_OAEP", "DSA_DSS", "ECC_DSS"]
+
+    generator = AdaptiveFreeKeysGenerator(
+        key_storage=local_key_storage,
+        key_types=key_types,
+        max_free_keys_per_type=3,
+        free_keys_stats=key_storage_pool.free_keys_stats,
+        key_generation_func=_fake_key_generation_func,
+        generation_workers_count=3,
+    )
+    assert generator._select_key_types_to_generate(dict(RSA_OAEP=2, DSA_DSS=1, ECC_DSS=0)) == [
+        "RSA_OAEP",
+        "RSA_OAEP",
+        "DSA_DSS",
+    ]
+    assert generator._select_key_types_to_generate(dict(RSA_OAEP=0, DSA_DSS=-1, ECC_DSS=0)) == []
+    assert generator.get_warmup_progress() == 0
+
+    generator.start()
+    for _ in range(100):
+        if generator.get_warmup_progress() == 1:
+            break
+        time.sleep(0.1)
+    generator.stop()
+    generator.join()
+
+    assert generator.get_warmup_progress() == 1
+    stats = generator.get_stats()
+    for key_type in key_types:
+        assert local_key_storage.get_free_keypairs_count(key_type) == 3
+        assert stats[key_type]["generated_count"] == 3
+        assert stats[key_type]["average_generation_duration_s"] >= 0.01
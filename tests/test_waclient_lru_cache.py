@@ -0,0 +1,26 @@
+from waclient.utilities.lru_cache import LruCache
+
+
+def test_lru_cache():
+
+    cache = LruCache(max_size=2)
+    assert cache.get("a") is None
+    assert cache.get("a", default=33) == 33
+
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # Now most recently used
+    cache.set("c", 3)
+    assert len(cache) == 2
+    assert cache.get("b") is None  # Evicted
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+    cache.set("a", 11)  # Replacement also counts as a use
+    cache.set("d", 4)
+    assert cache.get("a") == 11
+    assert cache.get("c") is None
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.get("a") is None
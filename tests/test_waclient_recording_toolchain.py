@@ -1,4 +1,8 @@
+import gzip
+import math
 import os
+import subprocess
+import sys
 import time
 
 from kivy.config import ConfigParser
@@ -9,14 +13,22 @@ from waclient.common_config import (
     INTERNAL_KEYS_DIR,
     get_encryption_conf,
 )
+from waclient.sensors.registry import (
+    get_compressible_record_names,
+    get_registered_sensor_names,
+    register_sensor,
+    unregister_sensor,
+)
+from waclient.utilities.sensor_data import decode_sensor_data
 from waclient.recording_toolchain import (
     build_recording_toolchain,
     start_recording_toolchain,
     stop_recording_toolchain,
+    update_recording_toolchain,
 )
 from wacryptolib.key_storage import FilesystemKeyStorage, FilesystemKeyStoragePool
 from wacryptolib.sensor import TarfileRecordsAggregator
-from wacryptolib.utilities import load_from_json_bytes
+from wacryptolib.utilities import load_from_json_bytes, TaskRunnerStateMachineBase
 
 
 def test_nominal_recording_toolchain_case():
@@ -47,7 +59,9 @@ def test_nominal_recording_toolchain_case():
 
     start_recording_toolchain(toolchain)
     time.sleep(2)
-    stop_recording_toolchain(toolchain)
+    report = stop_recording_toolchain(toolchain, timeout_s=30)
+    assert list(report["stage_durations_s"]) == ["sensors", "data_aggregators", "tarfile_aggregators", "encryption"]
+    assert report["timed_out_stages"] == []
 
     for i in range(2):
         assert not sensors_manager.is_running
@@ -72,28 +86,30 @@ def test_nominal_recording_toolchain_case():
 
     gyroscope_filenames = [m for m in tarfile_members if "gyroscope" in m]
     assert len(gyroscope_filenames) == 1
-    assert gyroscope_filenames[0].endswith(".json")
+    assert gyroscope_filenames[0].endswith(".json")  # Uncompressed by default
 
     json_bytestring = tar_file.extractfile(gyroscope_filenames[0]).read()
     gyroscope_data = load_from_json_bytes(json_bytestring)
-    assert isinstance(gyroscope_data, list)
-    assert len(gyroscope_data) >= 4
-    assert gyroscope_data[0] == {
-        "rotation_rate_x": None,
-        "rotation_rate_y": None,
-        "rotation_rate_z": None,
+    assert isinstance(gyroscope_data, dict)  # Columnar format
+    assert set(gyroscope_data) == {
+        "timestamp", "rotation_rate_x", "rotation_rate_y", "rotation_rate_z", "polling_interval_s"
     }
+    assert len(gyroscope_data["timestamp"]) >= 4
+    assert all(value is None for value in gyroscope_data["rotation_rate_x"])  # Fake values
+    assert set(gyroscope_data["polling_interval_s"]) == {0.5}  # Default fixed rate
 
     # GPS data
 
-    microphone_filenames = [m for m in tarfile_members if "gps" in m]
-    assert len(microphone_filenames) == 1
-    assert microphone_filenames[0].endswith(".json")
+    gps_filenames = [m for m in tarfile_members if "gps" in m]
+    assert len(gps_filenames) == 1
+    assert gps_filenames[0].endswith(".json")
 
-    json_bytestring = tar_file.extractfile(microphone_filenames[0]).read()
-    gyroscope_data = load_from_json_bytes(json_bytestring)
-    # Fake data pushed by sensor
-    assert gyroscope_data == [{'altitude': 2.2}, {'message_type': 'some_message_type', 'status': 'some_status_value'}]
+    json_bytestring = tar_file.extractfile(gps_filenames[0]).read()
+    gps_data = load_from_json_bytes(json_bytestring)
+    # Fake data pushed by sensor, locations being timestamped
+    assert [{key: value for (key, value) in entry.items() if key != "timestamp"} for entry in gps_data] == [
+        {'altitude': 2.2}, {'message_type': 'some_message_type', 'status': 'some_status_value'}
+    ]
 
     # Microphone data
 
@@ -103,3 +119,242 @@ def test_nominal_recording_toolchain_case():
 
     mp4_bytestring = tar_file.extractfile(microphone_filenames[0]).read()
     assert mp4_bytestring == b"fake_microphone_recording_data"
+
+
+def test_recording_toolchain_binary_sensor_data():
+
+    config = ConfigParser()
+    config.setdefaults("usersettings",
+                       {"record_gyroscope": 1,
+                        "record_gps": 1,
+                        "record_microphone": 0,
+                        "sensor_data_encoding": "binary",
+                        "sensor_data_compression": "gzip"})
+
+    key_storage_pool = FilesystemKeyStoragePool(INTERNAL_KEYS_DIR)
+    toolchain = build_recording_toolchain(
+        config, key_storage_pool=key_storage_pool, encryption_conf=get_encryption_conf("test")
+    )
+    container_storage = toolchain["container_storage"]
+
+    purge_test_containers()
+
+    start_recording_toolchain(toolchain)
+    time.sleep(2)
+    stop_recording_toolchain(toolchain, timeout_s=30)
+
+    (container_name,) = container_storage.list_container_names(as_sorted=True)
+    tar_file = TarfileRecordsAggregator.read_tarfile_from_bytestring(
+        container_storage.decrypt_container_from_storage(container_name)
+    )
+    tarfile_members = tar_file.getnames()
+    assert len(tarfile_members) == 3
+
+    (gyroscope_filename,) = [m for m in tarfile_members if "gyroscope" in m]
+    assert gyroscope_filename.endswith(".wasd.gz")
+    gyroscope_data = decode_sensor_data(gzip.decompress(tar_file.extractfile(gyroscope_filename).read()))
+    assert len(gyroscope_data["timestamp"]) >= 4
+    assert all(math.isnan(value) for value in gyroscope_data["rotation_rate_x"])  # Fake values
+
+    # Non-numeric status messages of GPS get their own json member
+    (gps_filename,) = [m for m in tarfile_members if "_gps." in m]
+    assert gps_filename.endswith(".wasd.gz")
+    gps_data = decode_sensor_data(gzip.decompress(tar_file.extractfile(gps_filename).read()))
+    assert gps_data["altitude"] == [2.2]
+    assert math.isnan(gps_data["lat"][0])
+
+    (gps_status_filename,) = [m for m in tarfile_members if "gps_status" in m]
+    assert gps_status_filename.endswith(".json.gz")
+    gps_status_data = load_from_json_bytes(gzip.decompress(tar_file.extractfile(gps_status_filename).read()))
+    assert gps_status_data == [{'message_type': 'some_message_type', 'status': 'some_status_value'}]
+
+
+def _wait_for_containers_count(container_storage, count, timeout_s=10):
+    # Done callbacks of encryption futures might run after wait_for_idle_state() returns
+    container_storage.wait_for_idle_state()
+    deadline = time.monotonic() + timeout_s
+    while len(container_storage) != count:
+        if time.monotonic() > deadline:
+            raise AssertionError(
+                "Container storage never reached %d containers (got %d)" % (count, len(container_storage))
+            )
+        time.sleep(0.1)
+
+
+def test_recording_toolchain_hot_reconfiguration():
+
+    config = ConfigParser()
+    config.setdefaults("usersettings",
+                       {"record_gyroscope": 1,
+                        "record_gps": 1,
+                        "record_microphone": 0,
+                        "polling_interval_s": 0.5})
+
+    key_storage_pool = FilesystemKeyStoragePool(INTERNAL_KEYS_DIR)
+    encryption_conf = get_encryption_conf("test")
+
+    def _update_toolchain(toolchain):
+        return update_recording_toolchain(
+            toolchain, config, key_storage_pool=key_storage_pool, encryption_conf=encryption_conf
+        )
+
+    purge_test_containers()
+
+    toolchain = build_recording_toolchain(
+        config, key_storage_pool=key_storage_pool, encryption_conf=encryption_conf
+    )
+    start_recording_toolchain(toolchain)
+    time.sleep(1.1)  # Container names have a precision of one second, so they must not collide
+    stop_recording_toolchain(toolchain)
+
+    container_storage = toolchain["container_storage"]
+    free_keys_generator_worker = toolchain["free_keys_generator_worker"]
+    sensors = dict(toolchain["sensors"])
+    assert sensors["microphone"] is None
+
+    assert _update_toolchain(toolchain) is toolchain  # Nothing changed
+    start_recording_toolchain(toolchain)
+    time.sleep(1.1)
+    stop_recording_toolchain(toolchain)
+
+    # Pollers are retuned in place
+
+    config.set("usersettings", "polling_interval_s", 0.2)
+    config.set("usersettings", "container_member_duration_s", 3)
+    assert _update_toolchain(toolchain) is toolchain
+    assert toolchain["container_storage"] is container_storage
+    assert toolchain["free_keys_generator_worker"] is free_keys_generator_worker
+    assert toolchain["sensors"] == sensors
+    assert sensors["gyroscope"].polling_interval_s == 0.2
+    assert sensors["gps"]._interval_s == 0.2
+    for data_aggregator in toolchain["data_aggregators"]:
+        assert data_aggregator._max_duration_s == 3
+
+    # Sensors are toggled individually
+
+    sensors_manager = toolchain["sensors_manager"]
+    config.set("usersettings", "record_gps", 0)
+    config.set("usersettings", "record_microphone", 1)
+    assert _update_toolchain(toolchain) is toolchain
+    assert toolchain["sensors"]["gyroscope"] is sensors["gyroscope"]
+    assert toolchain["sensors"]["gps"] is None
+    assert toolchain["sensors"]["microphone"] is not None
+    assert toolchain["sensors_manager"] is not sensors_manager
+
+    start_recording_toolchain(toolchain)
+    time.sleep(1.1)
+    stop_recording_toolchain(toolchain)
+
+    _wait_for_containers_count(container_storage, 3)
+    tar_file = TarfileRecordsAggregator.read_tarfile_from_bytestring(
+        container_storage.decrypt_container_from_storage(2)
+    )
+    sensor_names = sorted(member_name.split("_")[2].split(".")[0] for member_name in tar_file.getnames())
+    assert sensor_names == ["gyroscope", "microphone"]
+
+    # Other settings require a full rebuild
+
+    config.set("usersettings", "sensor_data_encoding", "binary")
+    new_toolchain = _update_toolchain(toolchain)
+    assert new_toolchain is not toolchain
+    assert new_toolchain["container_storage"] is not container_storage
+    assert new_toolchain["settings"]["sensor_data_encoding"] == "binary"
+
+    new_toolchain2 = update_recording_toolchain(
+        new_toolchain, config, key_storage_pool=key_storage_pool, encryption_conf=get_encryption_conf("test")
+    )
+    assert new_toolchain2 is new_toolchain  # Equal encryption confs
+
+    config.set("usersettings", "record_gyroscope", 0)
+    config.set("usersettings", "record_microphone", 0)
+    assert _update_toolchain(new_toolchain) is None
+
+
+def test_recording_toolchain_stop_timeout():
+
+    config = ConfigParser()
+    config.setdefaults("usersettings", {"record_gyroscope": 1, "record_gps": 0, "record_microphone": 0})
+
+    key_storage_pool = FilesystemKeyStoragePool(INTERNAL_KEYS_DIR)
+    encryption_conf = get_encryption_conf("test")
+    toolchain = build_recording_toolchain(
+        config, key_storage_pool=key_storage_pool, encryption_conf=encryption_conf
+    )
+    assert not toolchain["is_broken"]
+
+    start_recording_toolchain(toolchain)
+    time.sleep(0.5)
+    report = stop_recording_toolchain(toolchain, timeout_s=0)  # Sensors can't be stopped in time
+
+    assert report["timed_out_stages"] == ["sensors"]
+    assert report["skipped_stages"] == ["data_aggregators", "tarfile_aggregators", "encryption"]
+    assert toolchain["is_broken"]
+
+    deadline = time.monotonic() + 10
+    while toolchain["sensors_manager"].is_running:  # Abandoned stop goes on in background
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+    new_toolchain = update_recording_toolchain(
+        toolchain, config, key_storage_pool=key_storage_pool, encryption_conf=encryption_conf
+    )
+    assert new_toolchain is not toolchain  # Even if config didn't change
+    assert not new_toolchain["is_broken"]
+
+    start_recording_toolchain(new_toolchain)
+    report = stop_recording_toolchain(new_toolchain, timeout_s=30)
+    assert report["timed_out_stages"] == report["skipped_stages"] == []
+
+
+def test_recording_toolchain_sensor_registry():
+
+    # Disabled sensors, and their platform backends, are never imported (plyer facades are harmless)
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            "import sys; import waclient.recording_toolchain; "
+            "print(sorted(name for name in sys.modules if name.startswith('waclient.sensors.') "
+            "or (name.startswith('plyer.platforms.') and name.endswith(('.gps', '.gyroscope')))))",
+        ],
+        universal_newlines=True,
+    )
+    # Only the last line matters, since importing common_config prints a summary of folders
+    assert output.strip().splitlines()[-1] == "['waclient.sensors.fields', 'waclient.sensors.registry']"
+
+    built_toolchains = []
+
+    class FakeSensor(TaskRunnerStateMachineBase):
+        sensor_name = "fake"
+
+    def _build_fake_sensor(toolchain):
+        built_toolchains.append(toolchain)
+        return FakeSensor()
+
+    config = ConfigParser()
+    config.setdefaults("usersettings", {"record_fake": 1})
+
+    key_storage_pool = FilesystemKeyStoragePool(INTERNAL_KEYS_DIR)
+    encryption_conf = get_encryption_conf("test")
+
+    register_sensor("fake", _build_fake_sensor, compressible_records=("fake",))
+    try:
+        assert get_registered_sensor_names() == ["gyroscope", "gps", "microphone", "camera", "fake"]
+        assert get_compressible_record_names() == ["gyroscope", "gps", "gps_status", "fake"]
+        toolchain = build_recording_toolchain(
+            config, key_storage_pool=key_storage_pool, encryption_conf=encryption_conf
+        )
+        assert built_toolchains == [toolchain]
+        assert isinstance(toolchain["sensors"]["fake"], FakeSensor)
+        assert toolchain["sensors"]["gps"] is None
+        assert toolchain["settings"]["record_fake"] == 1
+
+        config.set("usersettings", "record_fake", 0)
+        config.set("usersettings", "record_gyroscope", 1)
+        assert update_recording_toolchain(
+            toolchain, config, key_storage_pool=key_storage_pool, encryption_conf=encryption_conf
+        ) is toolchain
+        assert toolchain["sensors"]["fake"] is None
+        assert toolchain["sensors"]["gyroscope"] is not None
+    finally:
+        unregister_sensor("fake")
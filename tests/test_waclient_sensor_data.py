@@ -0,0 +1,95 @@
+import json
+import math
+import random
+
+import pytest
+
+from waclient.utilities.sensor_data import (
+    encode_sensor_data,
+    decode_sensor_data,
+    convert_sensor_data_file_to_json,
+    SENSOR_DATA_EXTENSION,
+)
+
+
+def test_sensor_data_encoding_roundtrip():
+
+    columns = {
+        "timestamp": [1600000000.123, 1600000000.623, 1600000001.124],
+        "x": [1.5, None, -2.25],
+        "y": [float("nan"), 3, 2 ** 40],
+    }
+    scales = dict(timestamp=1000, x=100, y=10)
+
+    data = encode_sensor_data(columns, scales=scales)
+    decoded_columns = decode_sensor_data(data)
+
+    assert list(decoded_columns) == ["timestamp", "x", "y"]
+    assert decoded_columns["timestamp"] == pytest.approx(columns["timestamp"], abs=0.001)
+    assert decoded_columns["x"][0] == 1.5 and math.isnan(decoded_columns["x"][1]) and decoded_columns["x"][2] == -2.25
+    assert math.isnan(decoded_columns["y"][0]) and decoded_columns["y"][1:] == [3, 2 ** 40]
+
+    # Fixed-point precision is 1/scale
+    (value,) = decode_sensor_data(encode_sensor_data({"z": [1.23456]}, scales=dict(z=100)))["z"]
+    assert value == 1.23
+
+    # Non-finite values are stored as missing, instead of breaking the whole member
+    values = decode_sensor_data(encode_sensor_data({"z": [1, math.inf, -math.inf, 2]}, scales=dict(z=10)))["z"]
+    assert values[0] == 1 and math.isnan(values[1]) and math.isnan(values[2]) and values[3] == 2
+
+    assert decode_sensor_data(encode_sensor_data({}, scales={})) == {}
+    assert decode_sensor_data(encode_sensor_data({"z": []}, scales=dict(z=1))) == {"z": []}
+
+    with pytest.raises(AssertionError):
+        encode_sensor_data({"a": [1], "b": [1, 2]}, scales=dict(a=1, b=1))
+
+    with pytest.raises(ValueError, match="Not a binary sensor data file"):
+        decode_sensor_data(b"[{}]" + data)
+
+    with pytest.raises(ValueError, match="Unsupported"):
+        decode_sensor_data(data[:4] + b"\x09" + data[5:])
+
+
+def test_sensor_data_encoding_delta_widths():
+
+    for step, expected_max_size in ((1, 140), (1000, 240), (10 ** 6, 440), (10 ** 12, 840)):
+        values = [idx * step for idx in range(100)]
+        data = encode_sensor_data({"v": values}, scales=dict(v=1))
+        assert len(data) < expected_max_size, (step, len(data))
+        assert decode_sensor_data(data)["v"] == values
+
+
+def test_convert_sensor_data_file_to_json(tmp_path):
+
+    filepath = tmp_path / ("mysensor" + SENSOR_DATA_EXTENSION)
+    filepath.write_bytes(encode_sensor_data({"timestamp": [1.0, 2.0], "x": [3.5, None]}, scales=dict(timestamp=1, x=10)))
+
+    json_filepath = convert_sensor_data_file_to_json(filepath)
+
+    assert not filepath.exists()
+    assert json_filepath == tmp_path / "mysensor.json"
+    assert "NaN" not in json_filepath.read_text()
+    columns = json.loads(json_filepath.read_text())
+    assert columns["timestamp"] == [1.0, 2.0]
+    assert columns["x"] == [3.5, None]
+
+
+def test_sensor_data_encoding_size_benchmark():
+
+    samples_count = 5000
+    columns = {
+        "timestamp": [1600000000 + idx * 0.5 for idx in range(samples_count)],
+        "lat": [48.8566 + random.uniform(-0.001, 0.001) for _ in range(samples_count)],
+        "lon": [2.3522 + random.uniform(-0.001, 0.001) for _ in range(samples_count)],
+        "altitude": [random.uniform(30, 40) for _ in range(samples_count)],
+    }
+    scales = dict(timestamp=1000, lat=10 ** 7, lon=10 ** 7, altitude=100)
+
+    binary_size = len(encode_sensor_data(columns, scales=scales))
+    columnar_json_size = len(json.dumps(columns))
+    dicts_json_size = len(json.dumps([dict(zip(columns, values)) for values in zip(*columns.values())]))
+    print(
+        "Size of %d GPS samples: binary=%dKB columnar_json=%dKB dicts_json=%dKB"
+        % (samples_count, binary_size // 1024, columnar_json_size // 1024, dicts_json_size // 1024)
+    )
+    assert binary_size * 3 < columnar_json_size < dicts_json_size
@@ -1,10 +1,16 @@
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from wacryptolib.sensor import TarfileRecordsAggregator, JsonDataAggregator
+import pytest
+
+from waclient.aggregators import SpoolingTarfileRecordsAggregator
+from waclient.common_config import INTERNAL_CACHE_DIR
+from wacryptolib.sensor import JsonDataAggregator
 from wacryptolib.utilities import load_from_json_bytes
 
 
-class FakeTarfileRecordsAggregator(TarfileRecordsAggregator):
+class FakeTarfileRecordsAggregator(SpoolingTarfileRecordsAggregator):
     def __init__(self):
         self._test_records = []
 
@@ -12,6 +18,12 @@ class FakeTarfileRecordsAggregator(TarfileRecordsAggregator):
         print("FakeTarfileRecordsAggregator->add_record()")
         self._test_records.append(kwargs)
 
+    def add_record_from_file(self, filepath, **kwargs):
+        print("FakeTarfileRecordsAggregator->add_record_from_file()")
+        data = filepath.read_bytes()
+        filepath.unlink()
+        self._test_records.append(dict(data=data, **kwargs))
+
     def finalize_tarfile(self):
         print("FakeTarfileRecordsAggregator->finalize_tarfile()")
         self._test_records = []
@@ -54,6 +66,307 @@ def test_gyroscope_sensor():
             assert "rotation_rate_x" in sensor_entry, sensor_entry
             assert "rotation_rate_y" in sensor_entry, sensor_entry
             assert "rotation_rate_z" in sensor_entry, sensor_entry
+            assert sensor_entry["polling_interval_s"] == 0.1, sensor_entry
+
+
+def test_gyroscope_sensor_adaptive_polling():
+
+    from waclient.sensors.gyroscope import get_gyroscope_sensor
+
+    fake_tarfile_aggregator = FakeTarfileRecordsAggregator()
+
+    json_aggregator = JsonDataAggregator(
+        max_duration_s=100, tarfile_aggregator=fake_tarfile_aggregator, sensor_name="test_gyroscope",
+    )
+
+    sensor = get_gyroscope_sensor(
+        json_aggregator=json_aggregator,
+        polling_interval_s=0.5,
+        adaptive_polling=True,
+        min_polling_interval_s=0.02,
+        max_polling_interval_s=0.16,
+    )
+    assert sensor.polling_interval_s == 0.16  # Initial interval is kept within bounds
+
+    rotation_rates = []
+    sensor._read_rotation_rate = lambda: rotation_rates[-1] if rotation_rates else (0, 0, 0)
+
+    sensor.start()
+    time.sleep(0.7)  # Device lies still
+    idle_interval_s = sensor.polling_interval_s
+
+    for idx in range(20):  # Device shakes
+        rotation_rates.append((idx % 2 * 3, 0, -(idx % 2)))
+        time.sleep(0.03)
+    motion_interval_s = sensor.polling_interval_s
+
+    sensor.stop()
+    sensor.join()
+
+    assert idle_interval_s == 0.16
+    assert motion_interval_s == 0.02
+
+    json_aggregator.flush_dataset()
+    (record,) = fake_tarfile_aggregator._test_records
+    sensor_entries = load_from_json_bytes(record["data"])
+    recorded_intervals_s = [sensor_entry["polling_interval_s"] for sensor_entry in sensor_entries]
+    assert 0.16 in recorded_intervals_s
+    assert recorded_intervals_s[-1] == 0.02  # Rate in use is recorded along with each sample
+
+
+def test_gyroscope_sensor_motion_callback():
+
+    from waclient.sensors.gyroscope import get_gyroscope_sensor
+
+    fake_tarfile_aggregator = FakeTarfileRecordsAggregator()
+
+    json_aggregator = JsonDataAggregator(
+        max_duration_s=100, tarfile_aggregator=fake_tarfile_aggregator, sensor_name="test_gyroscope",
+    )
+
+    callback_threads = []
+    unblock_event = threading.Event()
+
+    def _motion_callback():
+        callback_threads.append(threading.current_thread())
+        unblock_event.wait()  # E.g. sealing of a pre-event window
+
+    sensor = get_gyroscope_sensor(
+        json_aggregator=json_aggregator, polling_interval_s=0.02, motion_callback=_motion_callback
+    )
+
+    rotation_rates = []
+    sensor._read_rotation_rate = lambda: rotation_rates[-1] if rotation_rates else (0, 0, 0)
+
+    sensor.start()
+    for idx in range(20):  # Device shakes
+        rotation_rates.append((idx % 2 * 3, 0, -(idx % 2)))
+        time.sleep(0.03)
+    entries_count = len(json_aggregator)
+
+    sensor.stop()  # Not blocked by the pending motion callback
+    sensor.join()
+    unblock_event.set()
+
+    assert entries_count > 10  # Polling went on during the motion callback
+    assert len(callback_threads) == 1  # Not called again while in progress
+    assert callback_threads[0].name.startswith("gyroscope_motion")  # Not the polling thread
+
+
+@pytest.mark.parametrize("double_buffered", [False, True])
+def test_microphone_sensor(double_buffered):
+
+    from waclient.sensors.microphone import get_microphone_sensor
+
+    fake_tarfile_aggregator = FakeTarfileRecordsAggregator()
+
+    sensor = get_microphone_sensor(
+        interval_s=0.5, tarfile_aggregator=fake_tarfile_aggregator, double_buffered=double_buffered
+    )
+
+    sensor.start()
+
+    time.sleep(1.2)
+
+    sensor.stop()
+    sensor.join()
+
+    assert len(fake_tarfile_aggregator._test_records) == 3  # Two rotations, and final push
+
+    for record in fake_tarfile_aggregator._test_records:
+        assert record["sensor_name"] == "microphone"
+        assert record["extension"] == ".mp4"
+        assert record["data"] == b"fake_microphone_recording_data"
+        assert record["from_datetime"] <= record["to_datetime"]
+
+    records = fake_tarfile_aggregator._test_records
+    for previous_record, next_record in zip(records, records[1:]):
+        if double_buffered:
+            assert next_record["from_datetime"] <= previous_record["to_datetime"]  # Overlap, no audio lost
+        else:
+            assert next_record["from_datetime"] > previous_record["to_datetime"]
+
+    rotation_gaps_s = sensor.rotation_gaps_s
+    assert len(rotation_gaps_s) == 2
+    if double_buffered:
+        assert all(gap_s <= 0 for gap_s in rotation_gaps_s)
+    else:
+        assert all(gap_s > 0 for gap_s in rotation_gaps_s)  # Stop + prepare + start delays
+
+    assert not list(INTERNAL_CACHE_DIR.glob("temp_microphone_output_file*"))
+
+
+def test_microphone_sensor_output_paths_are_unique():
+
+    from waclient.sensors.microphone import get_microphone_sensor
+
+    sensor = get_microphone_sensor(interval_s=10, tarfile_aggregator=FakeTarfileRecordsAggregator())
+
+    # Paths are allocated both by the sensor thread and by the finalization executor
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        output_paths = list(executor.map(lambda _: sensor._get_next_output_path(), range(1000)))
+    assert len(set(output_paths)) == 1000
 
 
-# TODO complete with microphone and gps sensors!!
+def test_microphone_sensor_pending_temp_files():
+
+    from waclient.sensors.microphone import get_microphone_sensor
+
+    pending_filepath = INTERNAL_CACHE_DIR.joinpath("temp_microphone_output_file.1.dat")
+    pending_filepath.write_bytes(b"pending_microphone_recording_data")  # E.g. still in a pre-event window
+    stale_filepath = INTERNAL_CACHE_DIR.joinpath("temp_microphone_output_file.99.dat")
+    stale_filepath.write_bytes(b"stale_microphone_recording_data")
+
+    class PendingFilesTarfileRecordsAggregator(FakeTarfileRecordsAggregator):
+        def get_pending_record_filepaths(self):
+            return {pending_filepath}
+
+    fake_tarfile_aggregator = PendingFilesTarfileRecordsAggregator()
+    sensor = get_microphone_sensor(interval_s=10, tarfile_aggregator=fake_tarfile_aggregator)
+
+    sensor.start()
+    assert not stale_filepath.exists()
+    time.sleep(0.2)
+    sensor.stop()
+    sensor.join()
+
+    assert pending_filepath.read_bytes() == b"pending_microphone_recording_data"  # Neither deleted nor overwritten
+    (record,) = fake_tarfile_aggregator._test_records
+    assert record["data"] == b"fake_microphone_recording_data"
+
+    pending_filepath.unlink()
+
+
+@pytest.mark.parametrize("double_buffered", [False, True])
+def test_microphone_sensor_flush_current_segment(double_buffered):
+
+    from waclient.sensors.microphone import get_microphone_sensor
+
+    fake_tarfile_aggregator = FakeTarfileRecordsAggregator()
+    sensor = get_microphone_sensor(
+        interval_s=10, tarfile_aggregator=fake_tarfile_aggregator, double_buffered=double_buffered
+    )
+
+    sensor.flush_current_segment()  # No-op when not recording
+    sensor.start()
+    time.sleep(0.2)
+    sensor.flush_current_segment()
+    assert len(fake_tarfile_aggregator._test_records) == 1  # Pushed before returning
+    sensor.stop()
+    sensor.join()
+
+    records = fake_tarfile_aggregator._test_records
+    assert len(records) == 2
+    assert records[0]["to_datetime"] <= records[1]["to_datetime"]
+
+
+def test_camera_sensor():
+
+    from waclient.sensors.camera import FakeFrameSource, get_camera_sensor
+
+    fake_tarfile_aggregator = FakeTarfileRecordsAggregator()
+
+    sensor = get_camera_sensor(
+        frame_rate=10, tarfile_aggregator=fake_tarfile_aggregator, jpeg_quality=50, frame_source=FakeFrameSource(40, 30)
+    )
+
+    sensor.start()
+    time.sleep(1.05)
+    sensor.stop()
+    sensor.join()
+
+    records = fake_tarfile_aggregator._test_records
+    assert 8 <= len(records) <= 11
+    for record in records:
+        assert record["sensor_name"] == "camera"
+        assert record["extension"].endswith(".jpg")
+        assert record["data"].startswith(b"\xff\xd8fake_camera_frame_")
+        assert len(record["data"]) == 4 + 40 * 30 // 2
+    # Several frames are captured per second, but their member names must not collide
+    assert [record["extension"] for record in records] == [".%06d.jpg" % idx for idx in range(1, len(records) + 1)]
+    frame_stats = sensor.frame_stats
+    assert frame_stats["captured_count"] == len(records)
+    assert frame_stats["failed_count"] == frame_stats["skipped_count"] == 0
+    assert frame_stats["ring"]["dropped_count"] == 0
+
+
+def test_camera_sensor_bounded_resources():
+
+    from waclient.sensors.camera import FakeFrameSource, get_camera_sensor
+
+    class SlowFrameSource(FakeFrameSource):
+        simulated_capture_delay_s = 0.2  # Twice the frame budget
+
+    class SlowTarfileRecordsAggregator(FakeTarfileRecordsAggregator):
+        def add_record(self, **kwargs):
+            time.sleep(0.5)  # E.g. lagging encryption
+            super().add_record(**kwargs)
+
+    # Slow captures are paid back by skipped frames
+
+    sensor = get_camera_sensor(
+        frame_rate=10, tarfile_aggregator=FakeTarfileRecordsAggregator(), frame_source=SlowFrameSource(40, 30)
+    )
+    sensor.start()
+    time.sleep(2)
+    sensor.stop()
+    sensor.join()
+    frame_stats = sensor.frame_stats
+    assert frame_stats["captured_count"] <= 6  # Instead of 10 when ignoring the budget
+    assert frame_stats["skipped_count"] >= 3
+
+    # Frames overflowing the ring are dropped, oldest first
+
+    slow_tarfile_aggregator = SlowTarfileRecordsAggregator()
+    sensor = get_camera_sensor(
+        frame_rate=20,
+        tarfile_aggregator=slow_tarfile_aggregator,
+        ring_size=3,
+        frame_source=FakeFrameSource(40, 30),
+    )
+    sensor.start()
+    time.sleep(1)
+    sensor.stop()
+    sensor.join()
+    frame_stats = sensor.frame_stats
+    assert frame_stats["ring"]["max_depth"] <= 3
+    assert frame_stats["ring"]["dropped_count"] >= 5
+    records = slow_tarfile_aggregator._test_records
+    assert len(records) == frame_stats["captured_count"] - frame_stats["ring"]["dropped_count"]
+    assert records[-1]["data"].startswith(b"\xff\xd8fake_camera_frame_%d_" % frame_stats["captured_count"])
+
+
+def test_gps_sensor_decimation():
+
+    from waclient.sensors.gps import get_gps_sensor
+
+    fake_tarfile_aggregator = FakeTarfileRecordsAggregator()
+
+    json_aggregator = JsonDataAggregator(
+        max_duration_s=100, tarfile_aggregator=fake_tarfile_aggregator, sensor_name="test_gps",
+    )
+
+    sensor = get_gps_sensor(
+        json_aggregator=json_aggregator, polling_interval_s=0.01, min_distance_m=5, max_error_m=2
+    )
+
+    sensor.start()  # Fake GPS pushes an altitude and a status on desktop
+    for idx in range(10):  # Straight track, with a duplicate position
+        time.sleep(0.02)
+        sensor._on_location(lat=48.0 + (idx // 2) * 0.0001, lon=2.0, altitude=50)
+    sensor.stop()
+    sensor.join()
+
+    assert sensor.received_fixes_count == 11
+    assert sensor.dropped_fixes_count == 8  # Duplicates and intermediate points
+
+    json_aggregator.flush_dataset()
+    (record,) = fake_tarfile_aggregator._test_records
+    sensor_entries = load_from_json_bytes(record["data"])
+    assert len(sensor_entries) == 4  # Fake altitude, fake status, start and end of track
+    assert sensor_entries[0]["altitude"] == 2.2
+    assert sensor_entries[1]["status"] == "some_status_value"
+    assert sensor_entries[2]["lat"] == 48.0
+    assert sensor_entries[3]["lat"] == 48.0004
+    assert sensor_entries[2]["timestamp"] < sensor_entries[3]["timestamp"]
+
@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pytest
+
+from waclient.utilities.shutdown import ShutdownCoordinator
+
+
+def test_shutdown_coordinator_concurrent_stages():
+
+    coordinator = ShutdownCoordinator()
+    assert coordinator.get_remaining_time_s() is None
+    assert not coordinator.deadline_exceeded
+
+    calls = []
+
+    def _make_task(name, delay_s):
+        def _task():
+            time.sleep(delay_s)
+            calls.append(name)
+
+        return _task
+
+    assert coordinator.run_stage("first", dict(a=_make_task("a", 0.3), b=_make_task("b", 0.1), c=_make_task("c", 0.2)))
+    assert sorted(calls) == ["a", "b", "c"]
+    assert coordinator.run_stage("empty", {})
+
+    def _broken_task():
+        raise ValueError("flush failed")
+
+    assert coordinator.run_stage("second", dict(broken=_broken_task, d=_make_task("d", 0)))
+    assert calls[-1] == "d"
+
+    (error,) = coordinator.errors
+    assert isinstance(error, ValueError)
+
+    report = coordinator.get_report()
+    assert list(report["stage_durations_s"]) == ["first", "empty", "second"]
+    assert 0.3 <= report["stage_durations_s"]["first"] < 0.5  # Tasks ran concurrently
+    assert report["timed_out_stages"] == []
+    assert report["errors_count"] == 1
+    assert report["total_duration_s"] >= 0.3
+
+
+def test_shutdown_coordinator_deadline():
+
+    coordinator = ShutdownCoordinator(timeout_s=0.5)
+    assert 0 < coordinator.get_remaining_time_s() <= 0.5
+
+    unblock_event = threading.Event()
+    late_calls = []
+
+    start_time = time.monotonic()
+    assert not coordinator.run_stage("stuck", dict(stuck=unblock_event.wait, quick=lambda: None))
+    assert coordinator.deadline_exceeded
+    # Next stages depend on the abandoned one, so they are skipped
+    assert not coordinator.run_stage("after", dict(late=lambda: late_calls.append(True)))
+    assert time.monotonic() - start_time == pytest.approx(0.5, abs=0.15)
+
+    assert coordinator.timed_out_stages == ["stuck"]
+    assert coordinator.skipped_stages == ["after"]
+    report = coordinator.get_report()
+    assert report["timed_out_stages"] == ["stuck"]
+    assert report["skipped_stages"] == ["after"]
+    assert list(report["stage_durations_s"]) == ["stuck"]
+
+    time.sleep(0.2)
+    assert late_calls == []
+    unblock_event.set()
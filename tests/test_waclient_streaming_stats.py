@@ -0,0 +1,37 @@
+import random
+import statistics
+
+import pytest
+
+from waclient.utilities.streaming_stats import ExponentialMovingVariance
+
+
+def test_exponential_moving_variance():
+
+    with pytest.raises(AssertionError):
+        ExponentialMovingVariance(alpha=0)
+
+    estimator = ExponentialMovingVariance(alpha=0.05)
+    assert estimator.mean is None
+    assert estimator.variance == 0
+
+    assert estimator.update(3) == 0
+    assert estimator.mean == 3
+    for _ in range(100):
+        assert estimator.update(3) == 0  # Constant signal
+
+    samples = [random.gauss(10, 2) for _ in range(5000)]
+    for sample in samples:
+        estimator.update(sample)
+    assert estimator.count == 5101
+    assert estimator.mean == pytest.approx(10, abs=1.5)
+    assert estimator.variance == pytest.approx(statistics.pvariance(samples), rel=0.6)
+
+    for _ in range(200):  # Recent samples quickly prevail
+        estimator.update(-5)
+    assert estimator.mean == pytest.approx(-5, abs=0.01)
+    assert estimator.variance < 0.01
+
+    estimator.reset()
+    assert estimator.mean is None
+    assert estimator.count == 0